@@ -0,0 +1,110 @@
+"""Greedy-Dual-Size-Frequency Cache for Size-Aware Eviction"""
+
+from heapq import heapify, heappop, heappush
+from typing import Any, Dict, Hashable, Iterator, List, Optional, Tuple
+
+from sizing import entry_size
+
+
+class GDSFCache:
+    """Greedy-Dual-Size-Frequency cache
+
+    Each entry has priority L + frequency / size, where L is the priority of
+    the last evicted entry (the "inflation" that ages old entries). Large
+    objects need proportionally more hits to stay, so one big response cannot
+    push out many small hot ones. The heap uses lazy deletion, so get/put are
+    O(log n).
+    """
+
+    def __init__(self, max_size: Optional[int] = None, max_bytes: Optional[int] = None):
+        self.max_size = max_size
+        self.max_bytes = max_bytes
+        self.values: Dict[Hashable, Any] = {}
+        self.freq: Dict[Hashable, int] = {}
+        self.sizes: Dict[Hashable, int] = {}
+        self.priority: Dict[Hashable, Tuple[float, int]] = {}
+        self.heap: List[Tuple[float, int, Hashable]] = []
+        self.inflation = 0.0
+        self.bytes = 0
+        self.evictions = 0
+        self._seq = 0
+
+    def __len__(self) -> int:
+        return len(self.values)
+
+    def __contains__(self, key: Hashable) -> bool:
+        return key in self.values
+
+    def __iter__(self) -> Iterator[Hashable]:
+        return iter(self.values)
+
+    def score(self, count: int, size: int) -> float:
+        """Priority an entry with count accesses and size bytes would get now"""
+        return self.inflation + count / max(size, 1)
+
+    def get(self, key: Hashable) -> Optional[Any]:
+        """Get and count an access"""
+        if key not in self.values:
+            return None
+        self.freq[key] += 1
+        self._push(key)
+        return self.values[key]
+
+    def put(self, key: Hashable, value: Any, count: int = 1) -> None:
+        """Insert or update; new keys start at count accesses"""
+        size = entry_size(key, value)
+        if key in self.values:
+            self.bytes += size - self.sizes[key]
+            count = self.freq[key] + 1
+        else:
+            self.bytes += size
+        self.values[key] = value
+        self.sizes[key] = size
+        self.freq[key] = count
+        self._push(key)
+        while self.values and self._over():
+            self.evict()
+
+    def pop(self, key: Hashable) -> Optional[Any]:
+        """Remove a key without counting it as an eviction"""
+        if key not in self.values:
+            return None
+        self.bytes -= self.sizes.pop(key)
+        del self.freq[key]
+        del self.priority[key]
+        return self.values.pop(key)
+
+    def peek_victim(self) -> Optional[Tuple[Hashable, float]]:
+        """(key, priority) of the entry evict() would remove"""
+        while self.heap:
+            priority, seq, key = self.heap[0]
+            if self.priority.get(key) == (priority, seq):
+                return key, priority
+            heappop(self.heap)
+        return None
+
+    def evict(self) -> Optional[Tuple[Hashable, Any]]:
+        """Remove the lowest priority entry and raise the inflation to its priority"""
+        victim = self.peek_victim()
+        if victim is None:
+            return None
+        key, priority = victim
+        heappop(self.heap)
+        self.inflation = priority
+        self.evictions += 1
+        return key, self.pop(key)
+
+    def _over(self) -> bool:
+        if self.max_size is not None and len(self.values) > self.max_size:
+            return True
+        return self.max_bytes is not None and self.bytes > self.max_bytes
+
+    def _push(self, key: Hashable) -> None:
+        self._seq += 1
+        entry = (self.score(self.freq[key], self.sizes[key]), self._seq)
+        self.priority[key] = entry
+        heappush(self.heap, (entry[0], entry[1], key))
+        # Lazy deletion leaves stale heap entries behind; rebuild when they dominate
+        if len(self.heap) > 2 * len(self.values) + 64:
+            self.heap = [(p, s, k) for k, (p, s) in self.priority.items()]
+            heapify(self.heap)
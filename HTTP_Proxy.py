@@ -1,88 +1,266 @@
 """ Import's """
 
-from asyncio import StreamReader, StreamWriter, CancelledError, IncompleteReadError, open_connection, start_server, gather, run
-from json import load, dump, JSONDecodeError
+from asyncio import (
+    Event, StreamReader, StreamWriter, IncompleteReadError, create_task, get_running_loop, start_server, run, sleep,
+    wait_for,
+)
 from collections import OrderedDict
 from urllib.parse import urlparse
-from typing import Dict, Optional
-import http.client as http
+from typing import Callable, Dict, Optional, Set, Tuple, Union
 import logging
+import os
 import certifi
 import psutil
+import signal
 import socket
 import ssl
-import os
+import time
+
+from accesslog import AccessLog, note
+from blocklist import Blocklist, load_rules
+from bodystore import BodyStore
+from config import CONFIG_FILE, RESTART_KEYS, ConfigWatcher, load_config
+from dialer import Dialer
+from http1 import BodyTooLarge, RequestBody, keep_alive
+from httpcache import HTTPCache
+from metrics import BYTES_BUCKETS, Histogram, LoopMonitor, MetricsServer, Snapshot, render
+from mitm import Interceptor
+from resolver import Resolver, parse_nameserver
+from sharedcache import CacheClient, RemoteBodyStore
+from tls import TLSClient
+from upstream import UpstreamClient
+import tunnel
+from LFU import LFUCache
+from GDSF import GDSFCache
+from sizing import entry_size
+from store import LogStore, StoreLocked
+from cache import LRFUCache as SQLiteCache
+from tiered import TieredCache
 
 
 class LRFUCache:
-    def __init__(self, lru_capacity=50, lfu_capacity=50, cache_file="cache.json") -> None:
+    """Window LRU in front of a frequency-based main segment
+
+    New keys enter the LRU window. When the window overflows, its least
+    recent entry is only admitted into the main segment if it scores at
+    least as high as the entry it would displace. The main segment is an O(1)
+    LFU (policy="lfu") or size-aware GDSF (policy="gdsf"), where a large
+    response needs proportionally more hits to stay. Access counts are only
+    kept for resident keys, so metadata stays bounded by the capacities.
+    max_bytes bounds the summed size of both segments and objects above
+    max_object_size are not cached at all. Entries are persisted to an
+    append-only LogStore in cache_dir, or kept in memory only if another
+    process already writes there. on_evict(key, value) is called for
+    every entry pushed out by capacity.
+    """
+
+    def __init__(self, lru_capacity=50, lfu_capacity=50, cache_dir="cache",
+                 max_bytes: Optional[int] = None, max_object_size: Optional[int] = None,
+                 policy: str = "lfu", on_evict: Optional[Callable[[str, bytes], None]] = None) -> None:
+        if policy not in ("lfu", "gdsf"):
+            raise ValueError(f"Unknown cache policy: {policy}")
         self.lru_cache = OrderedDict()
-        self.lfu_cache = OrderedDict()
+        self.lfu_cache = LFUCache(lfu_capacity) if policy == "lfu" else GDSFCache(lfu_capacity)
         self.lru_capacity = lru_capacity
         self.lfu_capacity = lfu_capacity
+        self.max_bytes = max_bytes
+        self.max_object_size = max_object_size
         self.access_count = {}
-        self.cache_file = cache_file
+        self.lru_sizes = {}
+        self.lru_bytes = 0
+        self.evictions = 0
+        self.rejected = 0
+        self.on_evict = on_evict
+        self.store = self._open_store(cache_dir) if cache_dir else None
         self._load_cache()
 
+    @staticmethod
+    def _open_store(cache_dir: str) -> Optional[LogStore]:
+        try:
+            return LogStore(cache_dir)
+        except StoreLocked as e:
+            # e.g. supervisor --no-shared-cache: the first worker persists, the others cache in memory
+            logging.warning(f"{e}, caching in memory only")
+            return None
+
     def _load_cache(self):
-        if os.path.exists(self.cache_file):
-            try:
-                with open(self.cache_file, "r", encoding="utf-8") as file:
-                    data = load(file)
-                    self.lru_cache = OrderedDict(data.get("lru_cache", {}))
-                    self.lfu_cache = OrderedDict(data.get("lfu_cache", {}))
-                    self.access_count = data.get("access_count", {})
-            except JSONDecodeError:
-                logging.warning("Cache file is corrupted. Resetting cache.")
-                self._save_cache()
-
-    def _save_cache(self):
-        with open(self.cache_file, "w", encoding="utf-8") as file:
-            dump({"lru_cache": self.lru_cache, "lfu_cache": self.lfu_cache,
-                 "access_count": self.access_count}, file)
+        if self.store is None:
+            return
+        for key, value in self.store.items():
+            self.put(key, value, persist=False)
+
+    def close(self) -> None:
+        """Flush pending writes to disk"""
+        if self.store is not None:
+            self.store.close()
+
+    def __len__(self) -> int:
+        return len(self.lru_cache) + len(self.lfu_cache)
+
+    @property
+    def bytes(self) -> int:
+        return self.lru_bytes + self.lfu_cache.bytes
+
+    def stats(self) -> Dict[str, int]:
+        """Size and eviction counters"""
+        return {"entries": len(self), "bytes": self.bytes, "max_bytes": self.max_bytes or 0,
+                "evictions": self.evictions, "rejected": self.rejected}
+
+    def resize(self, lru_capacity: int, lfu_capacity: int, max_bytes: Optional[int] = None,
+               max_object_size: Optional[int] = None) -> None:
+        """Apply new limits, evicting whatever no longer fits"""
+        self.lru_capacity = lru_capacity
+        self.lfu_capacity = lfu_capacity
+        self.lfu_cache.max_size = lfu_capacity
+        self.max_bytes = max_bytes
+        self.max_object_size = max_object_size
+        while len(self.lfu_cache) > lfu_capacity:
+            self._evicted(*self.lfu_cache.evict())
+        self._shrink_window()
+        self._shrink_bytes()
 
     def get(self, key: str) -> Optional[bytes]:
         if key in self.lru_cache:
             self.lru_cache.move_to_end(key)
-            self.access_count[key] = self.access_count.get(key, 0) + 1
-            return self.lru_cache[key]
-        if key in self.lfu_cache:
             self.access_count[key] += 1
-            return self.lfu_cache[key]
-        return None
+            return self.lru_cache[key]
+        return self.lfu_cache.get(key)
 
-    def put(self, key: str, value: bytes):
-        if key in self.lru_cache or key in self.lfu_cache:
-            self.access_count[key] = self.access_count.get(key, 0) + 1
-        else:
-            self.access_count[key] = 1
+    def put(self, key: str, value: bytes, persist: bool = True):
+        size = entry_size(key, value)
+        if self.max_object_size is not None and size > self.max_object_size:
+            self.rejected += 1
+            self._discard(key)
+            return
 
-        if len(self.lru_cache) < self.lru_capacity:
+        if key in self.lru_cache:
+            self.lru_bytes += size - self.lru_sizes[key]
             self.lru_cache[key] = value
-        elif len(self.lfu_cache) < self.lfu_capacity:
-            self.lfu_cache[key] = value
+            self.lru_sizes[key] = size
+            self.lru_cache.move_to_end(key)
+            self.access_count[key] += 1
+        elif key in self.lfu_cache:
+            self.lfu_cache.put(key, value)
         else:
-            least_accessed = min(
-                self.access_count, key=lambda k: self.access_count[k])
-            if least_accessed in self.lfu_cache:
-                del self.lfu_cache[least_accessed]
-            elif least_accessed in self.lru_cache:
-                del self.lru_cache[least_accessed]
-            del self.access_count[least_accessed]
             self.lru_cache[key] = value
+            self.lru_sizes[key] = size
+            self.lru_bytes += size
+            self.access_count[key] = 1
+            self._shrink_window()
+        self._shrink_bytes()
+
+        if persist and self.store is not None and (key in self.lru_cache or key in self.lfu_cache):
+            self.store.put(key, value)
+
+    def delete(self, key: str) -> None:
+        """Remove a key from the cache and the store"""
+        self._discard(key)
+
+    async def aget(self, key: str) -> Optional[bytes]:
+        return self.get(key)
+
+    async def aput(self, key: str, value: bytes) -> None:
+        self.put(key, value)
 
-        self._save_cache()
+    async def adelete(self, key: str) -> None:
+        self.delete(key)
+
+    def _discard(self, key: str) -> None:
+        """Drop a key from whichever segment holds it"""
+        if key in self.lru_cache:
+            del self.lru_cache[key]
+            del self.access_count[key]
+            self.lru_bytes -= self.lru_sizes.pop(key)
+        elif self.lfu_cache.pop(key) is None:
+            return
+        if self.store is not None:
+            self.store.delete(key)
+
+    def _shrink_window(self) -> None:
+        """Move window overflow into the main segment, subject to admission"""
+        while len(self.lru_cache) > self.lru_capacity:
+            key, value = self.lru_cache.popitem(last=False)
+            count = self.access_count.pop(key)
+            size = self.lru_sizes.pop(key)
+            self.lru_bytes -= size
+            if len(self.lfu_cache) < self.lfu_capacity:
+                self.lfu_cache.put(key, value, count)
+                continue
+            victim = self.lfu_cache.peek_victim()
+            if victim is not None and self.lfu_cache.score(count, size) >= victim[1]:
+                dropped = self.lfu_cache.evict()
+                self.lfu_cache.put(key, value, count)
+            else:
+                dropped = key, value
+            self._evicted(*dropped)
+
+    def _shrink_bytes(self) -> None:
+        """Evict until both segments fit in max_bytes: main segment victims first, then the window"""
+        if self.max_bytes is None:
+            return
+        while self.bytes > self.max_bytes:
+            if len(self.lfu_cache):
+                dropped = self.lfu_cache.evict()
+            elif self.lru_cache:
+                dropped = self.lru_cache.popitem(last=False)
+                del self.access_count[dropped[0]]
+                self.lru_bytes -= self.lru_sizes.pop(dropped[0])
+            else:
+                return
+            self._evicted(*dropped)
+
+    def _evicted(self, key: str, value: bytes) -> None:
+        self.evictions += 1
+        if self.store is not None:
+            self.store.delete(key)
+        if self.on_evict is not None:
+            self.on_evict(key, value)
+
+
+def build_cache(data: Dict) -> Union[LRFUCache, TieredCache]:
+    """The cache backend a config asks for"""
+    if data.get("Cache_Backend", "memory") == "tiered":
+        # Memory-only LRFU as the hot tier, SQLite as the persistent cold tier
+        hot = LRFUCache(
+            data["Max_Cache_Size"], data["Max_Cache_Size"], None,
+            data.get("Max_Cache_Bytes"), data.get("Max_Object_Size"),
+            data.get("Cache_Policy", "lfu"))
+        cold = SQLiteCache(data.get("Cache_DB", "proxy_cache.db"),
+                           data.get("Disk_Cache_Entries", 100000), data.get("Disk_Cache_Bytes"),
+                           data.get("Max_Object_Size"))
+        return TieredCache(hot, cold)
+    return LRFUCache(
+        data["Max_Cache_Size"], data["Max_Cache_Size"], data.get("Cache_Dir", "cache"),
+        data.get("Max_Cache_Bytes"), data.get("Max_Object_Size"),
+        data.get("Cache_Policy", "lfu"))
+
+
+def build_body_store(data: Dict) -> BodyStore:
+    """Bodies above the spill threshold go to files and are sent with sendfile"""
+    return BodyStore(data.get("Body_Dir", "cache_bodies"),
+                     data.get("Body_Store_Bytes", 4 * 1024 * 1024 * 1024),
+                     data.get("Max_Body_Object_Size", 1024 * 1024 * 1024))
+
+
+def resize_cache(cache: Union[LRFUCache, TieredCache], data: Dict) -> None:
+    """Apply a reloaded config's limits to a cache from build_cache()"""
+    size = data["Max_Cache_Size"]
+    if isinstance(cache, TieredCache):
+        cache.l1.resize(size, size, data.get("Max_Cache_Bytes"), data.get("Max_Object_Size"))
+        cache.l2.resize(data.get("Disk_Cache_Entries", 100000), data.get("Disk_Cache_Bytes"),
+                        data.get("Max_Object_Size"))
+    else:
+        cache.resize(size, size, data.get("Max_Cache_Bytes"), data.get("Max_Object_Size"))
 
 
 class Proxy:
-    def __init__(self, IP="0.0.0.0", PORT=8080) -> None:
+    def __init__(self, IP="0.0.0.0", PORT=8080, cache_socket: Optional[str] = None) -> None:
         self.PORT = PORT
         self.IP = IP
         try:
-            with open("Config.json", "r", encoding="utf-8") as file:
-                self.data = load(file)  # Load JSON file content
-        except JSONDecodeError:
-            raise RuntimeError("Was not able to load JSON file: Config.json")
+            self.data = load_config(CONFIG_FILE)
+        except ValueError as e:
+            raise RuntimeError(f"Was not able to load JSON file: {CONFIG_FILE} ({e})")
         except FileNotFoundError as e:
             logging.error(e)
 
@@ -90,22 +268,149 @@ class Proxy:
             level=logging.INFO, format="%(asctime)s - %(levelname)s - %(message)s"
         )
 
-        with open("site/block.html", "r", encoding="utf-8") as file:
-            self.html_file = file.read().encode()
-            file.close()
+        self.html_file, self.blocklist = self.__compile(self.data)
 
-        self.cache = LRFUCache(
-            self.data["Max_Cache_Size"], self.data["Max_Cache_Size"], self.data["Cache_File"])
+        if cache_socket is not None:
+            # Another process owns the cache and the body store's accounting
+            self.cache = CacheClient(cache_socket)
+            bodies = RemoteBodyStore(self.data.get("Body_Dir", "cache_bodies"), self.cache,
+                                     self.data.get("Max_Body_Object_Size", 1024 * 1024 * 1024))
+        else:
+            self.cache = build_cache(self.data)
+            bodies = build_body_store(self.data)
+        self.http_cache = HTTPCache(self.cache, bodies=bodies)
+        nameservers = [parse_nameserver(server) for server in self.data.get("DNS_Servers", [])]
+        self.resolver = Resolver(nameservers or None, self.data.get("DNS_Prefer", "ipv4"),
+                                 max_entries=self.data.get("DNS_Cache_Size", 10000))
+        self.dialer = Dialer(self.resolver)
+        # One context (and CA bundle parse) per process, with sessions resumed per origin
+        self.tls = TLSClient(self.data.get("TLS_Session_Cache", 1024))
+        self.tls_context = self.tls.context(self.data.get("TLS_CA_File") or certifi.where())
+        self.upstream = UpstreamClient(dialer=self.dialer)
+        # TLS interception for MITM_Domains; the CA is only loaded or created once a host matches
+        self.mitm = Interceptor(self.data.get("MITM_CA", "mitm_ca.pem"), self.data.get("MITM_Cert_Dir", "mitm_certs"),
+                                self.data.get("MITM_Domains", []), self.data.get("MITM_Cert_Cache", 1024))
+        # One JSON line per request, written by a background thread; off unless Access_Log names a file or "-"
+        access_log = self.data.get("Access_Log", "")
+        self.access_log = AccessLog(access_log, max_queue=self.data.get("Access_Log_Queue", 65536)) \
+            if access_log else None
+        self.__apply(self.data)
+        self.connections = 0
+        self.requests = 0
+        self.tunnels = 0
+        # Client-side view: from a request line to its response being written, and per tunnel
+        self.request_seconds = Histogram()
+        self.tunnel_seconds = Histogram()
+        self.tunnel_bytes = Histogram(BYTES_BUCKETS)
+        self.loop_monitor = LoopMonitor()
+        # Keep-alive connections waiting for their next request, closed first when draining
+        self.idle: Set[StreamWriter] = set()
+        self.draining = False
+
+    @staticmethod
+    def __compile(data: Dict) -> Tuple[bytes, Blocklist]:
+        """Build everything derived from a config that is too slow to build on the event loop"""
+        with open("site/block.html", "r", encoding="utf-8") as file:
+            html_file = file.read().encode()
+        rules = list(data["BlockedSites"])
+        for path in data.get("Blocklist_Files", []):
+            rules.extend(load_rules(path))
+        return html_file, Blocklist(rules, data.get("Block_Verdict_Cache", 65536))
+
+    def __apply(self, data: Dict) -> None:
+        """Take the per-request settings from a config"""
+        self.keepalive_timeout = data.get("Keep_Alive_Timeout", 15)
+        self.max_requests = data.get("Max_Requests_Per_Connection", 100)
+        self.max_object_size = data.get("Max_Object_Size", 8 * 1024 * 1024)
+        self.max_body_size = data.get("Max_Body_Size", 64 * 1024 * 1024)
+        self.tunnel_engine = data.get("Tunnel_Engine", "auto")
+        self.tunnel_buffer_size = data.get("Tunnel_Buffer_Size", tunnel.DEFAULT_BUFFER)
+        self.http_cache.max_object_size = self.max_object_size
+        self.http_cache.coalesce_timeout = data.get("Coalesce_Timeout", 10.0)
+        self.http_cache.stale_while_revalidate = data.get("Stale_While_Revalidate", 0.0)
+        self.http_cache.stale_if_error = data.get("Stale_If_Error", 300.0)
+        self.http_cache.bodies.max_bytes = data.get("Body_Store_Bytes", 4 * 1024 * 1024 * 1024)
+        self.http_cache.bodies.max_body_size = data.get("Max_Body_Object_Size", 1024 * 1024 * 1024)
+        self.resolver.prefer = data.get("DNS_Prefer", "ipv4")
+        self.resolver.max_ttl = data.get("DNS_Max_TTL", 3600)
+        self.resolver.negative_ttl = data.get("DNS_Negative_TTL", 30)
+        self.dialer.attempt_delay = data.get("Happy_Eyeballs_Delay", 0.25)
+        self.dialer.attempt_timeout = data.get("Connect_Attempt_Timeout", 5.0)
+        self.dialer.total_timeout = data.get("Connect_Timeout", 10.0)
+        self.mitm.bypass_ttl = data.get("MITM_Bypass_TTL", 3600.0)
+        self.mitm.domains = self.mitm.compile(data.get("MITM_Domains", []))
+        if self.access_log is not None:
+            self.access_log.sample_rate = data.get("Access_Log_Sample", 1.0)
+
+    async def reload(self) -> bool:
+        """Re-read Config.json and swap in the new settings, keeping the running ones if it is invalid
+
+        Parsing and compiling the blocklist run in a worker thread; the swap
+        itself has no await, so every request sees either the old settings or
+        the new ones. Open connections and tunnels are left alone.
+        """
+        loop = get_running_loop()
+        try:
+            data = await loop.run_in_executor(None, load_config, CONFIG_FILE)
+            html_file, blocklist = await loop.run_in_executor(None, self.__compile, data)
+        except (OSError, ValueError) as e:
+            logging.error(f"Rejected new {CONFIG_FILE}, keeping the running config: {e}")
+            return False
+        for key in RESTART_KEYS:
+            if data.get(key) != self.data.get(key):
+                logging.warning(f"{key} changed in {CONFIG_FILE}; it takes effect after a restart")
+        self.data, self.html_file, self.blocklist = data, html_file, blocklist
+        self.__apply(data)
+        if not isinstance(self.cache, CacheClient):
+            resize_cache(self.cache, data)
+        logging.info(f"Reloaded {CONFIG_FILE}: {len(blocklist)} block rules")
+        return True
 
     async def __handle_client(self, reader: StreamReader, writer: StreamWriter) -> None:
         """ Handle Client's"""
+        self.connections += 1
         try:
-            request_line = await reader.readuntil(b"\r\n")
-            if not request_line:
-                return
-            method, url, _ = request_line.split(b" ", 2)
+            await self.__serve(reader, writer, client=self.__peer(writer))
+        except IncompleteReadError as e:
+            logging.error(e)
+        finally:
+            self.connections -= 1
+            writer.close()
+
+    def __peer(self, writer: StreamWriter) -> Optional[str]:
+        """Client address for the access log"""
+        if self.access_log is None:
+            return None
+        peer = writer.get_extra_info("peername")
+        return f"{peer[0]}:{peer[1]}" if isinstance(peer, tuple) else None
+
+    async def __serve(self, reader: StreamReader, writer: StreamWriter, origin: Optional[bytes] = None,
+                      client: Optional[str] = None) -> None:
+        """Serve requests on a client connection; origin completes origin-form URLs inside an intercepted tunnel"""
+        served = 0
+        while served < self.max_requests and not self.draining:
+            self.idle.add(writer)
+            try:
+                request_line = await wait_for(reader.readuntil(b"\r\n"), self.keepalive_timeout)
+            except TimeoutError:
+                break
+            except IncompleteReadError as e:
+                if e.partial:
+                    raise
+                break
+            finally:
+                self.idle.discard(writer)
+            if request_line == b"\r\n":
+                continue
+            start = time.perf_counter()
+            method, url, version = request_line.split(b" ", 2)
+            version = version.strip().decode("utf-8")
             headers = {}
-            body = bytes()
+            served += 1
+            self.requests += 1
+            record = None
+            if self.access_log is not None:
+                record = self.access_log.start(client, method.decode("latin-1"), url.decode("latin-1"), version)
 
             while True:
                 line = await reader.readuntil(b"\r\n")
@@ -115,21 +420,39 @@ class Proxy:
                 key, value = header.split(":", 1)
                 headers[key.strip()] = value.strip()
 
-            content_length = headers.get("Content-Length")
-            if content_length:
-                body = await reader.readexactly(int(content_length))
+            body = RequestBody(reader, list(headers.items()), self.max_body_size, writer, version)
+            if body.too_large:
+                note(status=413)
+                writer.write(b"HTTP/1.1 413 Content Too Large\r\nContent-Length: 0\r\nConnection: close\r\n\r\n")
+                await writer.drain()
+                if record is not None:
+                    self.access_log.finish(record)
+                break
 
             if method.lower() == b"connect":
-                await self.__handle_connect(reader, writer, url)
-            else:
-                logging.info(request_line)
-                await self.__handle_http(writer, method, url, headers, body)
-        except IncompleteReadError as e:
-            logging.error(e)
-        finally:
-            writer.close()
-
-    async def __handle_connect(self, reader: StreamReader, writer: StreamWriter, url: bytes) -> None:
+                if origin is None:
+                    await self.__handle_connect(reader, writer, url, client)
+                if record is not None:
+                    self.access_log.finish(record)
+                break
+            if origin is not None and url.startswith(b"/"):
+                url = origin + url
+                if record is not None:
+                    record.target = url.decode("latin-1")
+
+            persistent = served < self.max_requests and keep_alive(version, list(headers.items()))
+            reusable = await self.__handle_http(writer, method, url, headers, body, version, persistent)
+            self.request_seconds.observe(time.perf_counter() - start)
+            if record is not None:
+                self.access_log.finish(record)
+            if not reusable:
+                break
+            # An unread body would be parsed as the next request
+            if not persistent or not body.consumed:
+                break
+
+    async def __handle_connect(self, reader: StreamReader, writer: StreamWriter, url: bytes,
+                               client: Optional[str] = None) -> None:
         """Handle Connection's"""
         parsed_url = urlparse(url.decode("utf-8"))
         host, _, port = url.decode("utf-8").rpartition(":")
@@ -140,110 +463,143 @@ class Proxy:
 
         try:
             if self.__Should_Block(host) or host == "/" or not host:
+                note(cache="BLOCKED", status=403)
                 writer.write(b"HTTP/1.1 403 Forbidden\r\n\r\n")
                 await writer.drain()
                 writer.close()
                 return
 
-            target_reader, target_writer = await open_connection(host=host, port=port)
+            if self.mitm.intercepts(host) and await self.__intercept(reader, writer, host, port, client):
+                return
+
+            start = time.perf_counter()
+            target_reader, target_writer = await self.dialer.connect(host, port)
+            note(cache="TUNNEL", status=200, upstream=f"{host}:{port}", upstream_seconds=time.perf_counter() - start)
             writer.write(b"HTTP/1.1 200 Connection established\r\n\r\n")
             await writer.drain()
-            await gather(
-                self.__relay(reader, target_writer),
-                self.__relay(target_reader, writer)
-            )
+            start = time.perf_counter()
+            self.tunnels += 1
+            try:
+                relayed = await tunnel.relay(reader, writer, target_reader, target_writer,
+                                             self.tunnel_engine, self.tunnel_buffer_size)
+            finally:
+                self.tunnels -= 1
+            self.tunnel_seconds.observe(time.perf_counter() - start)
+            self.tunnel_bytes.observe(relayed)
+            note(sent=relayed)
         except ConnectionAbortedError as e:
             logging.error(e)
         except ConnectionRefusedError as e:
             logging.error(e)
         except socket.gaierror as e:
             logging.error(e)
+        except TimeoutError as e:
+            logging.error(e)
+        except OSError as e:
+            # Every address of the origin failed
+            logging.error(e)
         finally:
             writer.close()
 
-    async def __handle_http(self, writer: StreamWriter, method: bytes, url: bytes, headers: Dict[str, str], body: bytes) -> None:
-        """Handle Http Communication"""
+    async def __intercept(self, reader: StreamReader, writer: StreamWriter, host: str, port: int,
+                          client: Optional[str] = None) -> bool:
+        """Terminate the client's TLS with a minted certificate and serve the tunnel like plain proxy requests
+
+        Returns False, with nothing sent to the client, if no certificate can
+        be had for host, so the caller can tunnel it blindly instead.
+        """
+        try:
+            context = await self.mitm.context(host)
+        except (ValueError, OSError) as e:
+            # e.g. a host name cryptography cannot put in a certificate, or an unreadable CA
+            self.mitm.failed(host, minting=True)
+            logging.warning(f"Could not make a certificate for {host}, tunnelling it blindly: {e!r}")
+            return False
+        note(cache="INTERCEPTED", status=200)
+        writer.write(b"HTTP/1.1 200 Connection established\r\n\r\n")
+        await writer.drain()
+        try:
+            await writer.start_tls(context, ssl_handshake_timeout=self.keepalive_timeout)
+        except (ssl.SSLError, ConnectionError, TimeoutError) as e:
+            self.mitm.failed(host)
+            logging.warning(f"Client rejected the intercepted certificate for {host}; closing the connection, "
+                            f"later ones are tunnelled blindly: {e!r}")
+            return True
+        self.mitm.counters["intercepted"] += 1
+        origin = f"https://{host}" if port == 443 else f"https://{host}:{port}"
+        await self.__serve(reader, writer, origin.encode(), client)
+        return True
+
+    async def __handle_http(self, writer: StreamWriter, method: bytes, url: bytes, headers: Dict[str, str], body: RequestBody,
+                            version: str = "HTTP/1.1", persistent: bool = False) -> bool:
+        """Handle Http Communication, returning whether the client connection is reusable"""
         parsed_url = urlparse(url.decode("utf-8"))
-        host, _, port = url.decode("utf-8").rpartition(":")
-        port = (
-            int(port) if port.isnumeric(
-            ) else 443 if parsed_url.scheme == "https" else 80
-        )
-        cache_key = f"{method.decode()}:{parsed_url.geturl()}"
+        host = parsed_url.hostname or ""
+        port = parsed_url.port or (443 if parsed_url.scheme == "https" else 80)
+        # Set when fetch() fails: every path asks upstream before writing anything, so the client
+        # has not seen a response head yet and can still be told about it
+        upstream_failed = False
 
         try:
             if self.__Should_Block(host) or host == "/" or not host:
+                note(cache="BLOCKED", status=403)
                 writer.write(b"HTTP/1.1 403 Forbidden\r\n\r\n")
                 await writer.drain()
-                writer.close()
-                return
-
-            cached_response = self.cache.get(cache_key)
-            if cached_response:
-                writer.write(cached_response)
-                await writer.drain()
-                return
+                return False
 
-            if parsed_url.scheme.lower() == "https":
-                context = ssl.create_default_context(ssl.Purpose.CLIENT_AUTH)
-                context.load_verify_locations(cafile=certifi.where())
-                conn = http.HTTPSConnection(
-                    host=host, port=port, context=context
-                )
-            else:
-                conn = http.HTTPConnection(host=host, port=port)
+            context = self.tls_context if parsed_url.scheme.lower() == "https" else None
 
             path = parsed_url.path or "/"
             if parsed_url.query:
                 path += f"?{parsed_url.query}"
 
-            conn.request(method=method.decode("utf-8"),
-                         url=path, body=body, headers=headers)
-
-            response = conn.getresponse()
-            data = response.read()
-
-            response_headers = f"HTTP/1.1 {response.status} {response.reason}\r\n".encode()
-            for key, value in response.getheaders():
-                response_headers += f"{key}: {value}\r\n".encode()
-
-            response_headers += b"\r\n"
-            full_response = response_headers + data
-            self.cache.put(cache_key, full_response)
-
-            writer.write(full_response)
+            async def fetch(send_headers):
+                nonlocal upstream_failed
+                start = time.perf_counter()
+                try:
+                    response = await self.upstream.request(
+                        parsed_url.scheme.lower(), host, port, method.decode("utf-8"), path,
+                        send_headers, body, ssl_context=context)
+                except Exception:
+                    upstream_failed = True
+                    raise
+                note(upstream=f"{host}:{port}", upstream_seconds=time.perf_counter() - start)
+                return response
+
+            return await self.http_cache.serve(fetch, writer, method.decode("utf-8"), parsed_url.geturl(),
+                                               list(headers.items()), body, version, persistent)
+        except BodyTooLarge as e:
+            logging.warning(e)
+            note(status=413)
+            writer.write(b"HTTP/1.1 413 Content Too Large\r\nContent-Length: 0\r\nConnection: close\r\n\r\n")
             await writer.drain()
+            return False
         except ConnectionAbortedError as e:
             logging.error(e)
         except ConnectionRefusedError as e:
             logging.error(e)
         except socket.gaierror as e:
             logging.error(e)
-        finally:
-            writer.close()
-
-    async def __relay(self, reader: StreamReader, writer: StreamWriter) -> None:
-        """Handle Relaying Data"""
-        try:
-            while True:
-                data = await reader.read(4096)
-                if not data:
-                    break
-                writer.write(data)
+        except TimeoutError as e:
+            logging.error(e)
+        except OSError as e:
+            logging.error(e)
+        except IncompleteReadError as e:
+            logging.error(e)
+        except ValueError as e:  # http1.ProtocolError: the origin did not answer in HTTP/1.x
+            logging.error(e)
+        if upstream_failed:
+            note(status=502)
+            try:
+                writer.write(b"HTTP/1.1 502 Bad Gateway\r\nContent-Length: 0\r\nConnection: close\r\n\r\n")
                 await writer.drain()
-        except CancelledError:
-            logging.error("Relay task cancelled.")
-        except ConnectionResetError:
-            logging.error("Connection reset by peer.")
-        finally:
-            writer.close()
+            except ConnectionError:
+                pass
+        return False
 
     def __Should_Block(self, host: str) -> bool:
         """If the site getting accessed should be block"""
-        for site in self.data["BlockedSites"]:
-            if str(site).lower() in host.lower():
-                return True
-        return False
+        return self.blocklist.blocked(host)
 
     async def __get_ip(self) -> None:
         """Get the first available Ethernet or Wireless IP address."""
@@ -262,45 +618,146 @@ class Proxy:
         self.IP = ethernet_ips[0] if ethernet_ips else (
             wireless_ips[0] if wireless_ips else "127.0.0.1")
 
-    async def __find_available_port(self, start_port=19132, end_port=65535, fallback_port=8080) -> None:
-        """Find an available port within the given range, with a fallback."""
+    async def __start_on_free_port(self, start_port=19132, end_port=65535, fallback_port=8080):
+        """Start the server on the first free port in the range, with a fallback.
+
+        The server binds each candidate itself, so no other process can take
+        the port between finding it and using it.
+        """
         for port in range(start_port, end_port):
-            with socket.socket(socket.AF_INET, socket.SOCK_STREAM) as s:
-                s.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
-                try:
-                    # Bind immediately to lock the port
-                    s.bind(("0.0.0.0", port))
-                    # Ensure the port is usable for TCP connections
-                    s.listen(1)
-                    s.close()  # Close so the actual proxy server can use it
-                    self.PORT = port
-                    logging.info(f"Found available port: {self.PORT}")
-                    return  # Exit early once a free port is found
-                except OSError:
-                    continue  # Port is in use, try the next one
+            try:
+                server = await start_server(self.__handle_client, host=self.IP, port=port)
+            except OSError:
+                continue  # Port is in use, try the next one
+            self.PORT = port
+            logging.info(f"Found available port: {self.PORT}")
+            return server
         logging.warning(
             f"No available port found in range {start_port}-{end_port}, falling back to {fallback_port}")
         self.PORT = fallback_port  # Fallback only if no port was found
-
-    async def Start(self) -> None:
-        """Start the server"""
-
-        if self.IP == "0.0.0.0":
+        return await start_server(self.__handle_client, host=self.IP, port=self.PORT)
+
+    def stats(self) -> Dict[str, float]:
+        """Counters from every component, prefixed with the component name"""
+        stats: Dict[str, float] = {"connections": self.connections, "requests": self.requests,
+                                   "tunnels": self.tunnels}
+        components = (
+            ("http_cache", self.http_cache.stats()), ("cache", self.cache.stats()),
+            ("bodies", self.http_cache.bodies.stats()), ("dns", self.resolver.stats()),
+            ("dialer", self.dialer.stats()), ("pool", self.upstream.pool.stats()),
+            ("blocklist", self.blocklist.stats()), ("tls", self.tls.stats()),
+            ("mitm", self.mitm.stats()), ("loop", self.loop_monitor.stats()),
+        )
+        if self.access_log is not None:
+            components += (("access_log", self.access_log.stats()),)
+        for name, values in components:
+            for key, value in values.items():
+                stats[f"{name}_{key}"] = value
+        return stats
+
+    def histograms(self) -> Dict[str, Snapshot]:
+        """Latency and size histograms from every component, named like stats()"""
+        histograms = {"request_seconds": self.request_seconds, "tunnel_seconds": self.tunnel_seconds,
+                      "tunnel_bytes": self.tunnel_bytes}
+        components = (
+            ("http_cache", self.http_cache.histograms()), ("dialer", self.dialer.histograms()),
+            ("upstream", self.upstream.histograms()), ("loop", self.loop_monitor.histograms()),
+        )
+        for name, values in components:
+            for key, value in values.items():
+                histograms[f"{name}_{key}"] = value
+        return {name: histogram.snapshot() for name, histogram in histograms.items()}
+
+    def metrics(self) -> str:
+        """stats() and histograms() in Prometheus text format"""
+        return render(self.stats(), self.histograms())
+
+    async def drain(self, server, timeout: float = 30.0) -> None:
+        """Stop accepting, close idle keep-alive connections and let in-flight ones finish for up to timeout"""
+        self.draining = True
+        server.close()
+        for writer in list(self.idle):
+            writer.close()
+        deadline = time.monotonic() + timeout
+        while self.connections and time.monotonic() < deadline:
+            await sleep(0.1)
+        if self.connections:
+            logging.warning(f"Drain timed out with {self.connections} connections still open")
+
+    async def __report(self, stats_queue, interval: float) -> None:
+        """Send stats to the supervisor every interval seconds"""
+        while True:
+            stats_queue.put((os.getpid(), self.stats(), self.histograms()))
+            await sleep(interval)
+
+    async def Start(self, sock: Optional[socket.socket] = None, reuse_port: bool = False,
+                    stats_queue=None, stats_interval: float = 5.0, drain_timeout: float = 30.0) -> None:
+        """Start the server
+
+        Standalone, it finds its own address and port and serves its metrics
+        on Metrics_Port. Under the supervisor every worker either binds the
+        shared address with reuse_port or serves a listening socket inherited
+        from it (sock), reports stats to stats_queue (the supervisor serves
+        the metrics), and drains gracefully on SIGTERM.
+        """
+
+        if sock is None and self.IP == "0.0.0.0" and not reuse_port:
             await self.__get_ip()
 
-        if self.PORT != 8080:
-            await self.__find_available_port()
-
+        watcher = ConfigWatcher(CONFIG_FILE, self.reload, self.data.get("Config_Poll_Interval", 2.0))
+        watcher.start()
+        if len(self.mitm.domains):
+            self.mitm.prewarm(self.data.get("MITM_Prewarm", []))
+        self.loop_monitor.start()
+        metrics = None
+        if stats_queue is None and self.data.get("Metrics_Port"):
+            metrics = MetricsServer(self.metrics)
+            try:
+                await metrics.start(self.data.get("Metrics_Host", "127.0.0.1"), self.data["Metrics_Port"])
+            except OSError as e:
+                logging.warning(f"Not serving metrics on port {self.data['Metrics_Port']}: {e}")
+                metrics = None
+        stopping = Event()
+        try:
+            get_running_loop().add_signal_handler(signal.SIGTERM, stopping.set)
+        except (NotImplementedError, RuntimeError, AttributeError):
+            pass  # No loop signal handlers here; SIGTERM stops the process outright
+        reporter = None
         try:
-            server = await start_server(
-                self.__handle_client,
-                host=self.IP, port=self.PORT
-            )
+            if sock is not None:
+                server = await start_server(self.__handle_client, sock=sock)
+            elif reuse_port:
+                server = await start_server(self.__handle_client, host=self.IP, port=self.PORT, reuse_port=True)
+            elif self.PORT != 8080:
+                server = await self.__start_on_free_port()
+            else:
+                server = await start_server(
+                    self.__handle_client,
+                    host=self.IP, port=self.PORT
+                )
             async with server:
                 logging.info(f"Serving at port {self.IP} on IP {self.PORT}")
-                await server.serve_forever()
+                if stats_queue is not None:
+                    reporter = create_task(self.__report(stats_queue, stats_interval))
+                await stopping.wait()
+                logging.info("Draining connections....")
+                await self.drain(server, drain_timeout)
         except KeyboardInterrupt:
             print("Shutting down server....")
+        finally:
+            if reporter is not None:
+                reporter.cancel()
+            if metrics is not None:
+                await metrics.close()
+            self.loop_monitor.stop()
+            await watcher.stop()
+            self.mitm.close()
+            self.upstream.pool.close()
+            if self.access_log is not None:
+                self.access_log.close()
+            if isinstance(self.cache, TieredCache):
+                await self.cache.aclose()
+            self.cache.close()
 
 
 if __name__ == "__main__":
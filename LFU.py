@@ -0,0 +1,125 @@
+"""O(1) Least-Frequently-Used Cache with Per-Frequency Buckets"""
+
+from collections import OrderedDict
+from typing import Any, Dict, Hashable, Iterator, Optional, Tuple
+
+from sizing import entry_size
+
+
+class LFUCache:
+    """O(1) LFU cache
+
+    Keys live in per-frequency buckets; each bucket is an OrderedDict, so ties
+    within a frequency are broken by recency and every operation is O(1).
+    Frequencies are only kept for resident keys. max_bytes optionally bounds
+    the summed entry sizes as well as the entry count.
+    """
+
+    def __init__(self, max_size: int, max_bytes: Optional[int] = None):
+        self.max_size = max_size
+        self.max_bytes = max_bytes
+        self.values: Dict[Hashable, Any] = {}
+        self.sizes: Dict[Hashable, int] = {}
+        self.bytes = 0
+        self.freq: Dict[Hashable, int] = {}
+        self.buckets: Dict[int, "OrderedDict[Hashable, None]"] = {}
+        self.min_freq = 0
+        self.evictions = 0
+
+    def __len__(self) -> int:
+        return len(self.values)
+
+    def __contains__(self, key: Hashable) -> bool:
+        return key in self.values
+
+    def __iter__(self) -> Iterator[Hashable]:
+        return iter(self.values)
+
+    def get(self, key: Hashable) -> Optional[Any]:
+        """Get and count an access"""
+        if key not in self.values:
+            return None
+        self._touch(key)
+        return self.values[key]
+
+    def score(self, count: int, size: int) -> int:
+        """Priority an entry with count accesses would get (size does not matter for LFU)"""
+        return count
+
+    def put(self, key: Hashable, value: Any, count: int = 1) -> None:
+        """Insert or update; new keys start at count accesses"""
+        size = entry_size(key, value)
+        if key in self.values:
+            self.bytes += size - self.sizes[key]
+            self.values[key] = value
+            self.sizes[key] = size
+            self._touch(key)
+        else:
+            if self.max_size <= 0:
+                return
+            while len(self.values) >= self.max_size:
+                self.evict()
+            self.values[key] = value
+            self.sizes[key] = size
+            self.bytes += size
+            self.freq[key] = count
+            self.buckets.setdefault(count, OrderedDict())[key] = None
+            if len(self.values) == 1 or count < self.min_freq:
+                self.min_freq = count
+        while self.max_bytes is not None and self.bytes > self.max_bytes and self.values:
+            self.evict()
+
+    def pop(self, key: Hashable) -> Optional[Any]:
+        """Remove a key without counting it as an eviction"""
+        if key not in self.values:
+            return None
+        self._unlink(key)
+        self.bytes -= self.sizes.pop(key)
+        return self.values.pop(key)
+
+    def peek_victim(self) -> Optional[Tuple[Hashable, int]]:
+        """(key, frequency) of the entry evict() would remove"""
+        if not self.values:
+            return None
+        self._fix_min()
+        key = next(iter(self.buckets[self.min_freq]))
+        return key, self.min_freq
+
+    def evict(self) -> Optional[Tuple[Hashable, Any]]:
+        """Remove the least frequently, then least recently, used entry"""
+        victim = self.peek_victim()
+        if victim is None:
+            return None
+        key = victim[0]
+        self.evictions += 1
+        return key, self.pop(key)
+
+    def frequency(self, key: Hashable) -> int:
+        """Access count of a resident key, 0 if absent"""
+        return self.freq.get(key, 0)
+
+    def _touch(self, key: Hashable) -> None:
+        count = self.freq[key]
+        bucket = self.buckets[count]
+        del bucket[key]
+        if not bucket:
+            del self.buckets[count]
+            if self.min_freq == count:
+                self.min_freq = count + 1
+        self.freq[key] = count + 1
+        self.buckets.setdefault(count + 1, OrderedDict())[key] = None
+
+    def _unlink(self, key: Hashable) -> None:
+        count = self.freq.pop(key)
+        bucket = self.buckets[count]
+        del bucket[key]
+        if not bucket:
+            del self.buckets[count]
+
+    def _fix_min(self) -> None:
+        """min_freq only ever lags behind the true minimum; walk it up to the next live bucket"""
+        for _ in range(64):
+            if self.min_freq in self.buckets:
+                return
+            self.min_freq += 1
+        self.min_freq = min(self.buckets)
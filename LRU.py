@@ -2,19 +2,36 @@
 
 from collections import OrderedDict
 
+from sizing import entry_size
+
 
 class LRUCache:
-    """Cache"""
+    """Cache bounded by entry count and, optionally, total bytes
+
+    on_evict(key, value) is called for every entry pushed out by capacity.
+    """
 
-    def __init__(self, max_size):
+    def __init__(self, max_size, max_bytes=None, max_object_size=None, on_evict=None):
         self.cache = OrderedDict()
+        self.sizes = {}
         self.max_size = max_size
+        self.max_bytes = max_bytes
+        self.max_object_size = max_object_size
+        self.current_bytes = 0
+        self.evictions = 0
+        self.on_evict = on_evict
 
     def add(self, key, value):
         """Add"""
+        size = entry_size(key, value)
         if key in self.cache:
             del self.cache[key]  # Refresh position in OrderedDict
+            self.current_bytes -= self.sizes.pop(key)
+        if self.max_object_size is not None and size > self.max_object_size:
+            return
         self.cache[key] = value
+        self.sizes[key] = size
+        self.current_bytes += size
         self.evict_if_needed()
 
     def get(self, key):
@@ -27,14 +44,39 @@ class LRUCache:
 
     def evict_if_needed(self):
         """Evict"""
-        while len(self.cache) > self.max_size:
-            self.cache.popitem(
+        while len(self.cache) > self.max_size or (
+                self.max_bytes is not None and self.current_bytes > self.max_bytes):
+            key, value = self.cache.popitem(
                 last=False
             )  # Remove the first item (least recently used)
+            self.current_bytes -= self.sizes.pop(key)
+            self.evictions += 1
+            if self.on_evict is not None:
+                self.on_evict(key, value)
+
+    def delete(self, key):
+        """Delete"""
+        if key in self.cache:
+            del self.cache[key]
+            self.current_bytes -= self.sizes.pop(key)
+
+    async def aget(self, key):
+        return self.get(key)
+
+    async def aput(self, key, value):
+        self.add(key, value)
+
+    async def adelete(self, key):
+        self.delete(key)
 
     def replace(self, url, value):
         """Replace"""
-        for key in self.cache:
-            if key == url:
-                self.cache[key] = value
+        if url in self.cache:
+            self.current_bytes += entry_size(url, value) - self.sizes[url]
+            self.sizes[url] = entry_size(url, value)
+            self.cache[url] = value
         self.evict_if_needed()
+
+    def stats(self):
+        """Size and eviction counters"""
+        return {"entries": len(self.cache), "bytes": self.current_bytes, "evictions": self.evictions}
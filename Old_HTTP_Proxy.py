@@ -8,10 +8,11 @@ import asyncio
 import logging
 import psutil
 import socket
-import ssl
 import os
 
 from LRU import LRUCache
+from blocklist import Blocklist
+from tls import TLSClient
 
 # Load configuration
 CONFIG = "app/Config.json"
@@ -25,13 +26,17 @@ with open(CONFIG, "r", encoding="UTF-8") as file:
     try:
         data = load(file)
         MAX_CACHE_SIZE = data["MAX_CACHE_SIZE"]
+        MAX_CACHE_BYTES = data.get("MAX_CACHE_BYTES")
+        MAX_OBJECT_SIZE = data.get("MAX_OBJECT_SIZE")
         CACHE_FILE = data["CACHE_FILE"]
         BLOCKED_SITES = data["BlockSites"]
         CUSTOMDOMAIN = data["CUSTOMDOMAIN"]
     except JSONDecodeError as e:
         raise e
 
-cache = LRUCache(MAX_CACHE_SIZE)
+cache = LRUCache(MAX_CACHE_SIZE, MAX_CACHE_BYTES, MAX_OBJECT_SIZE)
+blocklist = Blocklist(BLOCKED_SITES)
+tls_context = TLSClient().context(certifi.where())
 
 
 async def handle_client(reader: asyncio.StreamReader, writer: asyncio.StreamWriter):
@@ -91,12 +96,11 @@ async def handle_connect(
             port = domain["port"]
             break
 
-    for site in BLOCKED_SITES:
-        if site in host:
-            writer.write(b"HTTP/1.1 403 Forbidden\r\n\r\n")
-            await writer.drain()
-            writer.close()
-            return
+    if blocklist.blocked(host):
+        writer.write(b"HTTP/1.1 403 Forbidden\r\n\r\n")
+        await writer.drain()
+        writer.close()
+        return
     try:
         target_reader, target_writer = await asyncio.open_connection(host, port)
         writer.write(b"HTTP/1.1 200 Connection established\r\n\r\n")
@@ -143,12 +147,11 @@ async def handle_http(
             port = domain["port"]
             break
 
-    for site in BLOCKED_SITES:
-        if site in host:
-            writer.write(b"HTTP/1.1 403 Forbidden\r\n\r\n")
-            await writer.drain()
-            writer.close()
-            return
+    if blocklist.blocked(host):
+        writer.write(b"HTTP/1.1 403 Forbidden\r\n\r\n")
+        await writer.drain()
+        writer.close()
+        return
 
     try:
         # Check if URL is in cache
@@ -157,9 +160,7 @@ async def handle_http(
         if cached_data is not None:
             # Make a request to fetch the current data
             if parsed_url.scheme == "https":
-                context = ssl.create_default_context(ssl.Purpose.CLIENT_AUTH)
-                context.load_verify_locations(cafile=certifi.where())
-                conn = http.client.HTTPSConnection(host, port, context=context)
+                conn = http.client.HTTPSConnection(host, port, context=tls_context)
             else:
                 conn = http.client.HTTPConnection(host, port)
 
@@ -184,9 +185,7 @@ async def handle_http(
 
         # If not in cache, make HTTP request and cache the result
         if parsed_url.scheme == "https":
-            context = ssl.create_default_context(ssl.Purpose.CLIENT_AUTH)
-            context.load_verify_locations(cafile=certifi.where())
-            conn = http.client.HTTPSConnection(host, port, context=context)
+            conn = http.client.HTTPSConnection(host, port, context=tls_context)
         else:
             conn = http.client.HTTPConnection(host, port)
 
@@ -0,0 +1,169 @@
+"""Structured Access Log Written in Batches Off the Event Loop
+
+The proxy fills one AccessRecord per request (or CONNECT tunnel) and hands
+it to AccessLog.finish(), which only appends it to a bounded deque; a
+background thread formats queued records as JSON lines and writes them in
+batches. When the queue is full new records are dropped and counted, so a
+slow disk costs log lines, never request latency.
+
+Code deeper in the request path (cache, upstream) reports what it did with
+note(), which fills in the record of the request being served: each client
+connection is its own task, so the record travels in a context variable
+instead of through every call signature.
+"""
+
+from collections import deque
+from contextvars import ContextVar
+from threading import Event, Thread
+from typing import Deque, Dict, List, Optional
+import datetime
+import json
+import logging
+import os
+import random
+import sys
+import time
+
+
+class AccessRecord:
+    """Fixed fields of one request; None is written as null"""
+
+    __slots__ = ("start", "time", "client", "method", "target", "version", "status", "cache", "bytes",
+                 "duration", "upstream", "upstream_seconds")
+
+    def __init__(self, client: Optional[str], method: str, target: str, version: str) -> None:
+        self.start = time.perf_counter()
+        self.time = time.time()
+        self.client = client
+        self.method = method
+        self.target = target
+        self.version = version
+        self.status: Optional[int] = None
+        # HIT, STALE, REVALIDATED, COALESCED, MISS, BYPASS (not cacheable by method), BLOCKED,
+        # TUNNEL or INTERCEPTED (a CONNECT whose requests get records of their own)
+        self.cache: Optional[str] = None
+        self.bytes = 0
+        self.duration = 0.0
+        self.upstream: Optional[str] = None
+        # From asking for an upstream connection to the response head (connect included)
+        self.upstream_seconds: Optional[float] = None
+
+    def line(self) -> str:
+        return json.dumps({
+            "time": datetime.datetime.fromtimestamp(self.time, datetime.timezone.utc).isoformat(
+                timespec="milliseconds"),
+            "client": self.client, "method": self.method, "target": self.target, "version": self.version,
+            "status": self.status, "cache": self.cache, "bytes": self.bytes,
+            "duration_ms": round(self.duration * 1000, 3), "upstream": self.upstream,
+            "upstream_ms": None if self.upstream_seconds is None else round(self.upstream_seconds * 1000, 3),
+        }, separators=(",", ":")) + "\n"
+
+
+current: ContextVar[Optional[AccessRecord]] = ContextVar("access_record", default=None)
+
+
+def note(cache: Optional[str] = None, status: Optional[int] = None, sent: Optional[int] = None,
+         upstream: Optional[str] = None, upstream_seconds: Optional[float] = None) -> None:
+    """Fill in the record of the request being served, if it is being logged"""
+    record = current.get()
+    if record is None:
+        return
+    if cache is not None:
+        record.cache = cache
+    if status is not None:
+        record.status = status
+    if sent is not None:
+        record.bytes = sent
+    if upstream is not None:
+        record.upstream = upstream
+        record.upstream_seconds = upstream_seconds
+
+
+class AccessLog:
+    """One JSON line per request, appended to path ("-" for stdout) by a writer thread
+
+    sample_rate keeps that fraction of ordinary requests; failed ones
+    (no status, or 5xx) are always kept. At most max_queue records wait for
+    the writer, which wakes up every flush_interval seconds or once
+    batch_size records are waiting and writes each batch with one write()
+    to a file opened for appending, so worker processes can share it.
+    """
+
+    def __init__(self, path: str, sample_rate: float = 1.0, max_queue: int = 65536, batch_size: int = 1024,
+                 flush_interval: float = 0.5) -> None:
+        self.path = path
+        self.sample_rate = sample_rate
+        self.max_queue = max_queue
+        self.batch_size = batch_size
+        self.flush_interval = flush_interval
+        # deque appends and pops are atomic, so the event loop never takes a lock here
+        self.queue: Deque[AccessRecord] = deque()
+        self.wakeup = Event()
+        self.closed = Event()
+        self.counters = {"logged": 0, "dropped": 0, "sampled_out": 0, "batches": 0, "write_errors": 0}
+        self.fd = sys.stdout.fileno() if path == "-" else os.open(path, os.O_WRONLY | os.O_APPEND | os.O_CREAT,
+                                                                  0o644)
+        self.thread = Thread(target=self._run, name="access-log-writer", daemon=True)
+        self.thread.start()
+
+    def start(self, client: Optional[str], method: str, target: str, version: str) -> AccessRecord:
+        """Begin the record of a request and make it the one note() fills in"""
+        record = AccessRecord(client, method, target, version)
+        current.set(record)
+        return record
+
+    def finish(self, record: AccessRecord) -> None:
+        """Queue a finished record, unless it is sampled out or the queue is full"""
+        record.duration = time.perf_counter() - record.start
+        failed = record.status is None or record.status >= 500
+        if not failed and self.sample_rate < 1.0 and random.random() >= self.sample_rate:
+            self.counters["sampled_out"] += 1
+            return
+        if len(self.queue) >= self.max_queue:
+            self.counters["dropped"] += 1
+            return
+        self.queue.append(record)
+        if len(self.queue) >= self.batch_size and not self.wakeup.is_set():
+            self.wakeup.set()
+
+    def stats(self) -> Dict[str, int]:
+        """Write, drop and sampling counters"""
+        return dict(self.counters, queued=len(self.queue))
+
+    def close(self) -> None:
+        """Write everything queued and stop the writer thread"""
+        if self.closed.is_set():
+            return
+        self.closed.set()
+        self.wakeup.set()
+        self.thread.join()
+        if self.path != "-":
+            os.close(self.fd)
+
+    def _run(self) -> None:
+        """Writer thread: format and write queued records in batches"""
+        while True:
+            self.wakeup.wait(self.flush_interval)
+            self.wakeup.clear()
+            while self.queue:
+                self._write_batch()
+            if self.closed.is_set():
+                return
+
+    def _write_batch(self) -> None:
+        batch: List[str] = []
+        try:
+            while len(batch) < self.batch_size:
+                batch.append(self.queue.popleft().line())
+        except IndexError:
+            pass
+        data = "".join(batch).encode()
+        try:
+            while data:
+                data = data[os.write(self.fd, data):]
+        except OSError as e:
+            self.counters["write_errors"] += 1
+            logging.error(f"Dropped {len(batch)} access log records: {e}")
+            return
+        self.counters["logged"] += len(batch)
+        self.counters["batches"] += 1
@@ -0,0 +1 @@
+"""Benchmarks for the proxy (run from the repository root with python -m)"""
@@ -0,0 +1,81 @@
+"""Per-lookup cost of the blocklist matcher against the previous linear scan
+
+Rules are synthetic domains, with --substring-ratio of them loaded as
+substring rules (the old BlockedSites semantics) and the rest as domain
+rules, the shape of public blocklists. Hosts are a mix of blocked and
+allowed names. "compiled" bypasses the verdict cache, "cached" reuses a
+small set of hosts the way real traffic does, and "linear" is the previous
+any(site in host) loop, timed on fewer lookups at large sizes.
+
+    python -m benchmarks.bench_blocklist --sizes 10,10000,1000000
+"""
+
+import argparse
+import random
+import string
+import time
+
+from blocklist import Blocklist
+
+TLDS = ("com", "net", "org", "io", "co.uk", "de")
+
+
+def domain(rng: random.Random) -> str:
+    labels = ["".join(rng.choice(string.ascii_lowercase) for _ in range(rng.randint(4, 12)))
+              for _ in range(rng.randint(1, 2))]
+    return ".".join(labels + [rng.choice(TLDS)])
+
+
+def legacy_blocked(sites, host: str) -> bool:
+    """The previous __Should_Block"""
+    for site in sites:
+        if str(site).lower() in host.lower():
+            return True
+    return False
+
+
+def timed(check, hosts) -> float:
+    start = time.perf_counter()
+    for host in hosts:
+        check(host)
+    return (time.perf_counter() - start) / len(hosts) * 1e6
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--sizes", default="10,10000,1000000")
+    parser.add_argument("--substring-ratio", type=float, default=0.01)
+    parser.add_argument("--lookups", type=int, default=100000)
+    parser.add_argument("--legacy-budget", type=int, default=20000000,
+                        help="rule comparisons allowed for the linear scan per size")
+    args = parser.parse_args()
+    rng = random.Random(1)
+
+    for size in (int(s) for s in args.sizes.split(",")):
+        domains = [domain(rng) for _ in range(size)]
+        substrings = max(int(size * args.substring_ratio), 1)
+        rules = [d.split(".")[0] for d in domains[:substrings]] + ["||" + d for d in domains[substrings:]]
+        start = time.perf_counter()
+        blocklist = Blocklist(rules, cache_size=0)
+        build = time.perf_counter() - start
+        cached = Blocklist(rules)
+
+        hosts = []
+        for _ in range(args.lookups):
+            if rng.random() < 0.2:
+                hosts.append("www." + rng.choice(domains))
+            else:
+                hosts.append("cdn." + domain(rng))
+        hot = [rng.choice(hosts[:1000]) for _ in range(args.lookups)]
+        legacy_hosts = hosts[:max(min(args.legacy_budget // size, len(hosts)), 10)]
+        # Substring rules are what the old loop understood
+        legacy_rules = [rule.lstrip("|") for rule in rules]
+
+        print(f"rules={size:<8} build {build:6.2f}s  "
+              f"compiled {timed(blocklist.blocked, hosts):6.2f} us  "
+              f"cached {timed(cached.blocked, hot):6.2f} us  "
+              f"linear {timed(lambda host: legacy_blocked(legacy_rules, host), legacy_hosts):10.2f} us")
+
+
+if __name__ == "__main__":
+    main()
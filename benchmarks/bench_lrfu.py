@@ -0,0 +1,97 @@
+"""Micro-benchmark of HTTP_Proxy.LRFUCache put/get throughput
+
+Each run uses a cache holding N entries (half window, half LFU) and a key
+space of 2N, so most puts evict. The pre-O(1) implementation is included
+for comparison at the sizes where it finishes in reasonable time.
+
+    python -m benchmarks.bench_lrfu --sizes 10000,100000,1000000
+"""
+
+from collections import OrderedDict
+import argparse
+import random
+import time
+
+from HTTP_Proxy import LRFUCache
+
+
+class LegacyLRFUCache:
+    """The previous eviction logic (min() over every access count), without persistence"""
+
+    def __init__(self, lru_capacity, lfu_capacity) -> None:
+        self.lru_cache = OrderedDict()
+        self.lfu_cache = OrderedDict()
+        self.lru_capacity = lru_capacity
+        self.lfu_capacity = lfu_capacity
+        self.access_count = {}
+
+    def get(self, key):
+        if key in self.lru_cache:
+            self.lru_cache.move_to_end(key)
+            self.access_count[key] = self.access_count.get(key, 0) + 1
+            return self.lru_cache[key]
+        if key in self.lfu_cache:
+            self.access_count[key] += 1
+            return self.lfu_cache[key]
+        return None
+
+    def put(self, key, value):
+        if key in self.lru_cache or key in self.lfu_cache:
+            self.access_count[key] = self.access_count.get(key, 0) + 1
+        else:
+            self.access_count[key] = 1
+        if len(self.lru_cache) < self.lru_capacity:
+            self.lru_cache[key] = value
+        elif len(self.lfu_cache) < self.lfu_capacity:
+            self.lfu_cache[key] = value
+        else:
+            least_accessed = min(self.access_count, key=lambda k: self.access_count[k])
+            if least_accessed in self.lfu_cache:
+                del self.lfu_cache[least_accessed]
+            elif least_accessed in self.lru_cache:
+                del self.lru_cache[least_accessed]
+            del self.access_count[least_accessed]
+            self.lru_cache[key] = value
+
+
+def bench(cache, size: int, ops: int) -> tuple:
+    """Return (puts/s, gets/s)"""
+    rng = random.Random(42)
+    keys = [f"GET:http://example.com/{i}" for i in range(size * 2)]
+    for key in keys[:size]:
+        cache.put(key, b"v")
+    # Skewed access: a small hot set plus a long tail
+    workload = [keys[int(len(keys) * rng.random() ** 3)] for _ in range(ops)]
+
+    start = time.perf_counter()
+    for key in workload:
+        cache.put(key, b"v")
+    put_rate = ops / (time.perf_counter() - start)
+
+    start = time.perf_counter()
+    for key in workload:
+        cache.get(key)
+    get_rate = ops / (time.perf_counter() - start)
+    return put_rate, get_rate
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--sizes", default="10000,100000,1000000")
+    parser.add_argument("--ops", type=int, default=200000)
+    parser.add_argument("--legacy-max", type=int, default=10000,
+                        help="largest size to run the legacy implementation at")
+    args = parser.parse_args()
+
+    for size in (int(s) for s in args.sizes.split(",")):
+        implementations = [("LRFUCache", LRFUCache(size // 2, size - size // 2, None))]
+        if size <= args.legacy_max:
+            implementations.append(("legacy", LegacyLRFUCache(size // 2, size - size // 2)))
+        for name, cache in implementations:
+            ops = args.ops if name != "legacy" else min(args.ops, 5000)
+            put_rate, get_rate = bench(cache, size, ops)
+            print(f"{name:<10} N={size:<8} put {put_rate:>12,.0f}/s  get {get_rate:>12,.0f}/s")
+
+
+if __name__ == "__main__":
+    main()
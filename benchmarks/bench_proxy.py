@@ -0,0 +1,366 @@
+"""End-to-end load benchmark of proxy.Proxy and HTTP_Proxy.Proxy
+
+Each run starts the proxy under test in its own process, in a scratch
+directory with its own Config.json and cache files, with local origins in
+another process, and drives it from this process with benchmarks.loadgen.
+CPU time and RSS are those of the proxy process alone. Scenarios:
+
+  hit        GETs over --keys cacheable URLs, each fetched once beforehand
+  miss       GETs for unique uncacheable URLs, so every request goes upstream
+  connect    keep-alive GETs of --tunnel-size bodies through CONNECT tunnels
+  blocklist  the miss traffic with --blocklist-rules domain rules loaded
+             (HTTP_Proxy only: proxy.Proxy has no blocklist)
+
+HTTP_Proxy runs with the repository's Config.json, only with paths moved
+into the scratch directory and the metrics endpoint off (it would be one
+more listening port), so results reflect the shipped settings (e.g.
+hits beyond Max_Cache_Size entries come from the SQLite tier). Results are
+written to --output as JSON together with the commit they were measured on;
+--baseline takes an earlier results file and prints the change per run.
+
+--tree benchmarks the proxies of another checkout, e.g. an older commit in a
+git worktree. Both proxies are only started through their constructors and
+plain Start()/main() on a free port, which every version supports.
+
+    python -m benchmarks.bench_proxy --scenarios hit,miss --duration 10
+    python -m benchmarks.bench_proxy --mode open --rate 2000 --output after.json --baseline before.json
+    git worktree add /tmp/before HEAD~5
+    python -m benchmarks.bench_proxy --tree /tmp/before --output before.json
+"""
+
+import argparse
+import asyncio
+import datetime
+import json
+import multiprocessing
+import os
+import platform
+import random
+import shutil
+import signal
+import socket
+import string
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+from typing import Callable, Dict, List, Optional, Tuple
+
+import psutil
+
+from benchmarks.loadgen import Client, Recorder, closed_loop, open_loop, warm
+from benchmarks.origin import Origin
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+TARGETS = ("http_proxy", "proxy")
+SCENARIOS = ("hit", "miss", "connect", "blocklist")
+
+
+def run_origins(ports, size: int, tunnel_size: int) -> None:
+    """Origin process: cacheable, uncacheable and large-body origins"""
+
+    async def serve() -> None:
+        origins = [Origin(size, cache_control="max-age=3600"), Origin(size, cache_control="no-store"),
+                   Origin(tunnel_size, cache_control="no-store")]
+        for origin in origins:
+            await origin.start()
+        ports.put([origin.port for origin in origins])
+        await asyncio.Event().wait()
+
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+    asyncio.run(serve())
+
+
+def _enter(tree: str, directory: str) -> None:
+    """Import the proxy from tree, work in the scratch directory and log to a file there"""
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+    sys.path.insert(0, tree)
+    os.chdir(directory)
+    log = os.open("proxy.log", os.O_WRONLY | os.O_CREAT | os.O_APPEND, 0o644)
+    os.dup2(log, 1)
+    os.dup2(log, 2)
+
+
+def run_http_proxy(tree: str, directory: str, port: int) -> None:
+    _enter(tree, directory)
+    from HTTP_Proxy import Proxy
+    asyncio.run(Proxy(IP="127.0.0.1", PORT=port).Start())
+
+
+def run_proxy(tree: str, directory: str, port: int) -> None:
+    _enter(tree, directory)
+    from proxy import Proxy
+    asyncio.run(Proxy(host="127.0.0.1", port=port).main())
+
+
+def scratch(tree: str, target: str, blocklist_rules: int) -> str:
+    """A directory holding everything the proxy reads or writes"""
+    directory = tempfile.mkdtemp(prefix=f"bench-{target}-")
+    if target == "http_proxy":
+        shutil.copytree(os.path.join(tree, "site"), os.path.join(directory, "site"))
+        with open(os.path.join(tree, "Config.json"), encoding="utf-8") as file:
+            config = json.load(file)
+        if blocklist_rules:
+            rng = random.Random(1)
+            path = os.path.join(directory, "blocklist.txt")
+            with open(path, "w", encoding="utf-8") as file:
+                for _ in range(blocklist_rules):
+                    label = "".join(rng.choice(string.ascii_lowercase) for _ in range(rng.randint(5, 12)))
+                    file.write(f"{label}.{rng.choice(('com', 'net', 'org', 'io'))}\n")
+            config["Blocklist_Files"] = [path]
+        if "Metrics_Port" in config:
+            config["Metrics_Port"] = 0
+        with open(os.path.join(directory, "Config.json"), "w", encoding="utf-8") as file:
+            json.dump(config, file, indent=4)
+    return directory
+
+
+class ProxyProcess:
+    """The proxy under test, started in its own process and watched with psutil"""
+
+    def __init__(self, tree: str, target: str, directory: str) -> None:
+        self.target = target
+        self.directory = directory
+        # A port that was free a moment ago; the proxy binds it itself
+        with socket.socket(socket.AF_INET, socket.SOCK_STREAM) as sock:
+            sock.bind(("127.0.0.1", 0))
+            self.port = sock.getsockname()[1]
+        self.process = multiprocessing.get_context("fork").Process(
+            target=run_http_proxy if target == "http_proxy" else run_proxy, args=(tree, directory, self.port),
+            daemon=True)
+        start = time.perf_counter()
+        self.process.start()
+        self.psutil = psutil.Process(self.process.pid)
+        self.startup_seconds = self._wait_ready(start)
+        self.peak_rss = 0
+        self.sampling = False
+
+    def _listening_port(self) -> Optional[int]:
+        """The port asked for, or the one the proxy picked instead (older HTTP_Proxy moves off any
+        port but 8080 to the first free one from 19132)"""
+        connections = getattr(self.psutil, "net_connections", self.psutil.connections)(kind="tcp")
+        ports = [c.laddr.port for c in connections if c.status == psutil.CONN_LISTEN]
+        if self.port in ports:
+            return self.port
+        if len(ports) > 1:
+            raise RuntimeError(f"{self.target} listens on {ports}, not on port {self.port} as asked")
+        return ports[0] if ports else None
+
+    def _wait_ready(self, start: float, timeout: float = 60.0) -> float:
+        """Seconds until the proxy answers (HTTP_Proxy accepts early but builds its cache first)"""
+        while time.perf_counter() - start < timeout:
+            if not self.process.is_alive():
+                raise RuntimeError(f"{self.target} exited during startup; see {self.directory}/proxy.log")
+            port = self._listening_port()
+            if port is None:
+                time.sleep(0.02)
+                continue
+            self.port = port
+            try:
+                with socket.create_connection(("127.0.0.1", self.port), timeout=1.0) as probe:
+                    probe.sendall(b"OPTIONS http://127.0.0.1:9/ HTTP/1.1\r\nHost: x\r\nConnection: close\r\n\r\n")
+                    probe.recv(1)
+                return time.perf_counter() - start
+            except OSError:
+                time.sleep(0.02)
+        raise RuntimeError(f"{self.target} did not start within {timeout}s")
+
+    def cpu_seconds(self) -> float:
+        times = self.psutil.cpu_times()
+        return times.user + times.system
+
+    def start_sampling(self) -> None:
+        """Track RSS in a background thread while the load runs"""
+        self.sampling = True
+
+        def sample() -> None:
+            while self.sampling:
+                try:
+                    self.peak_rss = max(self.peak_rss, self.psutil.memory_info().rss)
+                except psutil.Error:
+                    return
+                time.sleep(0.05)
+
+        self.sampler = threading.Thread(target=sample, daemon=True)
+        self.sampler.start()
+
+    def stop_sampling(self) -> int:
+        """Peak RSS in bytes: the kernel's high-water mark where available, else the sampled maximum"""
+        self.sampling = False
+        self.sampler.join()
+        try:
+            with open(f"/proc/{self.process.pid}/status", encoding="ascii") as status:
+                for line in status:
+                    if line.startswith("VmHWM:"):
+                        return max(self.peak_rss, int(line.split()[1]) * 1024)
+        except OSError:
+            pass
+        return self.peak_rss
+
+    def stop(self) -> None:
+        if self.process.is_alive():
+            os.kill(self.process.pid, signal.SIGTERM)
+            self.process.join(10.0)
+        if self.process.is_alive():
+            self.process.kill()
+            self.process.join()
+
+
+def workload(scenario: str, port: int, origin_ports: List[int],
+             keys: int) -> Tuple[Callable[[], Client], Callable[[int], str], List[str]]:
+    """Client factory, request target and warm-up URLs for a scenario"""
+    hit_port, miss_port, tunnel_port = origin_ports
+    if scenario == "connect":
+        return (lambda: Client("127.0.0.1", port, tunnel=f"127.0.0.1:{tunnel_port}"),
+                lambda n: f"/tunnel/{n}", [])
+    if scenario == "hit":
+        urls = [f"http://127.0.0.1:{hit_port}/object/{key}" for key in range(keys)]
+        return lambda: Client("127.0.0.1", port), lambda n: urls[n % keys], urls
+    # miss and blocklist: unique URLs on the uncacheable origin
+    nonce = random.getrandbits(32)
+    return (lambda: Client("127.0.0.1", port),
+            lambda n: f"http://127.0.0.1:{miss_port}/miss/{nonce}/{n}", [])
+
+
+async def drive(args, scenario: str, port: int, origin_ports: List[int], proxy: ProxyProcess) -> Dict[str, object]:
+    new_client, target, urls = workload(scenario, port, origin_ports, args.keys)
+    if urls:
+        await warm(new_client, urls, args.concurrency)
+    # Let connection pools, DNS and the like settle before measuring
+    await closed_loop(new_client, target, min(args.concurrency, 8), args.warmup)
+    cpu = proxy.cpu_seconds()
+    proxy.start_sampling()
+    if args.mode == "open":
+        recorder: Recorder = await open_loop(new_client, target, args.rate, args.duration, args.concurrency)
+    else:
+        recorder = await closed_loop(new_client, target, args.concurrency, args.duration)
+    cpu = proxy.cpu_seconds() - cpu
+    peak_rss = proxy.stop_sampling()
+    summary = recorder.summary()
+    summary.update(
+        cpu_seconds=round(cpu, 3),
+        cpu_percent=round(cpu / recorder.elapsed * 100, 1) if recorder.elapsed else 0.0,
+        cpu_us_per_request=round(cpu / summary["requests"] * 1e6, 1) if summary["requests"] else 0.0,
+        peak_rss_mb=round(peak_rss / 1024 / 1024, 1),
+        startup_seconds=round(proxy.startup_seconds, 3),
+    )
+    return summary
+
+
+def run(args, target: str, scenario: str, origin_ports: List[int]) -> Optional[Dict[str, object]]:
+    if scenario == "blocklist" and target != "http_proxy":
+        return None
+    directory = scratch(args.tree, target, args.blocklist_rules if scenario == "blocklist" else 0)
+    proxy = ProxyProcess(args.tree, target, directory)
+    try:
+        result = asyncio.run(drive(args, scenario, proxy.port, origin_ports, proxy))
+    finally:
+        proxy.stop()
+        if not args.keep:
+            shutil.rmtree(directory, ignore_errors=True)
+    load = {"concurrency": args.concurrency} if args.mode == "closed" else {"rate": args.rate,
+                                                                            "max_connections": args.concurrency}
+    return dict(target=target, scenario=scenario, mode=args.mode, **load, **result)
+
+
+def git_state(tree: str) -> Dict[str, object]:
+    """Commit the results belong to, and whether the tree had local changes"""
+    try:
+        commit = subprocess.run(["git", "rev-parse", "HEAD"], cwd=tree, capture_output=True, text=True,
+                                check=True).stdout.strip()
+        dirty = bool(subprocess.run(["git", "status", "--porcelain", "--untracked-files=no"], cwd=tree,
+                                    capture_output=True, text=True, check=True).stdout.strip())
+    except (OSError, subprocess.CalledProcessError):
+        return {"commit": None, "dirty": None}
+    return {"commit": commit, "dirty": dirty}
+
+
+def report(result: Dict[str, object], baseline: Dict[Tuple[str, str, str], Dict[str, object]]) -> None:
+    latency = result["latency_ms"]
+    line = (f"{result['target']:<10} {result['scenario']:<9} {result['rps']:>9.1f} req/s  "
+            f"p50 {latency['p50']:7.2f}  p99 {latency['p99']:7.2f}  p999 {latency['p999']:7.2f} ms  "
+            f"cpu {result['cpu_percent']:5.1f}% ({result['cpu_us_per_request']:.0f} us/req)  "
+            f"rss {result['peak_rss_mb']:.0f} MB  errors {result['errors']}")
+    before = baseline.get((result["target"], result["scenario"], result["mode"]))
+    if before:
+        def change(now: float, then: float) -> str:
+            return f"{(now - then) / then * 100:+.1f}%" if then else "n/a"
+        line += (f"\n{'':<20} vs baseline: rps {change(result['rps'], before['rps'])}, "
+                 f"p99 {change(latency['p99'], before['latency_ms']['p99'])}, "
+                 f"cpu/req {change(result['cpu_us_per_request'], before['cpu_us_per_request'])}")
+    print(line, flush=True)
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--tree", default=ROOT, help="checkout whose proxies to benchmark")
+    parser.add_argument("--targets", default=",".join(TARGETS))
+    parser.add_argument("--scenarios", default=",".join(SCENARIOS))
+    parser.add_argument("--mode", choices=("closed", "open"), default="closed")
+    parser.add_argument("--concurrency", type=int, default=32,
+                        help="connections (closed loop) or connection cap (open loop)")
+    parser.add_argument("--rate", type=float, default=1000.0, help="requests per second (open loop)")
+    parser.add_argument("--duration", type=float, default=10.0)
+    parser.add_argument("--warmup", type=float, default=1.0)
+    parser.add_argument("--size", type=int, default=16384, help="body size for hit and miss")
+    parser.add_argument("--tunnel-size", type=int, default=1024 * 1024, help="body size through CONNECT")
+    parser.add_argument("--keys", type=int, default=20, help="distinct URLs in the hit scenario")
+    parser.add_argument("--blocklist-rules", type=int, default=1000000)
+    parser.add_argument("--output", default="bench_results.json")
+    parser.add_argument("--baseline", help="earlier --output file to compare against")
+    parser.add_argument("--keep", action="store_true", help="keep scratch directories (logs, cache files)")
+    args = parser.parse_args()
+    args.tree = os.path.abspath(args.tree)
+
+    baseline: Dict[Tuple[str, str, str], Dict[str, object]] = {}
+    if args.baseline:
+        with open(args.baseline, encoding="utf-8") as file:
+            for result in json.load(file)["runs"]:
+                baseline[(result["target"], result["scenario"], result["mode"])] = result
+
+    ports = multiprocessing.get_context("fork").Queue()
+    origins = multiprocessing.get_context("fork").Process(
+        target=run_origins, args=(ports, args.size, args.tunnel_size), daemon=True)
+    origins.start()
+    origin_ports = ports.get(timeout=30)
+
+    try:
+        import uvloop
+        asyncio.set_event_loop_policy(uvloop.EventLoopPolicy())
+        loop = "uvloop"
+    except ImportError:
+        loop = "asyncio"
+
+    runs = []
+    try:
+        for target in args.targets.split(","):
+            for scenario in args.scenarios.split(","):
+                if target not in TARGETS or scenario not in SCENARIOS:
+                    parser.error(f"unknown target or scenario: {target} {scenario}")
+                result = run(args, target, scenario, origin_ports)
+                if result is None:
+                    print(f"{target:<10} {scenario:<9} skipped (no blocklist in this proxy)", flush=True)
+                    continue
+                runs.append(result)
+                report(result, baseline)
+    finally:
+        origins.terminate()
+
+    results = {
+        **git_state(args.tree),
+        "timestamp": datetime.datetime.now(datetime.timezone.utc).isoformat(timespec="seconds"),
+        "python": platform.python_version(),
+        "platform": platform.platform(),
+        "cpus": os.cpu_count(),
+        "client_loop": loop,
+        "settings": vars(args),
+        "runs": runs,
+    }
+    with open(args.output, "w", encoding="utf-8") as file:
+        json.dump(results, file, indent=2)
+    print(f"Wrote {args.output}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,115 @@
+"""Throughput of the SQLite cache under concurrent readers on one event loop
+
+Each of --readers coroutines issues lookups (with --write-ratio of them
+being stores) against a pre-filled cache, the way concurrent proxy clients
+do. The previous implementation (a new connection, a lock and a commit per
+call, run directly on the loop) is included for comparison.
+
+    python -m benchmarks.bench_sqlite_cache --readers 1,16,64 --entries 5000
+"""
+
+import argparse
+import asyncio
+import os
+import random
+import sqlite3
+import tempfile
+import time
+from threading import Lock
+
+from cache import LRFUCache
+
+
+class LegacyCache:
+    """The previous backend: connect, lock and commit on every call"""
+
+    def __init__(self, db_path: str, max_entries: int) -> None:
+        self.db_path = db_path
+        self.max_entries = max_entries
+        self.lock = Lock()
+        with sqlite3.connect(db_path) as conn:
+            conn.execute("CREATE TABLE IF NOT EXISTS cache (id INTEGER PRIMARY KEY, key TEXT UNIQUE, "
+                         "response BLOB, hits INTEGER DEFAULT 1, last_access REAL)")
+
+    def get(self, key: str):
+        with self.lock, sqlite3.connect(self.db_path) as conn:
+            row = conn.execute("SELECT response, hits FROM cache WHERE key = ?", (key,)).fetchone()
+            if row:
+                conn.execute("UPDATE cache SET hits = ?, last_access = ? WHERE key = ?",
+                             (row[1] + 1, time.time(), key))
+                conn.commit()
+                return row[0]
+            return None
+
+    def set(self, key: str, response: bytes):
+        with self.lock, sqlite3.connect(self.db_path) as conn:
+            conn.execute("INSERT OR REPLACE INTO cache (key, response, hits, last_access) VALUES "
+                         "(?, ?, COALESCE((SELECT hits FROM cache WHERE key = ?), 0) + 1, ?)",
+                         (key, response, key, time.time()))
+            conn.commit()
+            count = conn.execute("SELECT COUNT(*) FROM cache").fetchone()[0]
+            if count > self.max_entries:
+                conn.execute("DELETE FROM cache WHERE id IN (SELECT id FROM cache ORDER BY "
+                             "(hits / (strftime('%s','now') - last_access + 1.0)) ASC LIMIT ?)",
+                             (count - self.max_entries,))
+                conn.commit()
+
+
+async def worker(name: str, cache, urls, ops: int, write_ratio: float, body: bytes, seed: int) -> None:
+    rng = random.Random(seed)
+    for _ in range(ops):
+        url = urls[int(len(urls) * rng.random() ** 2)]
+        write = rng.random() < write_ratio
+        if name == "legacy":
+            if write:
+                cache.set(url, body)
+            else:
+                cache.get(url)
+        elif write:
+            await cache.aput(url, body)
+        else:
+            await cache.aget(url)
+
+
+async def bench(name: str, cache, readers: int, ops: int, entries: int, write_ratio: float,
+                body: bytes) -> float:
+    urls = [f"http://example.com/{i}" for i in range(entries * 2)]
+    for url in urls[:entries]:
+        if name == "legacy":
+            cache.set(url, body)
+        else:
+            await cache.aput(url, body)
+    per_worker = max(ops // readers, 1)
+    start = time.perf_counter()
+    await asyncio.gather(*(worker(name, cache, urls, per_worker, write_ratio, body, seed)
+                           for seed in range(readers)))
+    return per_worker * readers / (time.perf_counter() - start)
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--readers", default="1,16,64")
+    parser.add_argument("--entries", type=int, default=5000)
+    parser.add_argument("--ops", type=int, default=20000)
+    parser.add_argument("--write-ratio", type=float, default=0.05)
+    parser.add_argument("--body-size", type=int, default=4096)
+    args = parser.parse_args()
+    body = os.urandom(args.body_size)
+
+    for readers in (int(r) for r in args.readers.split(",")):
+        for name in ("legacy", "LRFUCache"):
+            with tempfile.TemporaryDirectory() as directory:
+                path = os.path.join(directory, "cache.db")
+                if name == "legacy":
+                    cache = LegacyCache(path, args.entries)
+                else:
+                    cache = LRFUCache(path, args.entries)
+                rate = asyncio.run(bench(name, cache, readers, args.ops, args.entries,
+                                         args.write_ratio, body))
+                if name != "legacy":
+                    cache.close()
+            print(f"{name:<10} readers={readers:<4} {rate:>10,.0f} ops/s")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,109 @@
+"""Loopback benchmark for CONNECT tunnel relay engines
+
+A child process pushes --size MiB through a tunnel to a sink; this process only
+runs the relay, so its CPU time is the cost of the engine.
+
+    python -m benchmarks.bench_tunnel --size 1024
+"""
+
+import argparse
+import asyncio
+import multiprocessing
+import socket
+import threading
+import time
+
+import tunnel
+
+
+async def legacy_relay(reader: asyncio.StreamReader, writer: asyncio.StreamWriter) -> None:
+    """The relay the proxies used before: 4 KiB reads with a drain after each write"""
+    try:
+        while True:
+            data = await reader.read(4096)
+            if not data:
+                break
+            writer.write(data)
+            await writer.drain()
+    finally:
+        writer.close()
+
+
+def sink_and_source(sink: socket.socket, tunnel_port: int, size: int, result) -> None:
+    """Child process: accept on the sink, push size bytes through the tunnel"""
+    received = [0]
+
+    def drain() -> None:
+        conn, _ = sink.accept()
+        buffer = bytearray(1 << 20)
+        while True:
+            n = conn.recv_into(buffer)
+            if not n:
+                break
+            received[0] += n
+        conn.close()
+
+    thread = threading.Thread(target=drain)
+    thread.start()
+    client = socket.create_connection(("127.0.0.1", tunnel_port))
+    block = b"x" * (1 << 20)
+    sent = 0
+    while sent < size:
+        client.sendall(block)
+        sent += len(block)
+    client.shutdown(socket.SHUT_WR)
+    thread.join()
+    client.close()
+    result.put(received[0])
+
+
+async def run(engine: str, size: int) -> dict:
+    sink = socket.socket()
+    sink.bind(("127.0.0.1", 0))
+    sink.listen(1)
+    sink_port = sink.getsockname()[1]
+    done = asyncio.get_running_loop().create_future()
+
+    async def handle(reader: asyncio.StreamReader, writer: asyncio.StreamWriter) -> None:
+        target_reader, target_writer = await asyncio.open_connection("127.0.0.1", sink_port)
+        if engine == "legacy":
+            await asyncio.gather(legacy_relay(reader, target_writer), legacy_relay(target_reader, writer))
+        else:
+            await tunnel.relay(reader, writer, target_reader, target_writer, engine=engine)
+        done.set_result(None)
+
+    server = await asyncio.start_server(handle, "127.0.0.1", 0)
+    port = server.sockets[0].getsockname()[1]
+    result = multiprocessing.Queue()
+    child = multiprocessing.get_context("fork").Process(
+        target=sink_and_source, args=(sink, port, size, result))
+
+    cpu, wall = time.process_time(), time.perf_counter()
+    child.start()
+    await done
+    received = await asyncio.get_running_loop().run_in_executor(None, result.get)
+    cpu, wall = time.process_time() - cpu, time.perf_counter() - wall
+    child.join()
+    server.close()
+    sink.close()
+    gib = received / (1 << 30)
+    return {"engine": engine, "bytes": received, "MiB/s": received / (1 << 20) / wall,
+            "cpu_s_per_GiB": cpu / gib if gib else 0.0}
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--size", type=int, default=512, help="MiB to transfer")
+    parser.add_argument("--engines", default="legacy,buffered,splice")
+    args = parser.parse_args()
+    for engine in args.engines.split(","):
+        if engine == "splice" and not tunnel.SPLICE_AVAILABLE:
+            print("splice      unavailable on this platform")
+            continue
+        stats = asyncio.run(run(engine, args.size << 20))
+        print(f"{stats['engine']:<10} {stats['MiB/s']:>9.1f} MiB/s  "
+              f"{stats['cpu_s_per_GiB']:>6.2f} CPU s/GiB  ({stats['bytes']} bytes)")
+
+
+if __name__ == "__main__":
+    main()
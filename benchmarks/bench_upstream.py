@@ -0,0 +1,79 @@
+"""Concurrency benchmark: blocking http.client vs the asyncio upstream client
+
+Starts N slow local origins in a background thread and fetches from all of them
+concurrently from one event loop, the way the proxy handles N clients.
+
+    python -m benchmarks.bench_upstream --origins 20 --delay 0.2
+"""
+
+from http.client import HTTPConnection
+import argparse
+import asyncio
+import threading
+import time
+
+from benchmarks.origin import Origin
+from upstream import UpstreamClient
+
+
+def start_origins(count: int, delay: float, body_size: int):
+    """Run count origins on their own loop in a daemon thread"""
+    loop = asyncio.new_event_loop()
+    origins = [Origin(body_size=body_size, delay=delay) for _ in range(count)]
+    ready = threading.Event()
+
+    def run():
+        asyncio.set_event_loop(loop)
+        for origin in origins:
+            loop.run_until_complete(origin.start())
+        ready.set()
+        loop.run_forever()
+
+    threading.Thread(target=run, daemon=True).start()
+    ready.wait()
+    return [origin.port for origin in origins]
+
+
+async def fetch_blocking(port: int) -> int:
+    """What the proxy did before: a blocking fetch inside a coroutine"""
+    conn = HTTPConnection("127.0.0.1", port)
+    conn.request("GET", "/")
+    body = conn.getresponse().read()
+    conn.close()
+    return len(body)
+
+
+async def fetch_async(client: UpstreamClient, port: int) -> int:
+    """Fetch through the asyncio upstream client"""
+    response = await client.request("http", "127.0.0.1", port, "GET", "/", [])
+    return len(await response.read())
+
+
+async def run_round(ports, rounds: int, use_async: bool) -> float:
+    client = UpstreamClient()
+    start = time.perf_counter()
+    for _ in range(rounds):
+        if use_async:
+            await asyncio.gather(*(fetch_async(client, port) for port in ports))
+        else:
+            await asyncio.gather(*(fetch_blocking(port) for port in ports))
+    return time.perf_counter() - start
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--origins", type=int, default=20)
+    parser.add_argument("--delay", type=float, default=0.2)
+    parser.add_argument("--rounds", type=int, default=3)
+    parser.add_argument("--body-size", type=int, default=16384)
+    args = parser.parse_args()
+
+    ports = start_origins(args.origins, args.delay, args.body_size)
+    total = args.origins * args.rounds
+    for label, use_async in (("http.client (before)", False), ("UpstreamClient (after)", True)):
+        elapsed = asyncio.run(run_round(ports, args.rounds, use_async))
+        print(f"{label:<24} {total} requests in {elapsed:.2f}s -> {total / elapsed:.1f} req/s")
+
+
+if __name__ == "__main__":
+    main()
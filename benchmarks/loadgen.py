@@ -0,0 +1,221 @@
+"""Asyncio HTTP/1.1 Load Generator
+
+A keep-alive client that talks to a forward proxy (absolute-form requests,
+or origin-form ones inside a CONNECT tunnel) and two ways of driving it:
+
+- closed_loop: `concurrency` connections each send their next request as
+  soon as the previous response is in, so throughput is whatever the proxy
+  sustains at that concurrency.
+- open_loop: requests arrive at `rate` per second (Poisson) regardless of
+  how fast they complete, and latency counts from the scheduled arrival,
+  so a stalled proxy shows up as queueing delay instead of fewer samples.
+"""
+
+import asyncio
+import random
+import time
+from typing import Callable, Dict, List, Optional, Tuple
+
+
+class Client:
+    """One client connection to the proxy; reconnects when the proxy closes it"""
+
+    def __init__(self, host: str, port: int, tunnel: Optional[str] = None) -> None:
+        self.host = host
+        self.port = port
+        self.tunnel = tunnel
+        self.reader: Optional[asyncio.StreamReader] = None
+        self.writer: Optional[asyncio.StreamWriter] = None
+
+    async def connect(self) -> None:
+        self.reader, self.writer = await asyncio.open_connection(self.host, self.port)
+        if self.tunnel is not None:
+            self.writer.write(f"CONNECT {self.tunnel} HTTP/1.1\r\nHost: {self.tunnel}\r\n\r\n".encode())
+            head = await self.reader.readuntil(b"\r\n\r\n")
+            if not head.startswith(b"HTTP/1.1 200"):
+                status_line = head.split(b"\r\n")[0]
+                raise ConnectionError(f"CONNECT refused: {status_line!r}")
+
+    async def get(self, target: str) -> Tuple[int, int]:
+        """Send a GET for target (absolute URL, or path inside a tunnel); return (status, body bytes)"""
+        if self.writer is None or self.writer.is_closing():
+            await self.connect()
+        self.writer.write(f"GET {target} HTTP/1.1\r\nHost: {self.host}\r\n\r\n".encode())
+        head = await self.reader.readuntil(b"\r\n\r\n")
+        lines = head.decode("latin-1").split("\r\n")
+        status = int(lines[0].split(" ", 2)[1])
+        length: Optional[int] = None
+        chunked = close = False
+        for line in lines[1:]:
+            name, _, value = line.partition(":")
+            name = name.strip().lower()
+            if name == "content-length":
+                length = int(value)
+            elif name == "transfer-encoding" and "chunked" in value.lower():
+                chunked = True
+            elif name == "connection" and "close" in value.lower():
+                close = True
+        if chunked:
+            size = await self._read_chunked()
+        elif length is not None:
+            await self.reader.readexactly(length)
+            size = length
+        else:
+            size = len(await self.reader.read())
+            close = True
+        if close:
+            self.close()
+        return status, size
+
+    def close(self) -> None:
+        if self.writer is not None:
+            self.writer.close()
+        self.reader = self.writer = None
+
+    async def _read_chunked(self) -> int:
+        size = 0
+        while True:
+            chunk = int((await self.reader.readuntil(b"\r\n")).split(b";")[0], 16)
+            if not chunk:
+                while await self.reader.readuntil(b"\r\n") != b"\r\n":
+                    pass
+                return size
+            await self.reader.readexactly(chunk + 2)
+            size += chunk
+
+
+class Recorder:
+    """Latencies, errors and bytes of one measured run"""
+
+    def __init__(self) -> None:
+        self.latencies: List[float] = []
+        self.errors = 0
+        self.statuses: Dict[int, int] = {}
+        self.bytes = 0
+        self.started = time.perf_counter()
+        self.elapsed = 0.0
+
+    def record(self, latency: float, status: int, size: int) -> None:
+        self.latencies.append(latency)
+        self.statuses[status] = self.statuses.get(status, 0) + 1
+        self.bytes += size
+
+    def finish(self) -> None:
+        self.elapsed = time.perf_counter() - self.started
+
+    def summary(self) -> Dict[str, object]:
+        """Throughput and latency percentiles in milliseconds"""
+        latencies = sorted(self.latencies)
+        count = len(latencies)
+
+        def percentile(fraction: float) -> float:
+            return latencies[min(int(fraction * count), count - 1)] * 1000 if count else 0.0
+
+        return {
+            "requests": count,
+            "errors": self.errors,
+            "statuses": {str(status): n for status, n in sorted(self.statuses.items())},
+            "seconds": round(self.elapsed, 3),
+            "rps": round(count / self.elapsed, 1) if self.elapsed else 0.0,
+            "mb_per_second": round(self.bytes / self.elapsed / 1e6, 2) if self.elapsed else 0.0,
+            "latency_ms": {
+                "mean": round(sum(latencies) / count * 1000, 3) if count else 0.0,
+                "p50": round(percentile(0.50), 3),
+                "p99": round(percentile(0.99), 3),
+                "p999": round(percentile(0.999), 3),
+                "max": round(latencies[-1] * 1000, 3) if count else 0.0,
+            },
+        }
+
+
+Target = Callable[[int], str]  # request number -> URL (or path inside a tunnel)
+ClientFactory = Callable[[], Client]
+
+
+async def closed_loop(new_client: ClientFactory, target: Target, concurrency: int, duration: float) -> Recorder:
+    """concurrency connections, each issuing requests back to back for duration seconds"""
+    recorder = Recorder()
+    deadline = time.perf_counter() + duration
+    counter = iter(range(1 << 62))
+
+    async def worker() -> None:
+        client = new_client()
+        try:
+            while time.perf_counter() < deadline:
+                start = time.perf_counter()
+                try:
+                    status, size = await client.get(target(next(counter)))
+                except (OSError, asyncio.IncompleteReadError, ValueError, IndexError):
+                    recorder.errors += 1
+                    client.close()
+                    continue
+                recorder.record(time.perf_counter() - start, status, size)
+        finally:
+            client.close()
+
+    await asyncio.gather(*(worker() for _ in range(concurrency)))
+    recorder.finish()
+    return recorder
+
+
+async def open_loop(new_client: ClientFactory, target: Target, rate: float, duration: float,
+                    max_connections: int = 1024, seed: int = 1) -> Recorder:
+    """Poisson arrivals at rate per second for duration seconds over at most max_connections connections"""
+    recorder = Recorder()
+    rng = random.Random(seed)
+    idle: List[Client] = []
+    slots = asyncio.Semaphore(max_connections)
+    pending = set()
+
+    async def request(number: int, scheduled: float) -> None:
+        async with slots:
+            client = idle.pop() if idle else new_client()
+            try:
+                status, size = await client.get(target(number))
+            except (OSError, asyncio.IncompleteReadError, ValueError, IndexError):
+                recorder.errors += 1
+                client.close()
+                return
+            recorder.record(time.perf_counter() - scheduled, status, size)
+            idle.append(client)
+
+    start = time.perf_counter()
+    scheduled = start
+    number = 0
+    while scheduled - start < duration:
+        scheduled += rng.expovariate(rate)
+        delay = scheduled - time.perf_counter()
+        if delay > 0:
+            await asyncio.sleep(delay)
+        task = asyncio.create_task(request(number, scheduled))
+        pending.add(task)
+        task.add_done_callback(pending.discard)
+        number += 1
+    if pending:
+        await asyncio.wait(pending)
+    recorder.finish()
+    for client in idle:
+        client.close()
+    return recorder
+
+
+async def warm(new_client: ClientFactory, targets: List[str], concurrency: int) -> None:
+    """Fetch every target once, e.g. to fill the cache before a hit run
+
+    Failures are left for the measured run to count, so a proxy that drops
+    requests gets an error rate instead of aborting the benchmark.
+    """
+    queue = list(targets)
+
+    async def worker() -> None:
+        client = new_client()
+        try:
+            while queue:
+                try:
+                    await client.get(queue.pop())
+                except (OSError, asyncio.IncompleteReadError, ValueError, IndexError):
+                    client.close()
+        finally:
+            client.close()
+
+    await asyncio.gather(*(worker() for _ in range(min(concurrency, len(targets)) or 1)))
@@ -0,0 +1,71 @@
+"""Local Origin Server Stand-in"""
+
+import asyncio
+from typing import Optional, Tuple
+
+
+class Origin:
+    """Minimal HTTP/1.1 origin that answers every request with a fixed body
+
+    cache_control, when given, is sent as the Cache-Control header so a
+    proxy in front can be made to cache ("max-age=3600") or not ("no-store").
+    """
+
+    def __init__(self, body_size: int = 1024, delay: float = 0.0, host: str = "127.0.0.1",
+                 cache_control: Optional[str] = None) -> None:
+        self.body = b"x" * body_size
+        self.delay = delay
+        self.host = host
+        self.cache_control = (f"Cache-Control: {cache_control}\r\n".encode()
+                              if cache_control is not None else b"")
+        self.port = 0
+        self.requests = 0
+        self.server = None
+
+    async def __handle(self, reader: asyncio.StreamReader, writer: asyncio.StreamWriter) -> None:
+        try:
+            while True:
+                request_line = await reader.readline()
+                if not request_line:
+                    break
+                length = 0
+                close = False
+                while True:
+                    line = await reader.readline()
+                    if line in (b"\r\n", b"\n", b""):
+                        break
+                    key, _, value = line.decode("latin-1").partition(":")
+                    if key.strip().lower() == "content-length":
+                        length = int(value)
+                    elif key.strip().lower() == "connection" and "close" in value.lower():
+                        close = True
+                if length:
+                    await reader.readexactly(length)
+                self.requests += 1
+                if self.delay:
+                    await asyncio.sleep(self.delay)
+                writer.write(
+                    b"HTTP/1.1 200 OK\r\nContent-Type: application/octet-stream\r\n"
+                    + self.cache_control
+                    + f"Content-Length: {len(self.body)}\r\n".encode()
+                    + (b"Connection: close\r\n" if close else b"")
+                    + b"\r\n" + self.body)
+                await writer.drain()
+                if close:
+                    break
+        except (ConnectionError, asyncio.IncompleteReadError):
+            pass
+        finally:
+            writer.close()
+
+    async def start(self) -> Tuple[str, int]:
+        """Start listening on an ephemeral port"""
+        self.server = await asyncio.start_server(self.__handle, self.host, 0)
+        self.port = self.server.sockets[0].getsockname()[1]
+        return self.host, self.port
+
+    async def stop(self) -> None:
+        """Stop the server"""
+        if self.server is not None:
+            self.server.close()
+            await self.server.wait_closed()
@@ -0,0 +1,168 @@
+"""Compiled Host Blocklist"""
+
+from collections import deque
+from typing import Dict, Iterable, List
+import ipaddress
+
+from LRU import LRUCache
+
+# Rule prefixes; anything else is a substring rule, as BlockedSites always were
+DOMAIN_PREFIXES = ("||", "*.")
+EXACT_PREFIX = "="
+
+
+class AhoCorasick:
+    """Automaton answering "does the text contain any of these patterns" in one pass over the text"""
+
+    def __init__(self, patterns: Iterable[str]) -> None:
+        self.goto: List[Dict[str, int]] = [{}]
+        self.fail: List[int] = [0]
+        self.terminal: List[bool] = [False]
+        for pattern in patterns:
+            if pattern:
+                self._add(pattern)
+        self._link()
+
+    def __len__(self) -> int:
+        return len(self.goto)
+
+    def _add(self, pattern: str) -> None:
+        state = 0
+        for char in pattern:
+            following = self.goto[state].get(char)
+            if following is None:
+                following = len(self.goto)
+                self.goto[state][char] = following
+                self.goto.append({})
+                self.fail.append(0)
+                self.terminal.append(False)
+            state = following
+        self.terminal[state] = True
+
+    def _link(self) -> None:
+        """Breadth-first failure links; a state is terminal if any suffix of it is"""
+        queue = deque(self.goto[0].values())
+        while queue:
+            state = queue.popleft()
+            for char, following in self.goto[state].items():
+                queue.append(following)
+                fallback = self.fail[state]
+                while fallback and char not in self.goto[fallback]:
+                    fallback = self.fail[fallback]
+                self.fail[following] = self.goto[fallback].get(char, 0)
+                self.terminal[following] = self.terminal[following] or self.terminal[self.fail[following]]
+
+    def search(self, text: str) -> bool:
+        """Whether any pattern occurs in text"""
+        goto, fail, terminal = self.goto, self.fail, self.terminal
+        state = 0
+        for char in text:
+            while state and char not in goto[state]:
+                state = fail[state]
+            state = goto[state].get(char, 0)
+            if terminal[state]:
+                return True
+        return False
+
+
+class Blocklist:
+    """Host matcher compiled once from the configured rules
+
+    Rules are matched case-insensitively against the request host:
+
+        ||example.com or *.example.com  example.com and every subdomain
+        =example.com                    exactly example.com
+        anything else                   substring of the host (e.g. "porn")
+
+    Domain rules go into a hash set probed once per label suffix of the host,
+    substring rules into one Aho-Corasick automaton, so a lookup costs
+    O(len(host)) however many rules are loaded. Verdicts are memoised per
+    host in an LRU.
+    """
+
+    def __init__(self, rules: Iterable[str], cache_size: int = 65536) -> None:
+        self.domains = set()
+        self.exact = set()
+        substrings = set()
+        for rule in rules:
+            rule = str(rule).strip().lower().rstrip(".")
+            if rule.startswith(DOMAIN_PREFIXES):
+                self.domains.add(rule[2:].rstrip("^"))
+            elif rule.startswith(EXACT_PREFIX):
+                self.exact.add(rule[1:])
+            elif rule:
+                substrings.add(rule)
+        self.substrings = AhoCorasick(substrings)
+        self.rules = len(self.domains) + len(self.exact) + len(substrings)
+        self.verdicts = LRUCache(cache_size)
+        self.lookups = 0
+        self.cache_hits = 0
+
+    def __len__(self) -> int:
+        return self.rules
+
+    def blocked(self, host: str) -> bool:
+        """Whether requests to host should be refused"""
+        self.lookups += 1
+        verdict = self.verdicts.get(host)
+        if verdict is not None:
+            self.cache_hits += 1
+            return verdict
+        verdict = self._match(host.lower().rstrip("."))
+        self.verdicts.add(host, verdict)
+        return verdict
+
+    def _match(self, host: str) -> bool:
+        if host in self.exact:
+            return True
+        if self.domains:
+            suffix = host
+            while True:
+                if suffix in self.domains:
+                    return True
+                _, dot, suffix = suffix.partition(".")
+                if not dot:
+                    break
+        return self.substrings.search(host)
+
+    def stats(self) -> Dict[str, int]:
+        """Rule and verdict-cache counters"""
+        return {"rules": self.rules, "domains": len(self.domains), "exact": len(self.exact),
+                "automaton_states": len(self.substrings), "lookups": self.lookups,
+                "cache_hits": self.cache_hits}
+
+
+def load_rules(path: str) -> List[str]:
+    """Domain rules from a public blocklist file
+
+    Accepts hosts files ("0.0.0.0 example.com"), plain domain lists and
+    adblock-style "||example.com^" lines; comments and other adblock syntax
+    are skipped. Every listed domain also blocks its subdomains.
+    """
+    rules = []
+    with open(path, "r", encoding="utf-8", errors="ignore") as file:
+        for line in file:
+            line = line.split("#", 1)[0].strip()
+            if not line or line.startswith("!"):
+                continue
+            if line.startswith("||"):
+                domain = line[2:].split("^", 1)[0]
+                if "/" not in domain and "*" not in domain:
+                    rules.append("||" + domain)
+                continue
+            fields = line.split()
+            if len(fields) > 1 and _is_address(fields[0]):
+                fields = fields[1:]
+            elif len(fields) > 1:
+                continue
+            rules.extend("||" + domain for domain in fields
+                         if domain not in ("localhost", "localhost.localdomain", "broadcasthost", "0.0.0.0"))
+    return rules
+
+
+def _is_address(text: str) -> bool:
+    try:
+        ipaddress.ip_address(text)
+    except ValueError:
+        return False
+    return True
@@ -0,0 +1,223 @@
+"""File-Backed Store for Large Cached Bodies"""
+
+from asyncio import StreamWriter, get_running_loop
+from collections import OrderedDict
+from typing import BinaryIO, Dict, List, Optional, Tuple
+import logging
+import mmap
+import os
+import time
+import uuid
+
+BODY_SUFFIX = ".body"
+TEMP_SUFFIX = ".tmp"
+MMAP_CHUNK = 1024 * 1024
+STALE_TEMP = 3600
+
+BodyRef = Tuple[str, int]  # file name, length
+
+
+class SpillTee:
+    """Collects a streamed body in memory, moving it to a file once it passes the spill threshold
+
+    Drop-in for upstream.BodyTee: getvalue() returns the bytes of a small
+    body, while a spilled body is available as ref once finish() succeeds.
+    """
+
+    def __init__(self, store: "BodyStore") -> None:
+        self.store = store
+        self.chunks: List[bytes] = []
+        self.size = 0
+        self.overflow = False
+        self.file: Optional[BinaryIO] = None
+        self.name = ""
+        self.ref: Optional[BodyRef] = None
+
+    def feed(self, data: bytes) -> None:
+        """Add a chunk of body"""
+        if self.overflow:
+            return
+        self.size += len(data)
+        if self.size > self.store.max_body_size:
+            self.overflow = True
+            self.chunks.clear()
+            self.discard()
+            return
+        if self.file is None and self.size <= self.store.spill_threshold:
+            self.chunks.append(data)
+            return
+        try:
+            if self.file is None:
+                self.name = uuid.uuid4().hex
+                self.file = open(self.store.path(self.name) + TEMP_SUFFIX, "wb")
+                self.file.writelines(self.chunks)
+                self.chunks.clear()
+            self.file.write(data)
+        except OSError as e:
+            logging.error("Could not spill cached body to disk: %s", e)
+            self.overflow = True
+            self.discard()
+
+    def getvalue(self) -> Optional[bytes]:
+        """The collected body if it stayed in memory, else None"""
+        if self.overflow or self.name:
+            return None
+        return b"".join(self.chunks)
+
+    def finish(self) -> Optional[BodyRef]:
+        """Publish a spilled body under its final name"""
+        if self.overflow or self.file is None:
+            return None
+        try:
+            self.file.close()
+            self.ref = self.store.commit(self.name, self.size)
+            self.file = None
+        except OSError as e:
+            logging.error("Could not store cached body: %s", e)
+            self.discard()
+        return self.ref
+
+    def discard(self) -> None:
+        """Remove a partially written file"""
+        if self.file is not None:
+            self.file.close()
+            try:
+                os.remove(self.store.path(self.name) + TEMP_SUFFIX)
+            except FileNotFoundError:
+                pass
+            self.file = None
+
+
+class BodyStore:
+    """Directory of cached bodies, one file each, bounded in total bytes
+
+    Large bodies live in files and only their name and length go into the
+    cache index, so the cache backends (and their memory) hold metadata only
+    and hits are served from the page cache with sendfile. Files are evicted
+    least-recently-used when the directory grows past max_bytes; an index
+    entry whose file is gone simply becomes a miss. Files are never modified
+    in place, so a reader holding one open is unaffected by its eviction.
+    """
+
+    def __init__(self, directory: str, max_bytes: int = 4 * 1024 * 1024 * 1024,
+                 max_body_size: int = 1024 * 1024 * 1024, spill_threshold: int = 64 * 1024) -> None:
+        self.directory = directory
+        self.max_bytes = max_bytes
+        self.max_body_size = max_body_size
+        self.spill_threshold = spill_threshold
+        self.files: "OrderedDict[str, int]" = OrderedDict()
+        self.bytes = 0
+        self.evictions = 0
+        os.makedirs(directory, exist_ok=True)
+        self._load()
+
+    def tee(self) -> SpillTee:
+        """Collector for one response body"""
+        return SpillTee(self)
+
+    def path(self, name: str) -> str:
+        return os.path.join(self.directory, name + BODY_SUFFIX)
+
+    def commit(self, name: str, size: int) -> BodyRef:
+        """Move a finished temporary file into place and account for it"""
+        os.replace(self.path(name) + TEMP_SUFFIX, self.path(name))
+        self.add(name, size)
+        return name, size
+
+    def add(self, name: str, size: int) -> None:
+        """Account for a body file already in place, evicting the least recently used past max_bytes"""
+        self._forget(name)
+        self.files[name] = size
+        self.bytes += size
+        while self.bytes > self.max_bytes and len(self.files) > 1:
+            victim, _ = next(iter(self.files.items()))
+            self.delete(victim)
+            self.evictions += 1
+
+    def touch(self, name: str) -> None:
+        """Mark a body recently used"""
+        if name in self.files:
+            self.files.move_to_end(name)
+
+    def open(self, name: str) -> Optional[BinaryIO]:
+        """Open a body for reading and mark it recently used; None if it was evicted"""
+        if name not in self.files:
+            return None
+        try:
+            file = open(self.path(name), "rb")
+        except FileNotFoundError:
+            self._forget(name)
+            return None
+        self.files.move_to_end(name)
+        return file
+
+    def __contains__(self, name: str) -> bool:
+        return name in self.files
+
+    def delete(self, name: str) -> None:
+        """Remove a body file"""
+        self._forget(name)
+        try:
+            os.remove(self.path(name))
+        except FileNotFoundError:
+            pass
+
+    def stats(self) -> Dict[str, int]:
+        """Size counters"""
+        return {"files": len(self.files), "bytes": self.bytes, "evictions": self.evictions}
+
+    def _forget(self, name: str) -> None:
+        size = self.files.pop(name, None)
+        if size is not None:
+            self.bytes -= size
+
+    def _load(self) -> None:
+        """Index existing files, oldest access first, and drop leftovers from interrupted writes
+
+        Other worker processes may be writing into the same directory, so
+        only temporary files untouched for STALE_TEMP seconds are removed.
+        """
+        found = []
+        cutoff = time.time() - STALE_TEMP
+        for entry in os.scandir(self.directory):
+            try:
+                stat = entry.stat()
+                if entry.name.endswith(TEMP_SUFFIX) and stat.st_mtime < cutoff:
+                    os.remove(entry.path)
+            except FileNotFoundError:
+                continue  # Removed by another process meanwhile
+            if entry.name.endswith(BODY_SUFFIX):
+                found.append((stat.st_atime, entry.name[:-len(BODY_SUFFIX)], stat.st_size))
+        for _, name, size in sorted(found):
+            self.files[name] = size
+            self.bytes += size
+
+
+async def send_file(writer: StreamWriter, file: BinaryIO, offset: int, count: int) -> None:
+    """Send count bytes of file to the client without copying them through Python
+
+    Uses loop.sendfile (os.sendfile on plain sockets). Loops without it, such
+    as uvloop, get memory-mapped slices handed straight to the transport.
+    """
+    await writer.drain()
+    loop = get_running_loop()
+    try:
+        await loop.sendfile(writer.transport, file, offset, count)
+        return
+    except NotImplementedError:
+        pass
+    if not count:
+        return
+    mapped = mmap.mmap(file.fileno(), 0, access=mmap.ACCESS_READ)
+    view = memoryview(mapped)
+    try:
+        for start in range(offset, offset + count, MMAP_CHUNK):
+            writer.write(view[start:min(start + MMAP_CHUNK, offset + count)])
+            await writer.drain()
+    finally:
+        view.release()
+        try:
+            mapped.close()
+        except BufferError:
+            # The transport still holds a slice; the mapping goes away with it
+            pass
@@ -1,32 +1,111 @@
 """Implement LRFU Cache"""
 
-import sqlite3
+from concurrent.futures import ThreadPoolExecutor
+from threading import Lock, local
+from typing import Dict, List, Optional, Tuple
+import asyncio
 import hashlib
+import math
+import sqlite3
 import time
-from threading import Lock
-from typing import Optional
 
 
 class LRFUCache:
-    """LRFU Cache"""
-    def __init__(self, db_path: str = "proxy_cache.db", max_entries: int = 1000):
+    """LRFU Cache backed by SQLite in WAL mode
+
+    Reads run on a small pool of threads, each with its own long-lived
+    connection; all writes run on a single writer thread, so readers never
+    wait for a write to commit and the event loop never touches the database.
+    Hits are counted in memory and written back in batches.
+
+    Every row stores a combined recency/frequency value (CRF) that halves
+    every half_life seconds of disuse. Ranking rows by CRF(now) / size gives
+    the same order as ranking by
+
+        score = last_access / half_life + log2(crf) - log2(size)
+
+    which does not depend on the current time, so it is stored in an indexed
+    column and eviction walks the index instead of sorting the table.
+    Bounded by entry count and, optionally, by the summed size of stored
+    responses.
+    """
+
+    def __init__(self, db_path: str = "proxy_cache.db", max_entries: int = 1000,
+                 max_bytes: Optional[int] = None, max_object_size: Optional[int] = None,
+                 readers: int = 4, half_life: float = 300.0, hit_batch: int = 256,
+                 flush_interval: float = 1.0):
         self.db_path = db_path
         self.max_entries = max_entries
-        self.lock = Lock()
-        self._init_db()
+        self.max_bytes = max_bytes
+        self.max_object_size = max_object_size
+        self.half_life = half_life
+        self.hit_batch = hit_batch
+        self.flush_interval = flush_interval
+        self.evictions = 0
+        self.entries = 0
+        self.bytes = 0
+        # key -> (hits since last flush, time of the latest one)
+        self.pending_hits: Dict[str, Tuple[int, float]] = {}
+        self.hits_lock = Lock()
+        self.last_flush = time.monotonic()
+        self.flush_scheduled = False
+        self.local = local()
+        # Every thread's connection, so close() can close them once the threads are gone
+        self.connections: List[sqlite3.Connection] = []
+        self.readers = ThreadPoolExecutor(max_workers=readers, thread_name_prefix="cache-reader")
+        self.writer = ThreadPoolExecutor(max_workers=1, thread_name_prefix="cache-writer")
+        self.writer.submit(self._init_db).result()
+
+    def _connect(self) -> sqlite3.Connection:
+        """Connection owned by the calling thread"""
+        conn = getattr(self.local, "conn", None)
+        if conn is None:
+            # Only ever used by this thread; close() closes it from another after the pools shut down
+            conn = sqlite3.connect(self.db_path, timeout=30.0, check_same_thread=False)
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.execute("PRAGMA synchronous=NORMAL")
+            self.local.conn = conn
+            with self.hits_lock:
+                self.connections.append(conn)
+        return conn
 
     def _init_db(self):
-        with sqlite3.connect(self.db_path) as conn:
-            conn.execute('''
-                CREATE TABLE IF NOT EXISTS cache (
-                    id INTEGER PRIMARY KEY,
-                    key TEXT UNIQUE,
-                    response BLOB,
-                    hits INTEGER DEFAULT 1,
-                    last_access REAL
-                )
-            ''')
-            conn.commit()
+        conn = self._connect()
+        conn.execute('''
+            CREATE TABLE IF NOT EXISTS cache (
+                id INTEGER PRIMARY KEY,
+                key TEXT UNIQUE,
+                response BLOB,
+                hits INTEGER DEFAULT 1,
+                last_access REAL,
+                size INTEGER DEFAULT 0,
+                crf REAL DEFAULT 1.0,
+                score REAL DEFAULT 0.0
+            )
+        ''')
+        columns = {row[1] for row in conn.execute("PRAGMA table_info(cache)")}
+        if "size" not in columns:
+            # Databases created before size accounting
+            conn.execute("ALTER TABLE cache ADD COLUMN size INTEGER DEFAULT 0")
+            conn.execute("UPDATE cache SET size = length(key) + length(response)")
+        if "score" not in columns:
+            # Databases created before the indexed score; seed CRF from the hit count
+            conn.execute("ALTER TABLE cache ADD COLUMN crf REAL DEFAULT 1.0")
+            conn.execute("ALTER TABLE cache ADD COLUMN score REAL DEFAULT 0.0")
+            rows = conn.execute("SELECT id, hits, last_access, size FROM cache").fetchall()
+            conn.executemany("UPDATE cache SET crf = ?, score = ? WHERE id = ?",
+                             [(max(hits, 1), self._score(last_access or 0.0, max(hits, 1), size), row_id)
+                              for row_id, hits, last_access, size in rows])
+        conn.execute("CREATE INDEX IF NOT EXISTS cache_score ON cache (score)")
+        conn.commit()
+        self.entries, self.bytes = conn.execute(
+            "SELECT COUNT(*), COALESCE(SUM(size), 0) FROM cache").fetchone()
+
+    def _score(self, last_access: float, crf: float, size: int) -> float:
+        return last_access / self.half_life + math.log2(max(crf, 1e-300)) - math.log2(max(size, 1))
+
+    def _decay(self, crf: float, since: float, now: float) -> float:
+        return crf * 2.0 ** (-max(now - since, 0.0) / self.half_life)
 
     def _make_key(self, method: str, url: str, headers: dict, body: bytes) -> str:
         """Make key"""
@@ -34,43 +113,162 @@ class LRFUCache:
         raw = method.upper() + url + str(sorted(relevant_headers.items())) + body.decode("utf-8", errors="ignore")
         return hashlib.sha256(raw.encode("utf-8")).hexdigest()
 
+    async def aget(self, key: str) -> Optional[bytes]:
+        """Get data by key without blocking the event loop"""
+        loop = asyncio.get_running_loop()
+        response = await loop.run_in_executor(self.readers, self._lookup, key)
+        if response is not None:
+            self._record_hit(key)
+        return response
+
+    async def aput(self, key: str, response: bytes):
+        """Set data by key without blocking the event loop"""
+        loop = asyncio.get_running_loop()
+        await loop.run_in_executor(self.writer, self._store, key, response)
+
+    async def adelete(self, key: str):
+        """Remove a key without blocking the event loop"""
+        loop = asyncio.get_running_loop()
+        await loop.run_in_executor(self.writer, self._delete, key)
+
     def get(self, method: str, url: str, headers: dict, body: bytes) -> Optional[bytes]:
         """Get data"""
         key = self._make_key(method, url, headers, body)
-        with self.lock, sqlite3.connect(self.db_path) as conn:
-            cur = conn.execute("SELECT response, hits, last_access FROM cache WHERE key = ?", (key,))
-            row = cur.fetchone()
-            if row:
-                response, hits, _ = row
-                conn.execute("UPDATE cache SET hits = ?, last_access = ? WHERE key = ?",
-                             (hits + 1, time.time(), key))
-                conn.commit()
-                return response
-            return None
+        response = self.readers.submit(self._lookup, key).result()
+        if response is not None:
+            self._record_hit(key)
+        return response
 
     def set(self, method: str, url: str, headers: dict, body: bytes, response: bytes):
         """Set data"""
         key = self._make_key(method, url, headers, body)
+        self.writer.submit(self._store, key, response).result()
+
+    def resize(self, max_entries: int, max_bytes: Optional[int] = None, max_object_size: Optional[int] = None):
+        """Apply new limits, evicting on the writer thread whatever no longer fits"""
+        self.writer.submit(self._resize, max_entries, max_bytes, max_object_size)
+
+    def flush(self):
+        """Write pending hit counts"""
+        self.writer.submit(self._flush_hits).result()
+
+    def close(self):
+        """Flush hits and close every connection"""
+        self.flush()
+        self.readers.shutdown(wait=True)
+        self.writer.shutdown(wait=True)
+        with self.hits_lock:
+            connections, self.connections = self.connections, []
+        for conn in connections:
+            conn.close()
+
+    def stats(self) -> Dict[str, int]:
+        """Size and eviction counters"""
+        with self.hits_lock:
+            pending = len(self.pending_hits)
+        return {"entries": self.entries, "bytes": self.bytes, "evictions": self.evictions,
+                "pending_hits": pending}
+
+    def _lookup(self, key: str) -> Optional[bytes]:
+        row = self._connect().execute("SELECT response FROM cache WHERE key = ?", (key,)).fetchone()
+        return row[0] if row else None
+
+    def _record_hit(self, key: str):
+        """Count a hit in memory and schedule a write-back once enough have piled up"""
         now = time.time()
-        with self.lock, sqlite3.connect(self.db_path) as conn:
-            conn.execute("""
-                INSERT OR REPLACE INTO cache (key, response, hits, last_access)
-                VALUES (?, ?, COALESCE((SELECT hits FROM cache WHERE key = ?), 0) + 1, ?)
-            """, (key, response, key, now))
-            conn.commit()
-            self._evict_if_needed(conn)
+        with self.hits_lock:
+            count = self.pending_hits.get(key, (0, now))[0]
+            self.pending_hits[key] = (count + 1, now)
+            due = len(self.pending_hits) >= self.hit_batch or \
+                time.monotonic() - self.last_flush >= self.flush_interval
+            if not due or self.flush_scheduled:
+                return
+            self.flush_scheduled = True
+        self.writer.submit(self._flush_hits)
+
+    def _flush_hits(self):
+        """Apply batched hits in one transaction (writer thread)"""
+        with self.hits_lock:
+            pending, self.pending_hits = self.pending_hits, {}
+            self.flush_scheduled = False
+            self.last_flush = time.monotonic()
+        if not pending:
+            return
+        conn = self._connect()
+        updates = []
+        for key, (count, now) in pending.items():
+            row = conn.execute("SELECT id, crf, last_access, size FROM cache WHERE key = ?", (key,)).fetchone()
+            if row is None:
+                continue  # Evicted since the hit
+            row_id, crf, last_access, size = row
+            crf = count + self._decay(crf, last_access, now)
+            updates.append((count, now, crf, self._score(now, crf, size), row_id))
+        conn.executemany("UPDATE cache SET hits = hits + ?, last_access = ?, crf = ?, score = ? WHERE id = ?",
+                         updates)
+        conn.commit()
+
+    def _store(self, key: str, response: bytes):
+        """Insert or replace one entry and evict (writer thread)"""
+        self._flush_hits()
+        conn = self._connect()
+        size = len(key) + len(response)
+        now = time.time()
+        old = conn.execute("SELECT size, hits, crf, last_access FROM cache WHERE key = ?", (key,)).fetchone()
+        if old is not None:
+            self.entries -= 1
+            self.bytes -= old[0]
+        if self.max_object_size is not None and size > self.max_object_size:
+            if old is not None:
+                conn.execute("DELETE FROM cache WHERE key = ?", (key,))
+                conn.commit()
+            return
+        hits = old[1] + 1 if old is not None else 1
+        crf = 1.0 + (self._decay(old[2], old[3], now) if old is not None else 0.0)
+        conn.execute("""
+            INSERT OR REPLACE INTO cache (key, response, hits, last_access, size, crf, score)
+            VALUES (?, ?, ?, ?, ?, ?, ?)
+        """, (key, response, hits, now, size, crf, self._score(now, crf, size)))
+        self.entries += 1
+        self.bytes += size
+        self._evict_if_needed(conn)
+        conn.commit()
+
+    def _delete(self, key: str):
+        """Remove one entry (writer thread)"""
+        conn = self._connect()
+        row = conn.execute("SELECT size FROM cache WHERE key = ?", (key,)).fetchone()
+        if row is None:
+            return
+        conn.execute("DELETE FROM cache WHERE key = ?", (key,))
+        conn.commit()
+        self.entries -= 1
+        self.bytes -= row[0]
+
+    def _resize(self, max_entries: int, max_bytes: Optional[int], max_object_size: Optional[int]):
+        self.max_entries = max_entries
+        self.max_bytes = max_bytes
+        self.max_object_size = max_object_size
+        conn = self._connect()
+        self._evict_if_needed(conn)
+        conn.commit()
 
     def _evict_if_needed(self, conn: sqlite3.Connection):
-        """Remove if needed"""
-        cur = conn.execute("SELECT COUNT(*) FROM cache")
-        count = cur.fetchone()[0]
-        if count > self.max_entries:
-            conn.execute("""
-                DELETE FROM cache
-                WHERE id IN (
-                    SELECT id FROM cache
-                    ORDER BY (hits / (strftime('%s','now') - last_access + 1.0)) ASC
-                    LIMIT ?
-                )
-            """, (count - self.max_entries,))
-            conn.commit()
+        """Remove the lowest scores until both the count and byte limits hold"""
+        excess_entries = max(self.entries - self.max_entries, 0)
+        excess_bytes = max(self.bytes - self.max_bytes, 0) if self.max_bytes is not None else 0
+        if not excess_entries and not excess_bytes:
+            return
+        victims: List[Tuple[int]] = []
+        freed = 0
+        # Walks the score index in order and stops as soon as enough is freed
+        cur = conn.execute("SELECT id, size FROM cache ORDER BY score ASC")
+        for row_id, size in cur:
+            if len(victims) >= excess_entries and freed >= excess_bytes:
+                break
+            victims.append((row_id,))
+            freed += size
+        cur.close()
+        conn.executemany("DELETE FROM cache WHERE id = ?", victims)
+        self.entries -= len(victims)
+        self.bytes -= freed
+        self.evictions += len(victims)
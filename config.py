@@ -0,0 +1,150 @@
+"""Config.json Loading, Validation and Live Reload"""
+
+from asyncio import Event, Task, create_task, get_running_loop, wait_for
+from json import load
+from typing import Any, Awaitable, Callable, Dict, Optional, Tuple
+import logging
+import os
+import signal
+
+CONFIG_FILE = "Config.json"
+
+# Keys whose values must be positive integers when present
+POSITIVE_INTS = (
+    "Max_Cache_Size", "Max_Cache_Bytes", "Disk_Cache_Entries", "Disk_Cache_Bytes", "Body_Store_Bytes",
+    "Max_Body_Object_Size", "Max_Object_Size", "Max_Body_Size", "Max_Requests_Per_Connection",
+    "Tunnel_Buffer_Size", "Block_Verdict_Cache", "DNS_Cache_Size", "TLS_Session_Cache",
+    "MITM_Cert_Cache", "Access_Log_Queue",
+)
+NON_NEGATIVE_NUMBERS = ("Keep_Alive_Timeout", "Coalesce_Timeout", "Stale_While_Revalidate", "Stale_If_Error",
+                        "Config_Poll_Interval", "DNS_Max_TTL", "DNS_Negative_TTL", "Happy_Eyeballs_Delay",
+                        "Connect_Attempt_Timeout", "Connect_Timeout", "MITM_Bypass_TTL", "Access_Log_Sample")
+CHOICES = {
+    "Cache_Policy": ("lfu", "gdsf"),
+    "Cache_Backend": ("memory", "tiered"),
+    "Tunnel_Engine": ("auto", "splice", "buffered"),
+    "DNS_Prefer": ("ipv4", "ipv6", "ipv4_only", "ipv6_only"),
+}
+# Only read at startup; a reload that changes them takes effect after a restart
+RESTART_KEYS = ("Cache_Backend", "Cache_Policy", "Cache_Dir", "Cache_DB", "Body_Dir", "DNS_Servers", "DNS_Cache_Size",
+                "TLS_Session_Cache", "TLS_CA_File", "MITM_CA", "MITM_Cert_Dir", "MITM_Cert_Cache",
+                "Metrics_Host", "Metrics_Port", "Access_Log", "Access_Log_Queue")
+
+
+def validate_config(data: Any) -> Dict[str, Any]:
+    """Check a parsed config, raising ValueError describing the first problem"""
+    if not isinstance(data, dict):
+        raise ValueError("config must be a JSON object")
+    sites = data.get("BlockedSites")
+    if not isinstance(sites, list) or not all(isinstance(site, str) for site in sites):
+        raise ValueError("BlockedSites must be a list of strings")
+    files = data.get("Blocklist_Files", [])
+    if not isinstance(files, list) or not all(isinstance(path, str) for path in files):
+        raise ValueError("Blocklist_Files must be a list of paths")
+    servers = data.get("DNS_Servers", [])
+    if not isinstance(servers, list) or not all(isinstance(server, str) for server in servers):
+        raise ValueError("DNS_Servers must be a list of addresses")
+    if data.get("TLS_CA_File") is not None and not isinstance(data["TLS_CA_File"], str):
+        raise ValueError("TLS_CA_File must be a path")
+    port = data.get("Metrics_Port", 0)
+    if isinstance(port, bool) or not isinstance(port, int) or not 0 <= port <= 65535:
+        raise ValueError(f"Metrics_Port must be a port number, or 0 to disable metrics, got {port!r}")
+    if not isinstance(data.get("Metrics_Host", ""), str):
+        raise ValueError("Metrics_Host must be an address")
+    if not isinstance(data.get("Access_Log", ""), str):
+        raise ValueError('Access_Log must be a path, "-" for stdout or "" to disable it')
+    for key in ("MITM_Domains", "MITM_Prewarm"):
+        hosts = data.get(key, [])
+        if not isinstance(hosts, list) or not all(isinstance(host, str) for host in hosts):
+            raise ValueError(f"{key} must be a list of host names")
+    for key in POSITIVE_INTS:
+        value = data.get(key)
+        if value is not None and (isinstance(value, bool) or not isinstance(value, int) or value <= 0):
+            raise ValueError(f"{key} must be a positive integer, got {value!r}")
+    for key in NON_NEGATIVE_NUMBERS:
+        value = data.get(key)
+        if value is not None and (isinstance(value, bool) or not isinstance(value, (int, float)) or value < 0):
+            raise ValueError(f"{key} must be a non-negative number, got {value!r}")
+    sample = data.get("Access_Log_Sample", 1.0)
+    if isinstance(sample, (int, float)) and not isinstance(sample, bool) and sample > 1:
+        raise ValueError(f"Access_Log_Sample must be a fraction between 0 and 1, got {sample!r}")
+    for key, choices in CHOICES.items():
+        if key in data and data[key] not in choices:
+            raise ValueError(f"{key} must be one of {', '.join(choices)}, got {data[key]!r}")
+    if "Max_Cache_Size" not in data:
+        raise ValueError("Max_Cache_Size is required")
+    return data
+
+
+def load_config(path: str = CONFIG_FILE) -> Dict[str, Any]:
+    """Read and validate a config file (json.JSONDecodeError is a ValueError too)"""
+    with open(path, "r", encoding="utf-8") as file:
+        return validate_config(load(file))
+
+
+class ConfigWatcher:
+    """Calls reload() when the config file changes or the process gets SIGHUP
+
+    Changes are noticed by polling the file's mtime and size every interval
+    seconds, which works on every platform and filesystem; SIGHUP forces an
+    immediate reload. Reloads run one at a time in a background task, never
+    inside a request.
+    """
+
+    def __init__(self, path: str, reload: Callable[[], Awaitable[bool]], interval: float = 2.0) -> None:
+        self.path = path
+        self.reload = reload
+        self.interval = interval
+        self.signature = self._signature()
+        self.wakeup = Event()
+        self.task: Optional[Task] = None
+        self.reloads = 0
+
+    def start(self) -> None:
+        """Begin watching; must be called from the event loop"""
+        if hasattr(signal, "SIGHUP"):
+            try:
+                get_running_loop().add_signal_handler(signal.SIGHUP, self.trigger)
+            except (NotImplementedError, RuntimeError):
+                pass  # Not the main thread, or a loop without signal support
+        self.task = create_task(self._run())
+
+    def trigger(self) -> None:
+        """Reload as soon as possible"""
+        self.wakeup.set()
+
+    async def stop(self) -> None:
+        if hasattr(signal, "SIGHUP"):
+            try:
+                get_running_loop().remove_signal_handler(signal.SIGHUP)
+            except (NotImplementedError, RuntimeError):
+                pass
+        if self.task is not None:
+            self.task.cancel()
+            self.task = None
+
+    def _signature(self) -> Optional[Tuple[int, int]]:
+        try:
+            stat = os.stat(self.path)
+        except OSError:
+            return None
+        return stat.st_mtime_ns, stat.st_size
+
+    async def _run(self) -> None:
+        while True:
+            try:
+                await wait_for(self.wakeup.wait(), self.interval)
+            except TimeoutError:
+                pass
+            forced = self.wakeup.is_set()
+            self.wakeup.clear()
+            signature = self._signature()
+            if not forced and (signature is None or signature == self.signature):
+                continue
+            self.signature = signature
+            try:
+                if await self.reload():
+                    self.reloads += 1
+            except Exception as e:
+                # A broken reload must not take the watcher (or the proxy) down
+                logging.error("Config reload failed: %s", e)
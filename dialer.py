@@ -0,0 +1,160 @@
+"""Upstream Dialer: Happy Eyeballs Connects with Timeouts"""
+
+from asyncio import (
+    FIRST_COMPLETED, StreamReader, StreamWriter, Task, create_task, get_running_loop, open_connection, wait,
+    wait_for,
+)
+from itertools import chain, zip_longest
+from typing import Dict, List, Optional, Set, Tuple
+import socket
+import ssl
+import time
+
+from metrics import Histogram
+from resolver import Address, Resolver
+
+
+class Dialer:
+    """Opens upstream connections by racing every address of a host (RFC 8305)
+
+    Addresses come from the resolver in preference order and are
+    interleaved by family. The first attempt starts at once and each further
+    one attempt_delay later, or as soon as the previous attempt fails; the
+    first TCP connection to complete wins and the rest are cancelled. TLS is
+    only negotiated on the winner. Every attempt gets attempt_timeout and the
+    whole connect (DNS included) total_timeout. Addresses that failed within
+    the last failure_ttl seconds are tried after all the others, so later
+    connects to a partly broken multi-homed origin go straight to an address
+    that works.
+    """
+
+    def __init__(self, resolver: Optional[Resolver] = None, attempt_delay: float = 0.25,
+                 attempt_timeout: float = 5.0, total_timeout: float = 10.0, failure_ttl: float = 30.0) -> None:
+        self.resolver = resolver if resolver is not None else Resolver()
+        self.attempt_delay = attempt_delay
+        self.attempt_timeout = attempt_timeout
+        self.total_timeout = total_timeout
+        self.failure_ttl = failure_ttl
+        # address -> monotonic time until which it counts as failing
+        self.failures: Dict[str, float] = {}
+        self.counters = {"connects": 0, "attempts": 0, "failed_attempts": 0, "timeouts": 0,
+                         "fallbacks": 0, "avoided": 0}
+        # Where a slow connect spends its time
+        self.dns_seconds = Histogram()
+        self.tcp_seconds = Histogram()
+        self.tls_seconds = Histogram()
+
+    async def connect(self, host: str, port: int,
+                      ssl_context: Optional[ssl.SSLContext] = None) -> Tuple[StreamReader, StreamWriter]:
+        """Connected streams to host:port, over TLS when ssl_context is given"""
+        self.counters["connects"] += 1
+        try:
+            return await wait_for(self._connect(host, port, ssl_context), self.total_timeout)
+        except TimeoutError:
+            self.counters["timeouts"] += 1
+            raise TimeoutError(f"Connecting to {host}:{port} took longer than {self.total_timeout}s") from None
+
+    def stats(self) -> Dict[str, int]:
+        """Attempt and failure counters"""
+        return dict(self.counters, failing_addresses=len(self.failures))
+
+    def histograms(self) -> Dict[str, Histogram]:
+        """Time to resolve, to win the TCP race and to complete the TLS handshake of successful connects"""
+        return {"dns_seconds": self.dns_seconds, "tcp_seconds": self.tcp_seconds, "tls_seconds": self.tls_seconds}
+
+    async def _connect(self, host: str, port: int,
+                       ssl_context: Optional[ssl.SSLContext]) -> Tuple[StreamReader, StreamWriter]:
+        start = time.perf_counter()
+        addresses = self._order(await self.resolver.resolve(host))
+        if not addresses:
+            raise socket.gaierror(socket.EAI_NONAME, f"{host} has no usable addresses")
+        resolved = time.perf_counter()
+        self.dns_seconds.observe(resolved - start)
+        sock = await self._race(addresses, port)
+        connected = time.perf_counter()
+        self.tcp_seconds.observe(connected - resolved)
+        try:
+            if ssl_context is not None:
+                streams = await open_connection(sock=sock, ssl=ssl_context, server_hostname=host)
+                self.tls_seconds.observe(time.perf_counter() - connected)
+                return streams
+            return await open_connection(sock=sock)
+        except BaseException:
+            sock.close()
+            raise
+
+    def _order(self, addresses: List[Address]) -> List[Address]:
+        """Alternate families, preferred first, and move recently failed addresses to the end"""
+        if not addresses:
+            return addresses
+        first = addresses[0][0]
+        preferred = [address for address in addresses if address[0] == first]
+        other = [address for address in addresses if address[0] != first]
+        ordered = [address for address in chain.from_iterable(zip_longest(preferred, other)) if address]
+        now = time.monotonic()
+        for address, until in list(self.failures.items()):
+            if until <= now:
+                del self.failures[address]
+        failing = [address for address in ordered if address[1] in self.failures]
+        if failing:
+            self.counters["avoided"] += len(failing)
+            ordered = [address for address in ordered if address[1] not in self.failures] + failing
+        return ordered
+
+    async def _race(self, addresses: List[Address], port: int) -> socket.socket:
+        """Staggered TCP connects; the first to complete wins"""
+        pending: Set[Task] = set()
+        errors: List[BaseException] = []
+        remaining = iter(enumerate(addresses))
+        try:
+            while True:
+                index, address = next(remaining, (None, None))
+                if address is not None:
+                    pending.add(create_task(self._attempt(address, port, index)))
+                elif not pending:
+                    break
+                done, pending = await wait(pending, timeout=self.attempt_delay if address is not None else None,
+                                           return_when=FIRST_COMPLETED)
+                winner: Optional[Tuple[socket.socket, int]] = None
+                for task in done:
+                    if task.exception() is not None:
+                        errors.append(task.exception())
+                    elif winner is None:
+                        winner = task.result()
+                    else:
+                        task.result()[0].close()
+                if winner is not None:
+                    if winner[1]:
+                        self.counters["fallbacks"] += 1
+                    return winner[0]
+        finally:
+            for task in pending:
+                task.cancel()
+                task.add_done_callback(_close_socket)
+        if len(errors) == 1:
+            raise errors[0]
+        raise OSError(f"All {len(addresses)} addresses failed: " + "; ".join(str(e) for e in errors))
+
+    async def _attempt(self, address: Address, port: int, index: int) -> Tuple[socket.socket, int]:
+        family, host = address
+        self.counters["attempts"] += 1
+        sock = socket.socket(family, socket.SOCK_STREAM)
+        sock.setblocking(False)
+        try:
+            await wait_for(get_running_loop().sock_connect(sock, (host, port)), self.attempt_timeout)
+        except BaseException as e:
+            sock.close()
+            if isinstance(e, Exception):
+                self.counters["failed_attempts"] += 1
+                self.failures[host] = time.monotonic() + self.failure_ttl
+                if isinstance(e, TimeoutError):
+                    raise TimeoutError(f"Connecting to {host}:{port} timed out") from None
+            raise
+        self.failures.pop(host, None)
+        return sock, index
+
+
+def _close_socket(task: Task) -> None:
+    """Close the socket of an attempt that finished after the race was decided"""
+    if not task.cancelled() and task.exception() is None:
+        task.result()[0].close()
@@ -0,0 +1,251 @@
+"""HTTP/1.1 Message Helpers"""
+
+from asyncio import IncompleteReadError, StreamReader, StreamWriter
+from typing import AsyncIterator, List, Optional, Tuple
+
+Headers = List[Tuple[str, str]]
+
+# Headers that only describe a single hop and must not be forwarded
+HOP_BY_HOP = frozenset((
+    "connection",
+    "keep-alive",
+    "proxy-authenticate",
+    "proxy-authorization",
+    "proxy-connection",
+    "te",
+    "trailer",
+    "transfer-encoding",
+    "upgrade",
+))
+
+MAX_LINE = 65536
+MAX_HEADERS = 100
+
+
+class ProtocolError(ValueError):
+    """Malformed HTTP/1.1 message"""
+
+
+class BodyTooLarge(ProtocolError):
+    """Request body exceeds the configured limit"""
+
+
+def get_header(headers: Headers, name: str, default: Optional[str] = None) -> Optional[str]:
+    """Return the first header value matching name (case-insensitive)"""
+    name = name.lower()
+    for key, value in headers:
+        if key.lower() == name:
+            return value
+    return default
+
+
+def get_list(headers: Headers, name: str) -> List[str]:
+    """Members of every comma-separated header field named name, in order"""
+    name = name.lower()
+    return [member.strip() for key, value in headers if key.lower() == name
+            for member in value.split(",") if member.strip()]
+
+
+def strip_hop_by_hop(headers: Headers) -> Headers:
+    """Drop hop-by-hop headers, including any listed in Connection"""
+    extra = set()
+    for key, value in headers:
+        if key.lower() == "connection":
+            extra.update(token.strip().lower() for token in value.split(","))
+    return [(key, value) for key, value in headers
+            if key.lower() not in HOP_BY_HOP and key.lower() not in extra]
+
+
+async def read_line(reader: StreamReader) -> bytes:
+    """Read a CRLF terminated line"""
+    line = await reader.readuntil(b"\n")
+    if len(line) > MAX_LINE:
+        raise ProtocolError("Line too long")
+    return line
+
+
+async def read_headers(reader: StreamReader) -> Headers:
+    """Read header lines up to the blank line"""
+    headers: Headers = []
+    while True:
+        line = await read_line(reader)
+        if line in (b"\r\n", b"\n"):
+            return headers
+        if len(headers) >= MAX_HEADERS:
+            raise ProtocolError("Too many headers")
+        header = line.decode("latin-1").strip()
+        if ":" not in header:
+            continue
+        key, value = header.split(":", 1)
+        headers.append((key.strip(), value.strip()))
+
+
+async def read_response_head(reader: StreamReader) -> Tuple[str, int, str, Headers]:
+    """Read a status line and headers"""
+    line = (await read_line(reader)).decode("latin-1").strip()
+    parts = line.split(" ", 2)
+    if len(parts) < 2 or not parts[0].startswith("HTTP/"):
+        raise ProtocolError(f"Bad status line: {line!r}")
+    version, status = parts[0], parts[1]
+    reason = parts[2] if len(parts) > 2 else ""
+    try:
+        code = int(status)
+    except ValueError as e:
+        raise ProtocolError(f"Bad status code: {status!r}") from e
+    return version, code, reason, await read_headers(reader)
+
+
+def has_body(method: str, status: int) -> bool:
+    """Whether a response to method with status carries a body"""
+    return not (method.upper() == "HEAD" or 100 <= status < 200 or status in (204, 304))
+
+
+def is_chunked(headers: Headers) -> bool:
+    """Whether the last transfer coding is chunked"""
+    value = get_header(headers, "Transfer-Encoding")
+    return bool(value) and value.split(",")[-1].strip().lower() == "chunked"
+
+
+def content_length(headers: Headers) -> Optional[int]:
+    """Parsed Content-Length, or None if absent"""
+    value = get_header(headers, "Content-Length")
+    if value is None:
+        return None
+    try:
+        length = int(value)
+    except ValueError as e:
+        raise ProtocolError(f"Bad Content-Length: {value!r}") from e
+    if length < 0:
+        raise ProtocolError(f"Bad Content-Length: {value!r}")
+    return length
+
+
+async def read_chunk_size(reader: StreamReader) -> int:
+    """Read a chunk-size line, ignoring chunk extensions"""
+    size_line = (await read_line(reader)).split(b";", 1)[0].strip()
+    try:
+        return int(size_line, 16)
+    except ValueError as e:
+        raise ProtocolError(f"Bad chunk size: {size_line!r}") from e
+
+
+async def read_chunked(reader: StreamReader) -> bytes:
+    """Read and decode a chunked body, discarding trailers"""
+    parts = []
+    while True:
+        size = await read_chunk_size(reader)
+        if size == 0:
+            await read_headers(reader)
+            return b"".join(parts)
+        parts.append(await reader.readexactly(size))
+        await reader.readexactly(2)
+
+
+def serialize_head(start_line: str, headers: Headers) -> bytes:
+    """Build a message head from a start line and headers"""
+    lines = [start_line]
+    for key, value in headers:
+        clean_value = value.replace("\r", "").replace("\n", "")
+        lines.append(f"{key}: {clean_value}")
+    return ("\r\n".join(lines) + "\r\n\r\n").encode("latin-1")
+
+
+def framed_headers(headers: Headers, length: int) -> Headers:
+    """End-to-end headers for a body re-framed with a Content-Length"""
+    headers = [(key, value) for key, value in strip_hop_by_hop(headers)
+               if key.lower() != "content-length"]
+    headers.append(("Content-Length", str(length)))
+    return headers
+
+
+def keep_alive(version: str, headers: Headers) -> bool:
+    """Whether the client asked for a persistent connection"""
+    connection = (get_header(headers, "Connection") or get_header(headers, "Proxy-Connection") or "").lower()
+    if "close" in connection:
+        return False
+    if version.upper() == "HTTP/1.0":
+        return "keep-alive" in connection
+    return True
+
+
+def with_connection(response: bytes, persistent: bool) -> List[memoryview]:
+    """Split a serialized response to insert a Connection header after the status line"""
+    view = memoryview(response)
+    end = response.find(b"\r\n") + 2
+    header = b"Connection: keep-alive\r\n" if persistent else b"Connection: close\r\n"
+    return [view[:end], memoryview(header), view[end:]]
+
+
+class RequestBody:
+    """Request body streamed from the client as the upstream consumes it
+
+    Handles Content-Length and chunked framing, answers Expect: 100-continue
+    when the first chunk is requested and enforces max_size.
+    """
+
+    def __init__(self, reader: StreamReader, headers: Headers, max_size: Optional[int] = None,
+                 writer: Optional[StreamWriter] = None, version: str = "HTTP/1.1",
+                 chunk_size: int = 65536) -> None:
+        self.reader = reader
+        self.writer = writer
+        self.version = version
+        self.max_size = max_size
+        self.chunk_size = chunk_size
+        self.chunked = is_chunked(headers)
+        self.length = None if self.chunked else (content_length(headers) or 0)
+        self.expect_continue = (get_header(headers, "Expect") or "").lower() == "100-continue"
+        self.received = 0
+        self.started = False
+        self.consumed = not self.chunked and not self.length
+
+    def __bool__(self) -> bool:
+        return self.chunked or bool(self.length)
+
+    @property
+    def too_large(self) -> bool:
+        """Whether the declared length is already over the limit"""
+        return self.max_size is not None and self.length is not None and self.length > self.max_size
+
+    def _count(self, size: int) -> None:
+        self.received += size
+        if self.max_size is not None and self.received > self.max_size:
+            raise BodyTooLarge(f"Request body over {self.max_size} bytes")
+
+    async def __aiter__(self) -> AsyncIterator[bytes]:
+        if self.started:
+            raise RuntimeError("Request body already consumed")
+        self.started = True
+        if self.too_large:
+            raise BodyTooLarge(f"Request body over {self.max_size} bytes")
+        if self.expect_continue and self.writer is not None and self.version.upper() == "HTTP/1.1":
+            self.writer.write(b"HTTP/1.1 100 Continue\r\n\r\n")
+            await self.writer.drain()
+
+        if self.chunked:
+            while True:
+                size = await read_chunk_size(self.reader)
+                if size == 0:
+                    await read_headers(self.reader)
+                    break
+                self._count(size)
+                while size:
+                    data = await self.reader.read(min(size, self.chunk_size))
+                    if not data:
+                        raise IncompleteReadError(b"", size)
+                    size -= len(data)
+                    yield data
+                await self.reader.readexactly(2)
+        else:
+            remaining = self.length
+            while remaining:
+                data = await self.reader.read(min(remaining, self.chunk_size))
+                if not data:
+                    raise IncompleteReadError(b"", remaining)
+                remaining -= len(data)
+                self._count(len(data))
+                yield data
+        self.consumed = True
+
+    async def read(self) -> bytes:
+        """Read the whole body"""
+        return b"".join([data async for data in self])
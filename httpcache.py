@@ -0,0 +1,709 @@
+"""RFC 9111 Caching Policy in Front of a Cache Backend"""
+
+from asyncio import (
+    Future, IncompleteReadError, Queue, StreamWriter, Task, create_task, get_running_loop, shield, wait_for,
+)
+from email.utils import formatdate, parsedate_to_datetime
+from typing import Awaitable, Callable, Dict, List, Optional, Set, Tuple, Union
+import json
+import logging
+import struct
+import time
+
+from http1 import (
+    Headers, ProtocolError, RequestBody, content_length, framed_headers, get_header, get_list, has_body,
+    serialize_head, strip_hop_by_hop, with_connection,
+)
+from accesslog import current, note
+from bodystore import BodyStore, SpillTee, send_file
+from metrics import Histogram
+from upstream import CHUNK_SIZE, BodyTee, UpstreamResponse
+
+Fetch = Callable[[Headers], Awaitable[UpstreamResponse]]
+
+# Statuses that may be cached with a heuristic lifetime (RFC 9110 §15.1)
+HEURISTIC_STATUSES = frozenset((200, 203, 204, 300, 301, 308, 404, 405, 410, 414, 501))
+# Statuses this cache understands well enough to store at all
+UNDERSTOOD_STATUSES = HEURISTIC_STATUSES | frozenset((302, 303, 307))
+UNSAFE_METHODS = frozenset(("POST", "PUT", "DELETE", "PATCH"))
+# Origin answers a stale entry may stand in for (RFC 5861 §4)
+ERROR_STATUSES = frozenset((500, 502, 503, 504))
+# Sent with a 304 generated from a stored response (RFC 9110 §15.4.5)
+NOT_MODIFIED_HEADERS = frozenset(("cache-control", "content-location", "date", "etag", "expires", "vary",
+                                  "last-modified"))
+
+ENTRY_MAGIC = b"HC1\n"
+VARY_MAGIC = b"HCV\n"
+META_LENGTH = struct.Struct(">I")
+
+# Flight.head value telling followers to re-read the cache, and the end-of-stream marker for a failed leader
+REVALIDATED = object()
+FAILED = object()
+
+
+def parse_cache_control(headers: Headers) -> Dict[str, Optional[str]]:
+    """Cache-Control directives as lower-cased names mapped to their (unquoted) argument"""
+    directives: Dict[str, Optional[str]] = {}
+    for member in get_list(headers, "Cache-Control"):
+        name, _, value = member.partition("=")
+        name = name.strip().lower()
+        if name not in directives:
+            directives[name] = value.strip().strip('"') if value else None
+    return directives
+
+
+def delta_seconds(directives: Dict[str, Optional[str]], name: str) -> Optional[int]:
+    """Integer argument of a directive, or None if absent or malformed"""
+    value = directives.get(name)
+    if value is None:
+        return None
+    try:
+        return max(int(value), 0)
+    except ValueError:
+        return None
+
+
+def http_date(value: Optional[str]) -> Optional[float]:
+    """Parse an HTTP-date into a timestamp"""
+    if not value:
+        return None
+    try:
+        return parsedate_to_datetime(value).timestamp()
+    except (TypeError, ValueError, IndexError, OverflowError):
+        return None
+
+
+class CacheEntry:
+    """A stored response plus the times needed to compute its age
+
+    The body is either inline or, for large responses, a file in a BodyStore
+    named by body_file, in which case only the metadata goes to the backend.
+    """
+
+    def __init__(self, status: int, reason: str, headers: Headers, body: bytes,
+                 request_time: float, response_time: float,
+                 body_file: Optional[str] = None, body_length: Optional[int] = None) -> None:
+        self.status = status
+        self.reason = reason
+        self.headers = headers
+        self.body = body
+        self.request_time = request_time
+        self.response_time = response_time
+        self.body_file = body_file
+        self.length = len(body) if body_length is None else body_length
+        self.directives = parse_cache_control(headers)
+
+    def encode(self) -> bytes:
+        """Serialized form handed to the backend"""
+        meta = {"status": self.status, "reason": self.reason, "headers": self.headers,
+                "request_time": self.request_time, "response_time": self.response_time}
+        if self.body_file is not None:
+            meta.update(body_file=self.body_file, body_length=self.length)
+        raw = json.dumps(meta, separators=(",", ":")).encode("utf-8")
+        return ENTRY_MAGIC + META_LENGTH.pack(len(raw)) + raw + self.body
+
+    @classmethod
+    def decode(cls, data: bytes) -> Optional["CacheEntry"]:
+        """Inverse of encode(); None for anything else (e.g. entries stored before this format)"""
+        if not data.startswith(ENTRY_MAGIC):
+            return None
+        try:
+            start = len(ENTRY_MAGIC) + META_LENGTH.size
+            end = start + META_LENGTH.unpack_from(data, len(ENTRY_MAGIC))[0]
+            meta = json.loads(data[start:end])
+            return cls(meta["status"], meta["reason"], [tuple(h) for h in meta["headers"]],
+                       data[end:], meta["request_time"], meta["response_time"],
+                       meta.get("body_file"), meta.get("body_length"))
+        except (struct.error, ValueError, KeyError, TypeError):
+            return None
+
+    def header(self, name: str) -> Optional[str]:
+        return get_header(self.headers, name)
+
+    def age(self, now: float) -> float:
+        """current_age (RFC 9111 §4.2.3)"""
+        date = http_date(self.header("Date")) or self.response_time
+        try:
+            age_value = max(int(self.header("Age") or 0), 0)
+        except ValueError:
+            age_value = 0
+        apparent_age = max(0.0, self.response_time - date)
+        corrected_age_value = age_value + (self.response_time - self.request_time)
+        return max(apparent_age, corrected_age_value) + (now - self.response_time)
+
+    def lifetime(self, shared: bool, heuristic_fraction: float, max_heuristic: float) -> float:
+        """freshness_lifetime (RFC 9111 §4.2.1)"""
+        if shared and delta_seconds(self.directives, "s-maxage") is not None:
+            return delta_seconds(self.directives, "s-maxage")
+        if delta_seconds(self.directives, "max-age") is not None:
+            return delta_seconds(self.directives, "max-age")
+        if self.header("Expires") is not None:
+            expires = http_date(self.header("Expires"))
+            date = http_date(self.header("Date")) or self.response_time
+            # An invalid Expires means "already expired"
+            return max(expires - date, 0.0) if expires is not None else 0.0
+        if self.status in HEURISTIC_STATUSES or "public" in self.directives:
+            last_modified = http_date(self.header("Last-Modified"))
+            date = http_date(self.header("Date")) or self.response_time
+            if last_modified is not None and last_modified < date:
+                return min((date - last_modified) * heuristic_fraction, max_heuristic)
+        return 0.0
+
+    @property
+    def has_validators(self) -> bool:
+        return self.header("ETag") is not None or self.header("Last-Modified") is not None
+
+    def freshen(self, headers: Headers, request_time: float, response_time: float) -> "CacheEntry":
+        """Apply the header fields of a 304 to this entry (RFC 9111 §4.3.4)"""
+        updates = {key.lower(): (key, value) for key, value in strip_hop_by_hop(headers)
+                   if key.lower() != "content-length"}
+        merged = [(key, value) for key, value in self.headers if key.lower() not in updates]
+        merged.extend(updates.values())
+        return CacheEntry(self.status, self.reason, merged, self.body, request_time, response_time,
+                          self.body_file, self.length)
+
+    def serialize(self, version: str, now: float, not_modified: bool = False) -> bytes:
+        """The response to send to a client, with a current Age header (only the head if the body is a file)"""
+        headers = [(key, value) for key, value in self.headers if key.lower() != "age"]
+        headers.append(("Age", str(int(self.age(now)))))
+        if not_modified:
+            headers = [(key, value) for key, value in headers
+                       if key.lower() in NOT_MODIFIED_HEADERS or key.lower() == "age"]
+            return serialize_head(f"{version} 304 Not Modified", headers)
+        return serialize_head(f"{version} {self.status} {self.reason}",
+                              framed_headers(headers, self.length)) + self.body
+
+
+class HTTPCache:
+    """HTTP caching semantics on top of a key/value cache backend
+
+    The backend only needs async aget(key), aput(key, value) and
+    adelete(key) over bytes. This layer decides what may be stored, how long
+    it stays fresh (Cache-Control, Expires, or a heuristic based on
+    Last-Modified), keeps one entry per Vary combination under a secondary
+    key, and revalidates stale entries with If-None-Match/If-Modified-Since
+    so that unchanged objects cost a 304 from the origin. It acts as a shared
+    cache: private responses, Set-Cookie responses and responses to
+    requests with Authorization are not stored unless explicitly allowed.
+
+    Concurrent misses for one key are coalesced into a single fetch, and
+    entries within their stale-while-revalidate window (or the
+    stale_while_revalidate default) are served at once while a background
+    task refreshes them. When the origin fails or answers 500, 502, 503 or
+    504, a stale entry stands in for the error only within its
+    stale-if-error window (or the stale_if_error default).
+
+    With a BodyStore, bodies above its spill threshold are written to files
+    as they stream in (up to its max_body_size rather than max_object_size),
+    the backend only stores their metadata, and hits go out with sendfile.
+    """
+
+    def __init__(self, backend, max_object_size: int = 8 * 1024 * 1024, shared: bool = True,
+                 heuristic_fraction: float = 0.1, max_heuristic: float = 86400.0,
+                 coalesce_timeout: float = 10.0, stale_while_revalidate: float = 0.0,
+                 stale_if_error: float = 300.0, bodies: Optional[BodyStore] = None) -> None:
+        self.backend = backend
+        self.bodies = bodies
+        self.max_object_size = max_object_size
+        self.shared = shared
+        self.heuristic_fraction = heuristic_fraction
+        self.max_heuristic = max_heuristic
+        self.coalesce_timeout = coalesce_timeout
+        self.stale_while_revalidate = stale_while_revalidate
+        self.stale_if_error = stale_if_error
+        self.inflight: Dict[str, Flight] = {}
+        self.refreshing: Set[str] = set()
+        self.tasks: Set[Task] = set()
+        self.counters = {"hits": 0, "misses": 0, "revalidated": 0, "stale_served": 0, "stale_if_error": 0,
+                         "stored": 0, "uncacheable": 0, "invalidated": 0, "coalesced": 0,
+                         "coalesce_fallbacks": 0, "background_refreshes": 0}
+        self.lookup_seconds = Histogram()
+
+    def stats(self) -> Dict[str, int]:
+        """Hit, miss and revalidation counters"""
+        return dict(self.counters)
+
+    def histograms(self) -> Dict[str, Histogram]:
+        """Time spent reading the backend per lookup, Vary indirection included"""
+        return {"lookup_seconds": self.lookup_seconds}
+
+    @staticmethod
+    def primary_key(url: str) -> str:
+        return f"GET:{url}"
+
+    @staticmethod
+    def secondary_key(primary: str, names: List[str], headers: Headers) -> str:
+        """Key of the variant selected by the request's values for the Vary names"""
+        values = [" ".join(",".join(get_list(headers, name)).split()) for name in names]
+        return primary + "\n" + "\n".join(f"{name}={value}" for name, value in zip(names, values))
+
+    async def lookup(self, url: str, headers: Headers) -> Tuple[Optional[str], Optional[CacheEntry]]:
+        """Find the stored response (and its key) matching this request"""
+        key = self.primary_key(url)
+        start = time.perf_counter()
+        data = await self.backend.aget(key)
+        if data is not None and data.startswith(VARY_MAGIC):
+            names = data[len(VARY_MAGIC):].decode("latin-1").split(",")
+            key = self.secondary_key(key, names, headers)
+            data = await self.backend.aget(key)
+        self.lookup_seconds.observe(time.perf_counter() - start)
+        if data is None:
+            return key, None
+        entry = CacheEntry.decode(data)
+        if entry is not None and entry.body_file is not None and (
+                self.bodies is None or entry.body_file not in self.bodies):
+            # The body file was evicted independently of the index
+            return key, None
+        return key, entry
+
+    async def store(self, url: str, request_headers: Headers, entry: CacheEntry) -> None:
+        """Store an entry, writing a Vary marker at the primary key when needed"""
+        key = self.primary_key(url)
+        names = sorted({name.lower() for name in get_list(entry.headers, "Vary")})
+        if names:
+            await self.backend.aput(key, VARY_MAGIC + ",".join(names).encode("latin-1"))
+            key = self.secondary_key(key, names, request_headers)
+        await self.backend.aput(key, entry.encode())
+        self.counters["stored"] += 1
+
+    async def invalidate(self, url: str) -> None:
+        """Drop stored responses for url after a successful unsafe request (RFC 9111 §4.4)"""
+        await self.backend.adelete(self.primary_key(url))
+        self.counters["invalidated"] += 1
+
+    def storable(self, request_headers: Headers, request_cc: Dict[str, Optional[str]],
+                 response: UpstreamResponse) -> bool:
+        """Whether a response to a GET may be stored (RFC 9111 §3)"""
+        response_cc = parse_cache_control(response.headers)
+        if response.status not in UNDERSTOOD_STATUSES:
+            return False
+        if "no-store" in request_cc or "no-store" in response_cc:
+            return False
+        if self.shared and "private" in response_cc:
+            return False
+        if self.shared and get_header(request_headers, "Authorization") is not None and not (
+                "public" in response_cc or "must-revalidate" in response_cc or "s-maxage" in response_cc):
+            return False
+        if "*" in get_list(response.headers, "Vary"):
+            return False
+        # Storing a per-user cookie in a shared cache would hand it to every client
+        if response.getheader("Set-Cookie") is not None:
+            return False
+        explicit = "public" in response_cc or "max-age" in response_cc or \
+            (self.shared and "s-maxage" in response_cc) or response.getheader("Expires") is not None
+        if not explicit and response.status not in HEURISTIC_STATUSES:
+            return False
+        return True
+
+    def usable(self, entry: CacheEntry, request_cc: Dict[str, Optional[str]], now: float) -> bool:
+        """Whether entry can be served without contacting the origin"""
+        if "no-cache" in entry.directives or "no-cache" in request_cc:
+            return False
+        age = entry.age(now)
+        lifetime = entry.lifetime(self.shared, self.heuristic_fraction, self.max_heuristic)
+        max_age = delta_seconds(request_cc, "max-age")
+        if max_age is not None and age > max_age:
+            return False
+        min_fresh = delta_seconds(request_cc, "min-fresh")
+        if min_fresh is not None and lifetime - age < min_fresh:
+            return False
+        if lifetime > age:
+            return True
+        if "max-stale" in request_cc and self.may_serve_stale(entry):
+            max_stale = delta_seconds(request_cc, "max-stale")
+            return max_stale is None or age - lifetime <= max_stale
+        return False
+
+    def may_serve_stale(self, entry: CacheEntry) -> bool:
+        """Whether the origin allowed stale use of this entry"""
+        if "must-revalidate" in entry.directives or "no-cache" in entry.directives:
+            return False
+        return not self.shared or ("proxy-revalidate" not in entry.directives
+                                   and "s-maxage" not in entry.directives)
+
+    @staticmethod
+    def not_modified(entry: CacheEntry, request_headers: Headers) -> bool:
+        """Evaluate the client's own conditional headers against a stored entry"""
+        if_none_match = get_list(request_headers, "If-None-Match")
+        if if_none_match:
+            etag = entry.header("ETag")
+            if etag is None:
+                return False
+            weak = etag[2:] if etag.startswith("W/") else etag
+            return any(tag == "*" or (tag[2:] if tag.startswith("W/") else tag) == weak
+                       for tag in if_none_match)
+        since = http_date(get_header(request_headers, "If-Modified-Since"))
+        last_modified = http_date(entry.header("Last-Modified"))
+        return since is not None and last_modified is not None and last_modified <= since
+
+    def refresh_in_background(self, entry: CacheEntry, request_cc: Dict[str, Optional[str]], now: float) -> bool:
+        """Whether a stale entry may be served while it is revalidated (RFC 5861 stale-while-revalidate)"""
+        if not self.may_serve_stale(entry) or request_cc.keys() & {"no-cache", "max-age", "min-fresh"}:
+            return False
+        window = delta_seconds(entry.directives, "stale-while-revalidate")
+        if window is None:
+            window = self.stale_while_revalidate
+        lifetime = entry.lifetime(self.shared, self.heuristic_fraction, self.max_heuristic)
+        return window > 0 and entry.age(now) - lifetime <= window
+
+    def serve_on_error(self, entry: CacheEntry, request_cc: Dict[str, Optional[str]], now: float) -> bool:
+        """Whether a stale entry may stand in for an origin error (RFC 5861 stale-if-error)"""
+        if not self.may_serve_stale(entry):
+            return False
+        window = delta_seconds(entry.directives, "stale-if-error")
+        if window is None:
+            window = delta_seconds(request_cc, "stale-if-error")
+        if window is None:
+            window = self.stale_if_error
+        lifetime = entry.lifetime(self.shared, self.heuristic_fraction, self.max_heuristic)
+        return entry.age(now) - lifetime <= window
+
+    async def serve(self, fetch: Fetch, writer: StreamWriter, method: str, url: str, headers: Headers,
+                    body: RequestBody, version: str, persistent: bool) -> bool:
+        """Answer a request from the cache or the origin, returning whether the client connection is reusable
+
+        fetch(headers) sends the request upstream with the given headers and
+        returns the response once its head has arrived. Concurrent misses for
+        the same key share one upstream fetch; the first request leads and
+        the others follow its stream.
+        """
+        method = method.upper()
+        if method != "GET" or body:
+            note(cache="BYPASS")
+            response = await fetch(headers)
+            persistent = await response.relay(writer, version, persistent)
+            if method in UNSAFE_METHODS and response.status < 400:
+                await self.invalidate(url)
+            return persistent
+
+        request_cc = parse_cache_control(headers)
+        if not request_cc and "no-cache" in (value.lower() for value in get_list(headers, "Pragma")):
+            request_cc = {"no-cache": None}
+        key, entry = await self.lookup(url, headers)
+        now = time.time()
+        if entry is not None and self.usable(entry, request_cc, now):
+            note(cache="HIT")
+            sent = await self._send(writer, entry, headers, version, now, persistent)
+            if sent is not None:
+                self.counters["hits"] += 1
+                return sent
+            entry = None
+        if entry is not None and self.refresh_in_background(entry, request_cc, now):
+            if key not in self.inflight and key not in self.refreshing:
+                self.refreshing.add(key)
+                task = create_task(self._refresh(fetch, url, key, headers, entry))
+                self.tasks.add(task)
+                task.add_done_callback(self.tasks.discard)
+            return await self._serve_stale(writer, entry, headers, version, persistent)
+        if "only-if-cached" in request_cc:
+            note(cache="MISS", status=504)
+            await self._write(writer, f"{version} 504 Gateway Timeout\r\nContent-Length: 0\r\n\r\n"
+                              .encode("latin-1"), persistent)
+            return persistent
+
+        note(cache="MISS")
+        flight = self.inflight.get(key)
+        if flight is not None:
+            result = await self._follow(flight, writer, url, key, headers, request_cc, version, persistent)
+            if result is not None:
+                return result
+            self.counters["coalesce_fallbacks"] += 1
+            return await self._fetch(fetch, writer, url, key, entry, headers, request_cc, version, persistent)
+
+        flight = Flight(self.max_object_size, self._tee())
+        self.inflight[key] = flight
+        try:
+            return await self._fetch(fetch, writer, url, key, entry, headers, request_cc, version, persistent,
+                                     flight)
+        finally:
+            if self.inflight.get(key) is flight:
+                del self.inflight[key]
+            flight.abandon()
+
+    async def _fetch(self, fetch: Fetch, writer: StreamWriter, url: str, key: str, entry: Optional[CacheEntry],
+                     headers: Headers, request_cc: Dict[str, Optional[str]], version: str, persistent: bool,
+                     flight: Optional["Flight"] = None) -> bool:
+        """Miss or revalidation: go to the origin, leading flight if given"""
+        if entry is not None and not entry.has_validators:
+            entry = None
+        request_time = time.time()
+        try:
+            response = await fetch(self._conditional_headers(headers, entry))
+        except (OSError, ConnectionError, TimeoutError) as e:
+            if entry is None or not self.serve_on_error(entry, request_cc, time.time()):
+                raise
+            logging.warning("Serving stale %s after upstream error: %s", url, e)
+            if flight is not None:
+                flight.decline()
+            return await self._serve_stale(writer, entry, headers, version, persistent, error=True)
+        response_time = time.time()
+
+        if entry is not None and response.status == 304:
+            await response.read()
+            entry = entry.freshen(response.headers, request_time, response_time)
+            await self.backend.aput(key, entry.encode())
+            self.counters["revalidated"] += 1
+            note(cache="REVALIDATED")
+            if flight is not None:
+                flight.start(None)
+            return bool(await self._send(writer, entry, headers, version, response_time, persistent))
+        if entry is not None and response.status in ERROR_STATUSES \
+                and self.serve_on_error(entry, request_cc, response_time):
+            response.close()
+            if flight is not None:
+                flight.decline()
+            return await self._serve_stale(writer, entry, headers, version, persistent, error=True)
+
+        self.counters["misses"] += 1
+        if not self.storable(headers, request_cc, response):
+            # Not shared: followers of this flight fetch for themselves
+            self.counters["uncacheable"] += 1
+            if flight is not None:
+                flight.decline()
+            return await response.relay(writer, version, persistent)
+        tee = flight.tee if flight is not None else self._tee()
+        if flight is not None:
+            flight.start((response.status, response.reason, response.headers, headers))
+        try:
+            persistent = await response.relay(writer, version, persistent, flight or tee)
+        except BaseException:
+            if isinstance(tee, SpillTee):
+                tee.discard()
+            raise
+        if flight is not None:
+            flight.finish()
+        await self._store_response(url, headers, response, tee, request_time, response_time)
+        return persistent
+
+    async def _follow(self, flight: "Flight", writer: StreamWriter, url: str, key: str, headers: Headers,
+                      request_cc: Dict[str, Optional[str]], version: str, persistent: bool) -> Optional[bool]:
+        """Serve a request from another request's fetch; None means fetch independently"""
+        try:
+            head = await wait_for(shield(flight.head), self.coalesce_timeout)
+        except TimeoutError:
+            return None
+        if head is None:
+            return None
+        if head is REVALIDATED:
+            _, entry = await self.lookup(url, headers)
+            if entry is None or not self.usable(entry, request_cc, time.time()):
+                return None
+            self.counters["coalesced"] += 1
+            note(cache="COALESCED")
+            return await self._send(writer, entry, headers, version, time.time(), persistent)
+
+        status, reason, response_headers, leader_headers = head
+        names = sorted({name.lower() for name in get_list(response_headers, "Vary")})
+        if names and self.secondary_key(key, names, headers) != self.secondary_key(key, names, leader_headers):
+            return None
+        queue = flight.subscribe()
+        if queue is None:
+            return None
+        self.counters["coalesced"] += 1
+        note(cache="COALESCED", status=status)
+        send_headers = strip_hop_by_hop(response_headers)
+        chunked = False
+        if has_body("GET", status) and content_length(response_headers) is None:
+            if version.upper() == "HTTP/1.1":
+                send_headers.append(("Transfer-Encoding", "chunked"))
+                chunked = True
+            else:
+                persistent = False
+        send_headers.append(("Connection", "keep-alive" if persistent else "close"))
+        writer.write(serialize_head(f"{version} {status} {reason}", send_headers))
+        sent = 0
+        while True:
+            data = await queue.get()
+            if data is None:
+                break
+            if data is FAILED:
+                # The head is already out, so the only way to signal failure is to drop the connection
+                note(sent=sent)
+                return False
+            if chunked:
+                writer.writelines((b"%x\r\n" % len(data), data, b"\r\n"))
+            else:
+                writer.write(data)
+            sent += len(data)
+            await writer.drain()
+        note(sent=sent)
+        if chunked:
+            writer.write(b"0\r\n\r\n")
+        await writer.drain()
+        return persistent
+
+    async def _refresh(self, fetch: Fetch, url: str, key: str, headers: Headers, entry: CacheEntry) -> None:
+        """Revalidate or refetch a stale entry off the request path"""
+        # This task inherited the triggering request's access record, which may already be written out
+        current.set(None)
+        try:
+            request_time = time.time()
+            response = await fetch(self._conditional_headers(headers, entry if entry.has_validators else None))
+            response_time = time.time()
+            if response.status == 304 and entry.has_validators:
+                await response.read()
+                entry = entry.freshen(response.headers, request_time, response_time)
+                await self.backend.aput(key, entry.encode())
+            elif self.storable(headers, {}, response):
+                tee = self._tee()
+                body = response.iter_body()
+                try:
+                    async for data in body:
+                        tee.feed(data)
+                        if tee.overflow:
+                            break
+                except BaseException:
+                    if isinstance(tee, SpillTee):
+                        tee.discard()
+                    raise
+                finally:
+                    await body.aclose()
+                await self._store_response(url, headers, response, tee, request_time, response_time)
+            else:
+                response.close()
+            self.counters["background_refreshes"] += 1
+        except (OSError, ConnectionError, TimeoutError, IncompleteReadError, ProtocolError) as e:
+            logging.warning("Background refresh of %s failed: %s", url, e)
+        finally:
+            self.refreshing.discard(key)
+
+    @staticmethod
+    def _conditional_headers(headers: Headers, entry: Optional[CacheEntry]) -> Headers:
+        """Request headers validating entry; the client's own validators are evaluated locally instead"""
+        if entry is None:
+            return headers
+        send_headers = [(k, v) for k, v in headers if k.lower() not in (
+            "if-none-match", "if-modified-since", "if-match", "if-unmodified-since", "if-range")]
+        if entry.header("ETag") is not None:
+            send_headers.append(("If-None-Match", entry.header("ETag")))
+        if entry.header("Last-Modified") is not None:
+            send_headers.append(("If-Modified-Since", entry.header("Last-Modified")))
+        return send_headers
+
+    def _tee(self) -> Union[BodyTee, SpillTee]:
+        """Collector for a body that may be stored"""
+        if self.bodies is not None:
+            return self.bodies.tee()
+        return BodyTee(self.max_object_size)
+
+    async def _store_response(self, url: str, headers: Headers, response: UpstreamResponse,
+                              tee: Union[BodyTee, SpillTee], request_time: float, response_time: float) -> None:
+        ref = tee.finish() if isinstance(tee, SpillTee) else None
+        data = tee.getvalue()
+        if data is None and ref is None:
+            return
+        entry = CacheEntry(response.status, response.reason, strip_hop_by_hop(response.headers), data or b"",
+                           request_time, response_time, *(ref or (None, None)))
+        lifetime = entry.lifetime(self.shared, self.heuristic_fraction, self.max_heuristic)
+        # A response that is stale on arrival is only worth keeping if it can be revalidated
+        if lifetime > 0 or entry.has_validators:
+            if entry.header("Date") is None:
+                entry.headers.append(("Date", formatdate(response_time, usegmt=True)))
+            await self.store(url, headers, entry)
+
+    async def _serve_stale(self, writer: StreamWriter, entry: CacheEntry, headers: Headers, version: str,
+                           persistent: bool, error: bool = False) -> bool:
+        self.counters["stale_if_error" if error else "stale_served"] += 1
+        note(cache="STALE")
+        # None means the body file vanished before anything was written; the connection cannot continue
+        return bool(await self._send(writer, entry, headers, version, time.time(), persistent))
+
+    async def _send(self, writer: StreamWriter, entry: CacheEntry, headers: Headers, version: str, now: float,
+                    persistent: bool) -> Optional[bool]:
+        """Write a stored response (or a 304 for it); None if its body file is gone and nothing was sent"""
+        not_modified = self.not_modified(entry, headers)
+        head = entry.serialize(version, now, not_modified)
+        if not_modified or entry.body_file is None:
+            note(status=304 if not_modified else entry.status, sent=0 if not_modified else len(entry.body))
+            await self._write(writer, head, persistent)
+            return persistent
+        file = self.bodies.open(entry.body_file) if self.bodies is not None else None
+        if file is None:
+            return None
+        note(status=entry.status, sent=entry.length)
+        with file:
+            writer.writelines(with_connection(head, persistent))
+            await send_file(writer, file, 0, entry.length)
+        return persistent
+
+    @staticmethod
+    async def _write(writer: StreamWriter, response: bytes, persistent: bool) -> None:
+        writer.writelines(with_connection(response, persistent))
+        await writer.drain()
+
+
+class Flight:
+    """One in-progress upstream fetch that other requests for the same key can follow
+
+    head resolves to (status, reason, headers, leader request headers) once
+    the leader has a shareable response, to REVALIDATED when the cache entry
+    was refreshed instead, or to None when followers must fetch on their
+    own. Body chunks are fanned out to a queue per follower; chunks are kept
+    for late joiners only while the body fits in max_history. Each queue
+    holds at most max_history worth of full-size chunks: a follower that
+    falls that far behind is detached and gets FAILED, so a slow client
+    cannot make the leader buffer the whole body for it.
+    """
+
+    def __init__(self, max_history: int, tee: Union[BodyTee, SpillTee]) -> None:
+        self.head: Future = get_running_loop().create_future()
+        self.max_history = max_history
+        self.max_queued = max(max_history // CHUNK_SIZE, 1)
+        self.history = BodyTee(max_history)
+        # Collects the body for the cache on the leader's behalf
+        self.tee = tee
+        self.subscribers: List[Queue] = []
+        self.done = False
+
+    def start(self, head) -> None:
+        """Publish the response head (None when the cache was revalidated instead)"""
+        if not self.head.done():
+            self.head.set_result(REVALIDATED if head is None else head)
+
+    def decline(self) -> None:
+        """Tell followers this response will not be shared"""
+        if not self.head.done():
+            self.head.set_result(None)
+
+    def subscribe(self) -> Optional[Queue]:
+        """A queue yielding body chunks then None (or FAILED); None if it is too late to join"""
+        if self.history.overflow or len(self.history.chunks) >= self.max_queued:
+            return None
+        # One slot beyond max_queued is kept for the end marker
+        queue: Queue = Queue(maxsize=self.max_queued + 1)
+        for data in self.history.chunks:
+            queue.put_nowait(data)
+        if self.done:
+            queue.put_nowait(None)
+        self.subscribers.append(queue)
+        return queue
+
+    def feed(self, data: bytes) -> None:
+        self.history.feed(data)
+        self.tee.feed(data)
+        for queue in list(self.subscribers):
+            if queue.qsize() >= self.max_queued:
+                self._detach(queue)
+            else:
+                queue.put_nowait(data)
+
+    def _detach(self, queue: Queue) -> None:
+        """Drop a follower that stopped keeping up, freeing what it had queued"""
+        self.subscribers.remove(queue)
+        while not queue.empty():
+            queue.get_nowait()
+        queue.put_nowait(FAILED)
+
+    def finish(self) -> None:
+        self.done = True
+        for queue in self.subscribers:
+            queue.put_nowait(None)
+
+    def abandon(self) -> None:
+        """Release followers if the leader stopped before finishing"""
+        if not self.head.done():
+            self.decline()
+        elif not self.done:
+            self.done = True
+            for queue in self.subscribers:
+                queue.put_nowait(FAILED)
@@ -0,0 +1,215 @@
+"""Prometheus Metrics: Latency Histograms and a Text-Format Admin Endpoint
+
+Components keep plain counters (their stats()) and Histogram objects (their
+histograms()) that are only ever touched from their worker's event loop,
+so recording is a bisect and two additions with no locks. The admin
+endpoint renders whatever a collect() callable returns: one process's own
+values standalone, or the supervisor's sums of every worker's reports.
+"""
+
+from asyncio import (
+    AbstractEventLoop, IncompleteReadError, StreamReader, StreamWriter, Task, create_task, get_running_loop,
+    new_event_loop, sleep, start_server, wait_for,
+)
+from bisect import bisect_left
+from typing import Callable, Dict, Iterable, List, Optional, Tuple
+import logging
+import math
+import re
+import threading
+
+# Upper bounds of the buckets, Prometheus' le labels
+SECONDS_BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0)
+BYTES_BUCKETS = tuple(float(1 << shift) for shift in range(10, 32, 2))  # 1 KiB .. 1 GiB
+LAG_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5)
+
+# (bounds, per-bucket counts with the +Inf bucket last, sum) as reported across processes
+Snapshot = Tuple[Tuple[float, ...], List[int], float]
+
+CONTENT_TYPE = "text/plain; version=0.0.4; charset=utf-8"
+
+# Flat stats are running totals unless their name ends in one of these: components report
+# sizes, lengths of live tables, ratios and maxima as current values
+GAUGE_SUFFIXES = ("ratio", "max_seconds", "bytes", "entries", "files", "pending", "pending_hits", "queued",
+                  "in_flight", "idle", "origins", "contexts", "sessions", "bypassing", "failing_addresses",
+                  "rules", "domains", "exact", "automaton_states", "connections", "tunnels", "clients", "workers")
+
+
+class Histogram:
+    """Counts of observed values per bucket, plus their sum"""
+
+    __slots__ = ("bounds", "counts", "sum")
+
+    def __init__(self, bounds: Iterable[float] = SECONDS_BUCKETS) -> None:
+        self.bounds = tuple(bounds)
+        self.counts = [0] * (len(self.bounds) + 1)
+        self.sum = 0.0
+
+    def observe(self, value: float) -> None:
+        # The first bound >= value, i.e. the smallest le the value falls under
+        self.counts[bisect_left(self.bounds, value)] += 1
+        self.sum += value
+
+    @property
+    def count(self) -> int:
+        return sum(self.counts)
+
+    def snapshot(self) -> Snapshot:
+        """A picklable copy, e.g. for the supervisor's stats queue"""
+        return self.bounds, list(self.counts), self.sum
+
+
+def merge(snapshots: Iterable[Snapshot]) -> Optional[Snapshot]:
+    """Sum histograms with the same buckets (from several workers)"""
+    merged: Optional[Snapshot] = None
+    for bounds, counts, total in snapshots:
+        if merged is None:
+            merged = (bounds, list(counts), total)
+        elif merged[0] == tuple(bounds):
+            merged = (merged[0], [a + b for a, b in zip(merged[1], counts)], merged[2] + total)
+    return merged
+
+
+class LoopMonitor:
+    """Measures event loop lag: how late a sleep of interval seconds wakes up
+
+    Lag is time the loop spent running callbacks instead of serving
+    sockets, so a slow cache lookup or blocklist compile on the loop shows
+    up here even when each request's own latency looks fine.
+    """
+
+    def __init__(self, interval: float = 0.25) -> None:
+        self.interval = interval
+        self.lag_seconds = Histogram(LAG_BUCKETS)
+        self.max_lag = 0.0
+        self.task: Optional[Task] = None
+
+    def start(self) -> None:
+        self.task = create_task(self._run())
+
+    def stop(self) -> None:
+        if self.task is not None:
+            self.task.cancel()
+            self.task = None
+
+    def stats(self) -> Dict[str, float]:
+        return {"lag_max_seconds": self.max_lag}
+
+    def histograms(self) -> Dict[str, Histogram]:
+        return {"lag_seconds": self.lag_seconds}
+
+    async def _run(self) -> None:
+        loop = get_running_loop()
+        while True:
+            start = loop.time()
+            await sleep(self.interval)
+            lag = max(loop.time() - start - self.interval, 0.0)
+            self.lag_seconds.observe(lag)
+            self.max_lag = max(self.max_lag, lag)
+
+
+def _name(key: str, prefix: str) -> str:
+    return re.sub(r"[^a-zA-Z0-9_:]", "_", f"{prefix}_{key}")
+
+
+def _number(value: float) -> str:
+    if math.isinf(value):
+        return "+Inf" if value > 0 else "-Inf"
+    return repr(float(value)) if isinstance(value, float) else str(value)
+
+
+def render(stats: Dict[str, float], histograms: Dict[str, Snapshot], prefix: str = "proxy") -> str:
+    """Prometheus text exposition format (version 0.0.4)
+
+    Flat stats are typed by name (see GAUGE_SUFFIXES): gauges for current
+    values, counters for everything else; histograms get cumulative _bucket
+    series with le labels, _sum and _count.
+    """
+    lines: List[str] = []
+    for key, value in sorted(stats.items()):
+        if isinstance(value, bool) or not isinstance(value, (int, float)):
+            continue
+        name = _name(key, prefix)
+        lines.append(f"# TYPE {name} {'gauge' if key.endswith(GAUGE_SUFFIXES) else 'counter'}")
+        lines.append(f"{name} {_number(value)}")
+    for key, (bounds, counts, total) in sorted(histograms.items()):
+        name = _name(key, prefix)
+        lines.append(f"# TYPE {name} histogram")
+        cumulative = 0
+        for bound, count in zip(bounds + (math.inf,), counts):
+            cumulative += count
+            lines.append(f'{name}_bucket{{le="{_number(bound)}"}} {cumulative}')
+        lines.append(f"{name}_sum {_number(total)}")
+        lines.append(f"{name}_count {cumulative}")
+    return "\n".join(lines) + "\n"
+
+
+class MetricsServer:
+    """Minimal HTTP server answering GET /metrics with collect()'s text
+
+    Meant for a local admin address: it reads one request per connection
+    and closes it. start() serves from the running event loop; start_thread()
+    gives it a loop of its own in a daemon thread, for callers without one
+    (the supervisor), in which case collect() runs in that thread.
+    """
+
+    def __init__(self, collect: Callable[[], str], timeout: float = 5.0) -> None:
+        self.collect = collect
+        self.timeout = timeout
+        self.server = None
+        self.port = 0
+        self.scrapes = 0
+        self.loop: Optional[AbstractEventLoop] = None
+        self.thread: Optional[threading.Thread] = None
+
+    async def start(self, host: str = "127.0.0.1", port: int = 9100) -> None:
+        self.server = await start_server(self.__handle, host, port)
+        self.port = self.server.sockets[0].getsockname()[1]
+        logging.info(f"Serving metrics on http://{host}:{self.port}/metrics")
+
+    def start_thread(self, host: str = "127.0.0.1", port: int = 9100) -> None:
+        """Bind in the caller's thread, so a busy port fails here, then serve from a new thread"""
+        self.loop = new_event_loop()
+        try:
+            self.loop.run_until_complete(self.start(host, port))
+        except BaseException:
+            self.loop.close()
+            raise
+        self.thread = threading.Thread(target=self.loop.run_forever, name="metrics", daemon=True)
+        self.thread.start()
+
+    async def close(self) -> None:
+        if self.server is not None:
+            self.server.close()
+            await self.server.wait_closed()
+            self.server = None
+
+    def stop_thread(self) -> None:
+        if self.loop is None:
+            return
+        self.loop.call_soon_threadsafe(self.loop.stop)
+        self.thread.join(5.0)
+        self.loop.run_until_complete(self.close())
+        self.loop.close()
+        self.loop = None
+
+    async def __handle(self, reader: StreamReader, writer: StreamWriter) -> None:
+        try:
+            head = await wait_for(reader.readuntil(b"\r\n\r\n"), self.timeout)
+            method, target = head.split(b"\r\n", 1)[0].split(b" ")[:2]
+            if method not in (b"GET", b"HEAD"):
+                status, body = "405 Method Not Allowed", b""
+            elif target.split(b"?", 1)[0] != b"/metrics":
+                status, body = "404 Not Found", b""
+            else:
+                self.scrapes += 1
+                status, body = "200 OK", self.collect().encode()
+            writer.write(f"HTTP/1.1 {status}\r\nContent-Type: {CONTENT_TYPE}\r\n"
+                         f"Content-Length: {len(body)}\r\nConnection: close\r\n\r\n".encode())
+            if method != b"HEAD":
+                writer.write(body)
+            await writer.drain()
+        except (IncompleteReadError, ConnectionError, TimeoutError, ValueError):
+            pass
+        finally:
+            writer.close()
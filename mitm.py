@@ -0,0 +1,302 @@
+"""TLS Interception: Local CA and Per-Host Leaf Certificates"""
+
+from asyncio import Future, Task, create_task, get_running_loop, shield
+from collections import OrderedDict
+from typing import Dict, Iterable, List, Optional, Tuple
+import datetime
+import ipaddress
+import logging
+import os
+import ssl
+import threading
+import time
+import uuid
+
+from cryptography import x509
+from cryptography.exceptions import InvalidSignature
+from cryptography.hazmat.primitives import hashes, serialization
+from cryptography.hazmat.primitives.asymmetric import ec
+from cryptography.x509.oid import ExtendedKeyUsageOID, NameOID
+
+from blocklist import DOMAIN_PREFIXES, EXACT_PREFIX, Blocklist
+
+CA_DAYS = 3650
+LEAF_DAYS = 30
+# Leaves are re-minted in the background once they get this close to expiring
+RENEW_BEFORE = 2 * 24 * 3600
+PEM_SUFFIX = ".pem"
+# Hosts minted by earlier runs that prewarm() loads by default
+PREWARM_RECENT = 64
+
+Leaf = Tuple[ssl.SSLContext, float]  # server context, expiry as a Unix time
+
+
+class CertificateAuthority:
+    """Local CA whose key and certificate live together in one PEM file
+
+    The file is created on first use. Creation is atomic (os.link of a
+    finished temporary file), so worker processes starting together agree
+    on a single CA. The certificate alone is written next to it as .crt for
+    installing on clients. Leaves share one EC key per process: signing a
+    certificate takes well under a millisecond, generating a key does not.
+    """
+
+    def __init__(self, path: str, leaf_days: int = LEAF_DAYS) -> None:
+        self.path = path
+        self.leaf_days = leaf_days
+        if not os.path.exists(path):
+            self._create()
+        with open(path, "rb") as file:
+            pem = file.read()
+        self.key = serialization.load_pem_private_key(pem, None)
+        self.cert = x509.load_pem_x509_certificate(pem)
+        self.leaf_key = ec.generate_private_key(ec.SECP256R1())
+        self.leaf_key_pem = self.leaf_key.private_bytes(
+            serialization.Encoding.PEM, serialization.PrivateFormat.PKCS8, serialization.NoEncryption())
+        self.authority_key_id = x509.AuthorityKeyIdentifier.from_issuer_public_key(self.key.public_key())
+
+    def mint(self, host: str) -> Tuple[bytes, float]:
+        """PEM certificate and key for host, and the certificate's expiry"""
+        now = datetime.datetime.now(datetime.timezone.utc)
+        expires = now + datetime.timedelta(days=self.leaf_days)
+        try:
+            name: x509.GeneralName = x509.IPAddress(ipaddress.ip_address(host))
+        except ValueError:
+            name = x509.DNSName(host)
+        cert = (
+            x509.CertificateBuilder()
+            .subject_name(x509.Name([x509.NameAttribute(NameOID.COMMON_NAME, host[:64])]))
+            .issuer_name(self.cert.subject)
+            .public_key(self.leaf_key.public_key())
+            .serial_number(x509.random_serial_number())
+            # Backdated a day for clients with a slow clock
+            .not_valid_before(now - datetime.timedelta(days=1))
+            .not_valid_after(expires)
+            .add_extension(x509.SubjectAlternativeName([name]), critical=False)
+            .add_extension(x509.BasicConstraints(ca=False, path_length=None), critical=True)
+            .add_extension(x509.KeyUsage(True, True, False, False, False, False, False, False, False), critical=True)
+            .add_extension(x509.ExtendedKeyUsage([ExtendedKeyUsageOID.SERVER_AUTH]), critical=False)
+            .add_extension(self.authority_key_id, critical=False)
+            .sign(self.key, hashes.SHA256())
+        )
+        return cert.public_bytes(serialization.Encoding.PEM) + self.leaf_key_pem, expires.timestamp()
+
+    def issued(self, pem: bytes) -> Optional[float]:
+        """Expiry of a stored leaf if this CA issued it, else None"""
+        try:
+            cert = x509.load_pem_x509_certificate(pem)
+        except ValueError:
+            return None
+        if cert.issuer != self.cert.subject:
+            return None
+        try:
+            cert.verify_directly_issued_by(self.cert)
+        except (InvalidSignature, ValueError, TypeError):
+            return None
+        return cert.not_valid_after_utc.timestamp()
+
+    def _create(self) -> None:
+        key = ec.generate_private_key(ec.SECP256R1())
+        name = x509.Name([x509.NameAttribute(NameOID.COMMON_NAME, "Python-Proxy Local CA"),
+                          x509.NameAttribute(NameOID.ORGANIZATION_NAME, "Python-Proxy")])
+        now = datetime.datetime.now(datetime.timezone.utc)
+        cert = (
+            x509.CertificateBuilder()
+            .subject_name(name)
+            .issuer_name(name)
+            .public_key(key.public_key())
+            .serial_number(x509.random_serial_number())
+            .not_valid_before(now - datetime.timedelta(days=1))
+            .not_valid_after(now + datetime.timedelta(days=CA_DAYS))
+            .add_extension(x509.BasicConstraints(ca=True, path_length=0), critical=True)
+            .add_extension(x509.KeyUsage(True, False, False, False, False, True, True, False, False), critical=True)
+            .add_extension(x509.SubjectKeyIdentifier.from_public_key(key.public_key()), critical=False)
+            .sign(key, hashes.SHA256())
+        )
+        cert_pem = cert.public_bytes(serialization.Encoding.PEM)
+        key_pem = key.private_bytes(serialization.Encoding.PEM, serialization.PrivateFormat.PKCS8,
+                                    serialization.NoEncryption())
+        directory = os.path.dirname(os.path.abspath(self.path))
+        os.makedirs(directory, exist_ok=True)
+        temp = os.path.join(directory, f".{uuid.uuid4().hex}.tmp")
+        fd = os.open(temp, os.O_WRONLY | os.O_CREAT | os.O_EXCL, 0o600)
+        with os.fdopen(fd, "wb") as file:
+            file.write(key_pem + cert_pem)
+        try:
+            os.link(temp, self.path)
+        except FileExistsError:
+            return  # Another worker won; use its CA
+        finally:
+            os.remove(temp)
+        with open(os.path.splitext(self.path)[0] + ".crt", "wb") as file:
+            file.write(cert_pem)
+        logging.warning(f"Created a new interception CA; install {os.path.splitext(self.path)[0]}.crt on clients")
+
+
+class Interceptor:
+    """Decides which CONNECT tunnels to intercept and supplies their server-side TLS contexts
+
+    domains uses the blocklist rule syntax, except that a bare name also
+    covers its subdomains. Leaf contexts are kept for the max_contexts most
+    recently used hosts, and their PEMs in cert_dir so restarts and other
+    workers reuse them; minting and loading run in the default executor and
+    concurrent requests for one host share a single mint. prewarm() loads or
+    mints hosts ahead of their first CONNECT, and leaves close to expiry are
+    renewed in the background while the old one is still served. A client
+    that rejects our certificate (pinning, CA not installed) gets its host
+    tunnelled blindly for bypass_ttl seconds instead of failing every time,
+    as does a host no certificate can be made for.
+    """
+
+    def __init__(self, ca_path: str, cert_dir: str, domains: Iterable[str], max_contexts: int = 1024,
+                 bypass_ttl: float = 3600.0, leaf_days: int = LEAF_DAYS) -> None:
+        self.ca_path = ca_path
+        self.cert_dir = cert_dir
+        self.max_contexts = max_contexts
+        self.bypass_ttl = bypass_ttl
+        self.leaf_days = leaf_days
+        self.domains = self.compile(domains)
+        self.ca: Optional[CertificateAuthority] = None
+        self.ca_lock = threading.Lock()
+        self.contexts: "OrderedDict[str, Leaf]" = OrderedDict()
+        self.minting: Dict[str, Future] = {}
+        self.bypass: Dict[str, float] = {}
+        self.tasks: List[Task] = []
+        self.counters = {"intercepted": 0, "context_hits": 0, "disk_loads": 0, "minted": 0, "renewed": 0,
+                         "mint_failures": 0, "client_handshake_failures": 0, "bypassed": 0}
+
+    @staticmethod
+    def compile(domains: Iterable[str]) -> Blocklist:
+        """Matcher for domain rules, bare names meaning the domain and its subdomains"""
+        rules = [rule if rule.startswith(DOMAIN_PREFIXES + (EXACT_PREFIX,)) else "||" + rule for rule in domains]
+        return Blocklist(rules, 4096)
+
+    def intercepts(self, host: str) -> bool:
+        """Whether a CONNECT to host should be terminated here"""
+        if not len(self.domains) or not self.domains.blocked(host):
+            return False
+        until = self.bypass.get(host)
+        if until is not None:
+            if until > time.monotonic():
+                self.counters["bypassed"] += 1
+                return False
+            del self.bypass[host]
+        return True
+
+    def failed(self, host: str, minting: bool = False) -> None:
+        """The client refused our certificate for host (or none could be made); tunnel it blindly for a while"""
+        self.counters["mint_failures" if minting else "client_handshake_failures"] += 1
+        self.bypass[host] = time.monotonic() + self.bypass_ttl
+
+    async def context(self, host: str) -> ssl.SSLContext:
+        """Server context presenting a certificate for host"""
+        host = host.lower().rstrip(".")
+        leaf = self.contexts.get(host)
+        if leaf is not None:
+            self.contexts.move_to_end(host)
+            self.counters["context_hits"] += 1
+            if leaf[1] - time.time() < RENEW_BEFORE and host not in self.minting:
+                self._background(self._renew(host))
+            return leaf[0]
+        return await self._leaf(host)
+
+    def prewarm(self, hosts: Iterable[str], recent: int = PREWARM_RECENT) -> None:
+        """Load or mint contexts for hosts, plus the recent most recently minted ones on disk, in the background"""
+        self._background(self._prewarm(list(hosts), recent))
+
+    def close(self) -> None:
+        for task in self.tasks:
+            task.cancel()
+
+    def stats(self) -> Dict[str, int]:
+        return dict(self.counters, contexts=len(self.contexts), bypassing=len(self.bypass))
+
+    def _background(self, coroutine) -> None:
+        task = create_task(coroutine)
+        self.tasks.append(task)
+        task.add_done_callback(self.tasks.remove)
+
+    async def _prewarm(self, hosts: List[str], recent: int) -> None:
+        loop = get_running_loop()
+        if recent:
+            hosts += await loop.run_in_executor(None, self._recent_hosts, recent)
+        for host in dict.fromkeys(hosts):
+            if host not in self.contexts:
+                try:
+                    await self._leaf(host)
+                except (OSError, ValueError) as e:
+                    logging.warning(f"Could not prepare a certificate for {host}: {e}")
+
+    async def _renew(self, host: str) -> None:
+        try:
+            await self._leaf(host, renew=True)
+        except (OSError, ValueError) as e:
+            logging.warning(f"Could not renew the certificate for {host}: {e}")
+
+    async def _leaf(self, host: str, renew: bool = False) -> ssl.SSLContext:
+        """Load or mint host's leaf once, however many connections ask for it meanwhile"""
+        pending = self.minting.get(host)
+        if pending is not None:
+            # Shielded: a waiter cancelled by a drain or a vanished client must not cancel the others
+            return await shield(pending)
+        future = get_running_loop().create_future()
+        self.minting[host] = future
+        try:
+            context, expires = await get_running_loop().run_in_executor(None, self._build, host, renew)
+        except BaseException as e:
+            if not future.done():
+                if not isinstance(e, Exception):
+                    # This caller was cancelled; the others get an ordinary failure
+                    e = OSError(f"making the certificate for {host} was abandoned")
+                future.set_exception(e)
+                # Nobody else may be waiting; don't let the exception go unretrieved
+                future.exception()
+            raise
+        finally:
+            del self.minting[host]
+        self.contexts[host] = context, expires
+        self.contexts.move_to_end(host)
+        while len(self.contexts) > self.max_contexts:
+            self.contexts.popitem(last=False)
+        if not future.done():
+            future.set_result(context)
+        return context
+
+    def _build(self, host: str, renew: bool) -> Leaf:
+        """Runs in a worker thread: reuse the stored leaf if still good, else mint and store one"""
+        with self.ca_lock:
+            if self.ca is None:
+                os.makedirs(self.cert_dir, exist_ok=True)
+                self.ca = CertificateAuthority(self.ca_path, self.leaf_days)
+        path = os.path.join(self.cert_dir, host.replace(os.sep, "_") + PEM_SUFFIX)
+        expires = None
+        if not renew:
+            try:
+                with open(path, "rb") as file:
+                    expires = self.ca.issued(file.read())
+            except FileNotFoundError:
+                pass
+        if expires is not None and expires - time.time() > RENEW_BEFORE:
+            self.counters["disk_loads"] += 1
+        else:
+            pem, expires = self.ca.mint(host)
+            temp = f"{path}.{uuid.uuid4().hex}.tmp"
+            with open(temp, "wb") as file:
+                file.write(pem)
+            os.chmod(temp, 0o600)
+            os.replace(temp, path)
+            self.counters["renewed" if renew else "minted"] += 1
+        context = ssl.SSLContext(ssl.PROTOCOL_TLS_SERVER)
+        context.minimum_version = ssl.TLSVersion.TLSv1_2
+        # Decrypted requests go through the HTTP/1.1 pipeline
+        context.set_alpn_protocols(["http/1.1"])
+        context.load_cert_chain(path)
+        return context, expires
+
+    def _recent_hosts(self, count: int) -> List[str]:
+        try:
+            entries = [entry for entry in os.scandir(self.cert_dir) if entry.name.endswith(PEM_SUFFIX)]
+        except FileNotFoundError:
+            return []
+        entries.sort(key=lambda entry: entry.stat().st_mtime, reverse=True)
+        return [entry.name[:-len(PEM_SUFFIX)] for entry in entries[:count]]
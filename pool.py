@@ -0,0 +1,141 @@
+"""Keep-Alive Connection Pool for Upstream Connections"""
+
+from asyncio import StreamReader, StreamWriter, Task, create_task, sleep, wait_for
+from collections import OrderedDict, deque
+from typing import Deque, Dict, Optional, Tuple
+import ssl
+import time
+
+from dialer import Dialer
+from tls import default_context
+
+PoolKey = Tuple[str, str, int]
+
+
+class ConnectionPool:
+    """Bounded pool of idle upstream connections keyed by (scheme, host, port)
+
+    Connections idle for longer than idle_timeout are closed on the next
+    acquire() or release(), and by a background sweep every sweep_interval
+    seconds while any are idle, so a quiet proxy does not hold sockets the
+    origin has long given up on.
+    """
+
+    def __init__(self, max_per_origin: int = 8, max_idle: int = 256, idle_timeout: float = 30.0,
+                 dialer: Optional[Dialer] = None, sweep_interval: float = 5.0) -> None:
+        self.max_per_origin = max_per_origin
+        self.dialer = dialer if dialer is not None else Dialer()
+        self.max_idle = max_idle
+        self.idle_timeout = idle_timeout
+        self.sweep_interval = sweep_interval
+        self.sweeper: Optional[Task] = None
+        self._idle: Dict[PoolKey, Deque[Tuple[StreamReader, StreamWriter, float]]] = {}
+        # Every idle connection in release order, for global eviction and expiry sweeps
+        self._order: "OrderedDict[StreamWriter, Tuple[PoolKey, float]]" = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    async def acquire(self, key: PoolKey, ssl_context: Optional[ssl.SSLContext] = None,
+                      timeout: Optional[float] = None) -> Tuple[StreamReader, StreamWriter, bool]:
+        """Return (reader, writer, reused) for key, reusing a healthy idle connection if any"""
+        self._sweep()
+        idle = self._idle.get(key)
+        now = time.monotonic()
+        while idle:
+            reader, writer, released = idle.pop()
+            self._order.pop(writer, None)
+            if not idle:
+                del self._idle[key]
+            if now - released <= self.idle_timeout and self._healthy(reader, writer):
+                self.hits += 1
+                return reader, writer, True
+            self._discard(writer)
+        self.misses += 1
+
+        scheme, host, port = key
+        if scheme == "https" and ssl_context is None:
+            ssl_context = default_context()
+        connect = self.dialer.connect(host, port, ssl_context if scheme == "https" else None)
+        reader, writer = await wait_for(connect, timeout)
+        return reader, writer, False
+
+    def release(self, key: PoolKey, reader: StreamReader, writer: StreamWriter) -> None:
+        """Return a connection whose response has been fully read"""
+        self._sweep()
+        if not self._healthy(reader, writer):
+            writer.close()
+            return
+        idle = self._idle.setdefault(key, deque())
+        if len(idle) >= self.max_per_origin:
+            self._discard(writer)
+            return
+        now = time.monotonic()
+        idle.append((reader, writer, now))
+        self._order[writer] = (key, now)
+        while len(self._order) > self.max_idle:
+            oldest, (oldest_key, _) = self._order.popitem(last=False)
+            self._remove(oldest_key, oldest)
+            self._discard(oldest)
+        if self.sweeper is None or self.sweeper.done():
+            self.sweeper = create_task(self._run())
+
+    def stats(self) -> Dict[str, int]:
+        """Pool counters"""
+        return {
+            "hits": self.hits,
+            "misses": self.misses,
+            "evictions": self.evictions,
+            "idle": len(self._order),
+            "origins": len(self._idle),
+        }
+
+    def close(self) -> None:
+        """Close every idle connection and stop the sweep"""
+        if self.sweeper is not None:
+            self.sweeper.cancel()
+            self.sweeper = None
+        for writer in list(self._order):
+            writer.close()
+        self._idle.clear()
+        self._order.clear()
+
+    async def _run(self) -> None:
+        """Background expiry: sweep periodically until nothing is left idle"""
+        while self._order:
+            await sleep(self.sweep_interval)
+            self._sweep()
+
+    def _sweep(self) -> None:
+        """Drop idle connections past the idle timeout, oldest first"""
+        deadline = time.monotonic() - self.idle_timeout
+        while self._order:
+            writer, (key, released) = next(iter(self._order.items()))
+            if released > deadline:
+                break
+            self._order.popitem(last=False)
+            self._remove(key, writer)
+            self._discard(writer)
+
+    def _remove(self, key: PoolKey, writer: StreamWriter) -> None:
+        idle = self._idle.get(key)
+        if not idle:
+            return
+        for entry in idle:
+            if entry[1] is writer:
+                idle.remove(entry)
+                break
+        if not idle:
+            del self._idle[key]
+
+    def _discard(self, writer: StreamWriter) -> None:
+        self.evictions += 1
+        writer.close()
+
+    @staticmethod
+    def _healthy(reader: StreamReader, writer: StreamWriter) -> bool:
+        """An idle connection is only reusable if the peer has not closed or sent anything"""
+        if writer.is_closing() or reader.at_eof() or reader.exception() is not None:
+            return False
+        # Bytes waiting on an idle connection mean the framing is out of sync
+        return not getattr(reader, "_buffer", b"")
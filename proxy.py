@@ -1,17 +1,29 @@
 """Proxy Implementation with LRFU Cache Support"""
 
-from http.client import HTTPConnection, HTTPSConnection
 from urllib.parse import urlparse, ParseResult
-from typing import Dict, Tuple
+from typing import Dict, Optional, Tuple
 import socket
 import asyncio
 import ssl
 import signal
 import logging
+import time
 import uvloop
 import certifi
 
+from accesslog import AccessLog, note
+from bodystore import BodyStore
 from cache import LRFUCache
+from LRU import LRUCache
+from tiered import TieredCache
+from http1 import BodyTooLarge, RequestBody, keep_alive, read_headers
+from httpcache import HTTPCache
+from dialer import Dialer
+from metrics import BYTES_BUCKETS, Histogram, LoopMonitor, MetricsServer, Snapshot, render
+from resolver import Resolver
+from tls import TLSClient
+from upstream import UpstreamClient
+import tunnel
 
 asyncio.set_event_loop_policy(uvloop.EventLoopPolicy())
 
@@ -25,49 +37,140 @@ logging.basicConfig(
 class Proxy:
     """Proxy Implementation"""
 
-    def __init__(self, host: str = "0.0.0.0", port: int = 8443, buffer_size: int = 4096) -> None:
+    def __init__(self, host: str = "0.0.0.0", port: int = 8443, buffer_size: int = tunnel.DEFAULT_BUFFER,
+                 keepalive_timeout: float = 15.0, max_requests: int = 100,
+                 max_object_size: int = 8 * 1024 * 1024, max_body_size: int = 64 * 1024 * 1024,
+                 tunnel_engine: str = "auto", max_cache_bytes: int = 256 * 1024 * 1024,
+                 memory_cache_bytes: int = 64 * 1024 * 1024, body_dir: str = "cache_bodies",
+                 dns_prefer: str = "ipv4", connect_timeout: float = 10.0, metrics_port: int = 0,
+                 access_log: Optional[str] = None, access_log_sample: float = 1.0) -> None:
         self.host = host
         self.port = port
         self.buffer_size = buffer_size
+        self.keepalive_timeout = keepalive_timeout
+        self.max_requests = max_requests
+        self.max_object_size = max_object_size
+        self.max_body_size = max_body_size
+        self.tunnel_engine = tunnel_engine
         self.stop_event = asyncio.Event()
-        self.cache = LRFUCache()
+        # Hot objects are served from memory; SQLite keeps the cache warm across restarts
+        hot = LRUCache(100000, memory_cache_bytes, max_object_size)
+        self.cache = TieredCache(hot, LRFUCache(max_bytes=max_cache_bytes, max_object_size=max_object_size))
+        # Large bodies live in files and are sent with sendfile (or mmap under uvloop)
+        self.http_cache = HTTPCache(self.cache, max_object_size, bodies=BodyStore(body_dir))
+        # Cached DNS, IPv4 first by default as the old AF_INET-only connects were
+        self.resolver = Resolver(prefer=dns_prefer)
+        self.dialer = Dialer(self.resolver, total_timeout=connect_timeout)
+        # Built once: parsing the CA bundle per request dominated HTTPS misses
+        self.tls = TLSClient()
+        self.tls_context = self.tls.context(certifi.where())
+        self.upstream = UpstreamClient(dialer=self.dialer)
+        # Prometheus endpoint on localhost:metrics_port (0: off)
+        self.metrics_port = metrics_port
+        self.connections = 0
+        self.requests = 0
+        self.tunnels = 0
+        self.request_seconds = Histogram()
+        self.tunnel_seconds = Histogram()
+        self.tunnel_bytes = Histogram(BYTES_BUCKETS)
+        self.loop_monitor = LoopMonitor()
+        # JSON lines written off the event loop; None turns request logging off
+        self.access_log = AccessLog(access_log, access_log_sample) if access_log else None
+
+    def stats(self) -> Dict[str, float]:
+        """Counters from every component, prefixed with the component name"""
+        stats: Dict[str, float] = {"connections": self.connections, "requests": self.requests,
+                                   "tunnels": self.tunnels}
+        components = (
+            ("http_cache", self.http_cache.stats()), ("cache", self.cache.stats()),
+            ("bodies", self.http_cache.bodies.stats()), ("dns", self.resolver.stats()),
+            ("dialer", self.dialer.stats()), ("pool", self.upstream.pool.stats()),
+            ("tls", self.tls.stats()), ("loop", self.loop_monitor.stats()),
+        )
+        if self.access_log is not None:
+            components += (("access_log", self.access_log.stats()),)
+        for name, values in components:
+            for key, value in values.items():
+                stats[f"{name}_{key}"] = value
+        return stats
+
+    def histograms(self) -> Dict[str, Snapshot]:
+        """Latency and size histograms from every component, named like stats()"""
+        histograms = {"request_seconds": self.request_seconds, "tunnel_seconds": self.tunnel_seconds,
+                      "tunnel_bytes": self.tunnel_bytes}
+        components = (
+            ("http_cache", self.http_cache.histograms()), ("dialer", self.dialer.histograms()),
+            ("upstream", self.upstream.histograms()), ("loop", self.loop_monitor.histograms()),
+        )
+        for name, values in components:
+            for key, value in values.items():
+                histograms[f"{name}_{key}"] = value
+        return {name: histogram.snapshot() for name, histogram in histograms.items()}
 
     async def __handle_client(self, reader: asyncio.StreamReader, writer: asyncio.StreamWriter):
-        """Handle incoming client request"""
+        """Handle incoming client requests until the connection stops being persistent"""
+        self.connections += 1
+        client = None
+        if self.access_log is not None:
+            peer = writer.get_extra_info("peername")
+            client = f"{peer[0]}:{peer[1]}" if isinstance(peer, tuple) else None
         try:
-            initial = await reader.readline()
-            method, url, version = initial.decode("utf-8").strip().split(" ")
-            headers = {}
-            body = b""
-
-            while True:
-                line = await reader.readline()
-                if line == b"\r\n":
+            served = 0
+            while served < self.max_requests and not self.stop_event.is_set():
+                try:
+                    initial = await asyncio.wait_for(reader.readline(), self.keepalive_timeout)
+                except asyncio.TimeoutError:
+                    break
+                if not initial:
+                    break
+                if initial in (b"\r\n", b"\n"):
+                    continue
+                start = time.perf_counter()
+                method, url, version = initial.decode("utf-8").strip().split(" ")
+                record = self.access_log.start(client, method, url, version) if self.access_log else None
+                headers = dict(await read_headers(reader))
+                body = RequestBody(reader, list(headers.items()), self.max_body_size, writer, version)
+                served += 1
+                self.requests += 1
+
+                if body.too_large:
+                    note(status=413)
+                    writer.write(f"{version} 413 Content Too Large\r\nContent-Length: 0\r\n"
+                                 "Connection: close\r\n\r\n".encode())
+                    await writer.drain()
+                    if record is not None:
+                        self.access_log.finish(record)
                     break
-                header = line.decode("utf-8").strip()
-                if ":" in header:
-                    key, value = header.split(":", 1)
-                    headers[key.strip()] = value.strip()
 
-            content_len = headers.get("Content-Length")
-            if content_len:
-                body = await reader.readexactly(int(content_len))
+                if method.upper() == "CONNECT":
+                    host, port = url.split(":", 1)
+                    writer.write(
+                        f"{version} 200 Connection established\r\n\r\n".encode())
+                    await writer.drain()
+                    note(cache="TUNNEL", status=200)
+                    await self.__handle_connect(reader, writer, (host, int(port)))
+                    if record is not None:
+                        self.access_log.finish(record)
+                    break
 
-            if method.upper() == "CONNECT":
-                host, port = url.split(":", 1)
-                writer.write(
-                    f"{version} 200 Connection established\r\n\r\n".encode())
-                await writer.drain()
-                await self.__handle_connect(reader, writer, (host, int(port)))
-            else:
+                persistent = served < self.max_requests and keep_alive(version, list(headers.items()))
                 parsed = urlparse(url)
-                await self.__handle_http(parsed, method, headers, body, writer, version)
+                reusable = await self.__handle_http(parsed, method, headers, body, writer, version, persistent)
+                self.request_seconds.observe(time.perf_counter() - start)
+                if record is not None:
+                    self.access_log.finish(record)
+                if not reusable:
+                    break
+                # An unread body would be parsed as the next request
+                if not persistent or not body.consumed:
+                    break
 
         except asyncio.IncompleteReadError:
             logging.warning("[-] Incomplete read")
         except (ValueError, IndexError, UnicodeDecodeError, OSError) as e:
             logging.exception("[!] Error in __handle_client: %s", e)
         finally:
+            self.connections -= 1
             if not writer.is_closing():
                 writer.close()
                 await writer.wait_closed()
@@ -76,87 +179,87 @@ class Proxy:
         """Handle HTTPS CONNECT tunnel"""
         host, port = target
         try:
-            logging.info("[+] CONNECT to %s:%s", host, port)
-            target_reader, target_writer = await asyncio.open_connection(host=host, port=port, family=socket.AF_INET)
+            start = time.perf_counter()
+            target_reader, target_writer = await self.dialer.connect(host, port)
+            note(upstream=f"{host}:{port}", upstream_seconds=time.perf_counter() - start)
             await writer.drain()
 
-            await asyncio.gather(
-                self.__relay(reader, target_writer),
-                self.__relay(target_reader, writer)
-            )
+            start = time.perf_counter()
+            self.tunnels += 1
+            relay = asyncio.ensure_future(tunnel.relay(
+                reader, writer, target_reader, target_writer, self.tunnel_engine, self.buffer_size))
+            stop = asyncio.ensure_future(self.stop_event.wait())
+            try:
+                await asyncio.wait((relay, stop), return_when=asyncio.FIRST_COMPLETED)
+            finally:
+                self.tunnels -= 1
+            stop.cancel()
+            if not relay.done():
+                relay.cancel()
+            else:
+                logging.debug("[+] CONNECT %s:%s relayed %s bytes", host, port, relay.result())
+                self.tunnel_seconds.observe(time.perf_counter() - start)
+                self.tunnel_bytes.observe(relay.result())
+                note(sent=relay.result())
         except (OSError, asyncio.TimeoutError, ConnectionError) as e:
             logging.error("[!] CONNECT error to %s:%s - %s", host, port, e)
 
-    async def __relay(self, reader: asyncio.StreamReader, writer: asyncio.StreamWriter):
-        """Relay data between client and target"""
-        try:
-            while not reader.at_eof() and not self.stop_event.is_set():
-                data = await reader.read(self.buffer_size)
-                if not data:
-                    break
-                writer.write(data)
-                await writer.drain()
-        except (asyncio.IncompleteReadError, ConnectionResetError, OSError) as e:
-            logging.error("[!] Relay error: %s", e)
-        finally:
-            if not writer.is_closing():
-                writer.close()
-                await writer.wait_closed()
-
-    async def __handle_http(self, data: ParseResult, method: str, headers: Dict[str, str], body: bytes, writer: asyncio.StreamWriter, version: str):
-        """Handle regular HTTP(S) request"""
+    async def __handle_http(self, data: ParseResult, method: str, headers: Dict[str, str], body: RequestBody,
+                            writer: asyncio.StreamWriter, version: str, persistent: bool = False) -> bool:
+        """Handle regular HTTP(S) request, returning whether the client connection is reusable"""
+        # Set when fetch() fails: every path asks upstream before writing anything, so the client
+        # has not seen a response head yet and can still be told about it
+        upstream_failed = False
         try:
             full_url = data.geturl()
             host = data.hostname
             port = data.port or (443 if data.scheme == "https" else 80)
 
             if not host:
+                note(status=502)
                 writer.write(
                     f"{version} 502 Bad Gateway\r\nContent-Length: 0\r\n\r\n".encode())
                 await writer.drain()
                 logging.warning("[!] No host found in URL")
-                return
+                return True
 
             path = data.path or "/"
             if data.query:
                 path += f"?{data.query}"
 
-            logging.info("[+] HTTP %s %s://%s:%s%s", method,
-                         data.scheme, host, port, path)
-
-            cached = self.cache.get(method, full_url, headers, body)
-            if cached:
-                logging.debug("[+] Serving from cache")
-                writer.write(cached)
-                await writer.drain()
-                return
-
-            context = ssl.create_default_context(ssl.Purpose.CLIENT_AUTH)
-            context.load_verify_locations(cafile=certifi.where())
-
-            conn = HTTPSConnection(
-                host, port, context=context) if data.scheme == "https" else HTTPConnection(host, port)
-            conn.request(method, path, body=body, headers=headers)
-            response = conn.getresponse()
-            content = response.read()
-
-            response_headers = f"{version} {response.status} {response.reason}\r\n"
-            for key, value in response.getheaders():
-                clean_value = value.replace("\r", "").replace("\n", "")
-                response_headers += f"{key}: {clean_value}\r\n"
-            response_headers += "\r\n"
-
-            full_response = response_headers.encode() + content
-            self.cache.set(method, full_url, headers, body, full_response)
-
-            writer.write(full_response)
+            async def fetch(send_headers):
+                nonlocal upstream_failed
+                start = time.perf_counter()
+                try:
+                    response = await self.upstream.request(
+                        data.scheme, host, port, method, path, send_headers, body,
+                        ssl_context=self.tls_context if data.scheme == "https" else None)
+                except Exception:
+                    upstream_failed = True
+                    raise
+                note(upstream=f"{host}:{port}", upstream_seconds=time.perf_counter() - start)
+                return response
+
+            return await self.http_cache.serve(fetch, writer, method, full_url, list(headers.items()), body,
+                                               version, persistent)
+
+        except BodyTooLarge as e:
+            logging.warning("[!] %s for %s %s", e, method, data.geturl())
+            note(status=413)
+            writer.write(f"{version} 413 Content Too Large\r\nContent-Length: 0\r\n"
+                         "Connection: close\r\n\r\n".encode())
             await writer.drain()
-
-        except (ssl.SSLError, socket.error, ConnectionError, TimeoutError, OSError, ValueError) as e:
+            return False
+        except (ssl.SSLError, socket.error, ConnectionError, TimeoutError, OSError, ValueError,
+                asyncio.IncompleteReadError) as e:
             logging.error("[!] HTTP error for %s %s to %s:%s - %s", method,
                           data.geturl(), data.hostname, data.port or 'default', e)
-
+            if upstream_failed:
+                note(status=502)
+                writer.write(f"{version} 502 Bad Gateway\r\nContent-Length: 0\r\n"
+                             "Connection: close\r\n\r\n".encode())
             await writer.drain()
+            return False
 
     async def main(self):
         """Run Proxy"""
@@ -173,10 +276,24 @@ class Proxy:
         loop.add_signal_handler(signal.SIGINT, shutdown)
         loop.add_signal_handler(signal.SIGTERM, shutdown)
 
+        self.loop_monitor.start()
+        metrics = None
+        if self.metrics_port:
+            metrics = MetricsServer(lambda: render(self.stats(), self.histograms()))
+            await metrics.start("127.0.0.1", self.metrics_port)
+
         async with server:
             await self.stop_event.wait()
             server.close()
             await server.wait_closed()
+            if metrics is not None:
+                await metrics.close()
+            self.loop_monitor.stop()
+            if self.access_log is not None:
+                self.access_log.close()
+            self.upstream.pool.close()
+            await self.cache.aclose()
+            self.cache.close()
 
 
 if __name__ == "__main__":
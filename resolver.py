@@ -0,0 +1,399 @@
+"""Caching Asynchronous DNS Resolver"""
+
+from asyncio import (
+    DatagramProtocol, Future, Task, create_task, gather, get_running_loop, open_connection, shield, wait_for,
+)
+from collections import OrderedDict
+from typing import Dict, List, Optional, Set, Tuple
+import ipaddress
+import logging
+import random
+import socket
+import struct
+import time
+
+Address = Tuple[int, str]  # socket family, address
+
+TYPE_A = 1
+TYPE_CNAME = 5
+TYPE_SOA = 6
+TYPE_AAAA = 28
+RCODE_NXDOMAIN = 3
+FLAG_TC = 0x0200
+
+PREFERENCES = ("ipv4", "ipv6", "ipv4_only", "ipv6_only")
+
+
+class DNSError(Exception):
+    """A query that got no usable answer from any nameserver"""
+
+
+def system_nameservers(path: str = "/etc/resolv.conf") -> List[Tuple[str, int]]:
+    """Nameservers listed in resolv.conf, or none where there is no such file"""
+    servers = []
+    try:
+        with open(path, "r", encoding="utf-8") as file:
+            for line in file:
+                fields = line.split()
+                if len(fields) >= 2 and fields[0] == "nameserver":
+                    servers.append((fields[1].split("%", 1)[0], 53))
+    except OSError:
+        pass
+    return servers
+
+
+def parse_nameserver(text: str) -> Tuple[str, int]:
+    """ "1.1.1.1", "127.0.0.1:5353", "2606:4700::1111" or "[::1]:5353" as (address, port)"""
+    if text.startswith("["):
+        address, _, port = text[1:].partition("]")
+        return address, int(port.lstrip(":") or 53)
+    if text.count(":") == 1:
+        address, _, port = text.partition(":")
+        return address, int(port)
+    return text, 53
+
+
+def hosts_file(path: str = "/etc/hosts") -> Dict[str, List[Address]]:
+    """Static names from the hosts file"""
+    hosts: Dict[str, List[Address]] = {}
+    try:
+        with open(path, "r", encoding="utf-8", errors="ignore") as file:
+            for line in file:
+                fields = line.split("#", 1)[0].split()
+                if len(fields) < 2:
+                    continue
+                try:
+                    family = socket.AF_INET6 if ipaddress.ip_address(fields[0]).version == 6 else socket.AF_INET
+                except ValueError:
+                    continue
+                for name in fields[1:]:
+                    hosts.setdefault(name.lower(), []).append((family, fields[0]))
+    except OSError:
+        pass
+    return hosts
+
+
+def build_query(name: str, qtype: int) -> Tuple[int, bytes]:
+    """A recursive query for name, returning (id, packet)"""
+    ident = random.getrandbits(16)
+    packet = struct.pack(">HHHHHH", ident, 0x0100, 1, 0, 0, 0)
+    for label in name.encode("idna").split(b"."):
+        if label:
+            packet += bytes((len(label),)) + label
+    return ident, packet + struct.pack(">BHH", 0, qtype, 1)
+
+
+def _read_name(data: bytes, offset: int) -> int:
+    """Offset just past the (possibly compressed) name at offset"""
+    while True:
+        length = data[offset]
+        if length & 0xC0 == 0xC0:
+            return offset + 2
+        offset += 1
+        if not length:
+            return offset
+        offset += length
+
+
+def parse_response(data: bytes, ident: int, qtype: int) -> Tuple[int, List[str], Optional[float]]:
+    """(rcode, addresses, ttl) from a response; ttl is the negative-caching TTL when there are no addresses
+
+    Address records are collected whatever their owner name, as a stub
+    resolver does with the CNAME chain a recursive server hands back; the
+    TTL is the smallest along that chain.
+    """
+    answer_id, flags, questions, answers, authority, _ = struct.unpack_from(">HHHHHH", data)
+    if answer_id != ident or not flags & 0x8000:
+        raise DNSError("response does not match the query")
+    if flags & FLAG_TC:
+        raise DNSError("truncated")
+    rcode = flags & 0x000F
+    offset = 12
+    for _ in range(questions):
+        offset = _read_name(data, offset) + 4
+    addresses: List[str] = []
+    ttl: Optional[float] = None
+    negative_ttl: Optional[float] = None
+    for index in range(answers + authority):
+        offset = _read_name(data, offset)
+        rtype, _, record_ttl, length = struct.unpack_from(">HHIH", data, offset)
+        offset += 10
+        rdata = data[offset:offset + length]
+        if index < answers:
+            if rtype == qtype == TYPE_A and length == 4:
+                addresses.append(socket.inet_ntop(socket.AF_INET, rdata))
+            elif rtype == qtype == TYPE_AAAA and length == 16:
+                addresses.append(socket.inet_ntop(socket.AF_INET6, rdata))
+            if rtype in (TYPE_A, TYPE_AAAA, TYPE_CNAME):
+                ttl = record_ttl if ttl is None else min(ttl, record_ttl)
+        elif rtype == TYPE_SOA:
+            # RFC 2308: negative answers live for min(SOA TTL, SOA MINIMUM)
+            minimum = struct.unpack_from(">I", data, _read_name(data, _read_name(data, offset)) + 16)[0]
+            negative_ttl = min(record_ttl, minimum)
+        offset += length
+    if not addresses and rcode not in (0, RCODE_NXDOMAIN):
+        raise DNSError(f"server answered rcode {rcode}")
+    return rcode, addresses, ttl if addresses else negative_ttl
+
+
+class _Reply(DatagramProtocol):
+    def __init__(self, future: Future) -> None:
+        self.future = future
+
+    def datagram_received(self, data: bytes, addr) -> None:
+        if not self.future.done():
+            self.future.set_result(data)
+
+    def error_received(self, exc: Exception) -> None:
+        if not self.future.done():
+            self.future.set_exception(exc)
+
+
+class _Entry:
+    __slots__ = ("addresses", "expires", "ttl", "hits", "refreshing")
+
+    def __init__(self, addresses: List[Address], ttl: float) -> None:
+        self.addresses = addresses
+        self.ttl = ttl
+        self.expires = time.monotonic() + ttl
+        self.hits = 0
+        self.refreshing = False
+
+
+class Resolver:
+    """Resolves hostnames over UDP/TCP DNS with a TTL-respecting cache
+
+    Answers are cached for their record TTL (clamped to min_ttl..max_ttl),
+    failures (NXDOMAIN or no records) for the SOA negative TTL or
+    negative_ttl. Concurrent lookups of one name share a single query, and a
+    name that keeps being used is refreshed in the background once less
+    than prefetch_fraction of its TTL remains, so hot names never expire on
+    the request path. prefer orders IPv4 and IPv6 results ("ipv4", "ipv6")
+    or restricts them ("ipv4_only", "ipv6_only").
+
+    Nameservers default to /etc/resolv.conf; /etc/hosts is honoured. Single
+    label names (which need search domains) and systems with no nameserver
+    list go to getaddrinfo in a thread and are cached for system_ttl.
+    """
+
+    def __init__(self, nameservers: Optional[List[Tuple[str, int]]] = None, prefer: str = "ipv4",
+                 timeout: float = 2.0, attempts: int = 2, min_ttl: float = 1.0, max_ttl: float = 3600.0,
+                 negative_ttl: float = 30.0, system_ttl: float = 60.0, prefetch_fraction: float = 0.1,
+                 max_entries: int = 10000, hosts: Optional[Dict[str, List[Address]]] = None) -> None:
+        if prefer not in PREFERENCES:
+            raise ValueError(f"Unknown address preference: {prefer}")
+        self.nameservers = nameservers if nameservers is not None else system_nameservers()
+        self.prefer = prefer
+        self.timeout = timeout
+        self.attempts = attempts
+        self.min_ttl = min_ttl
+        self.max_ttl = max_ttl
+        self.negative_ttl = negative_ttl
+        self.system_ttl = system_ttl
+        self.prefetch_fraction = prefetch_fraction
+        self.max_entries = max_entries
+        self.hosts = hosts if hosts is not None else hosts_file()
+        self.cache: "OrderedDict[str, _Entry]" = OrderedDict()
+        self.inflight: Dict[str, Future] = {}
+        self.tasks: Set[Task] = set()
+        self.counters = {"hits": 0, "misses": 0, "negative_hits": 0, "coalesced": 0, "prefetches": 0,
+                         "queries": 0, "errors": 0, "system_lookups": 0}
+
+    async def resolve(self, host: str) -> List[Address]:
+        """Addresses for host in preference order; socket.gaierror if it does not resolve"""
+        host = host.lower().rstrip(".")
+        try:
+            host.encode("idna")
+        except UnicodeError:
+            raise socket.gaierror(socket.EAI_NONAME, f"{host!r} is not a valid hostname")
+        literal = self._literal(host)
+        if literal is not None:
+            return literal
+        static = self.hosts.get(host)
+        if static is not None:
+            return self._order(static)
+
+        entry = self.cache.get(host)
+        if entry is not None and entry.expires > time.monotonic():
+            self.cache.move_to_end(host)
+            entry.hits += 1
+            if not entry.addresses:
+                self.counters["negative_hits"] += 1
+                raise socket.gaierror(socket.EAI_NONAME, f"{host} does not resolve (cached)")
+            self.counters["hits"] += 1
+            if entry.hits > 1 and not entry.refreshing and host not in self.inflight and \
+                    entry.expires - time.monotonic() < entry.ttl * self.prefetch_fraction:
+                entry.refreshing = True
+                self.counters["prefetches"] += 1
+                task = create_task(self._lookup(host))
+                self.tasks.add(task)
+                task.add_done_callback(self._prefetched)
+            return self._order(entry.addresses)
+
+        pending = self.inflight.get(host)
+        if pending is not None:
+            self.counters["coalesced"] += 1
+            # Shielded: a follower that times out or goes away must not cancel everyone's lookup
+            addresses = await shield(pending)
+        else:
+            self.counters["misses"] += 1
+            addresses = await self._lookup(host)
+        if not addresses:
+            raise socket.gaierror(socket.EAI_NONAME, f"{host} does not resolve")
+        return self._order(addresses)
+
+    def stats(self) -> Dict[str, int]:
+        """Hit, miss and query counters"""
+        return dict(self.counters, entries=len(self.cache))
+
+    def clear(self) -> None:
+        self.cache.clear()
+
+    def _prefetched(self, task: Task) -> None:
+        self.tasks.discard(task)
+        if not task.cancelled() and task.exception() is not None:
+            logging.debug("DNS prefetch failed: %s", task.exception())
+
+    async def _lookup(self, host: str) -> List[Address]:
+        """Query and cache one name, sharing the result with concurrent callers"""
+        future = get_running_loop().create_future()
+        self.inflight[host] = future
+        try:
+            addresses, ttl = await self._query(host)
+        except BaseException as e:
+            self.counters["errors"] += 1
+            if not future.done():
+                if not isinstance(e, Exception):
+                    # The leader was cancelled; followers get an ordinary resolution failure
+                    e = socket.gaierror(socket.EAI_AGAIN, f"lookup of {host} was abandoned")
+                future.set_exception(e)
+                # Followers get the exception; mark it retrieved in case there are none
+                future.exception()
+            stale = self.cache.get(host)
+            if stale is not None:
+                stale.refreshing = False
+            raise
+        else:
+            if not future.done():
+                future.set_result(addresses)
+        finally:
+            del self.inflight[host]
+        self._store(host, addresses, ttl)
+        return addresses
+
+    def _store(self, host: str, addresses: List[Address], ttl: float) -> None:
+        self.cache.pop(host, None)
+        self.cache[host] = _Entry(addresses, ttl)
+        while len(self.cache) > self.max_entries:
+            self.cache.popitem(last=False)
+
+    async def _query(self, host: str) -> Tuple[List[Address], float]:
+        """Addresses and how long to cache them (an empty list is a negative answer)"""
+        if not self.nameservers or "." not in host:
+            return await self._system(host)
+        types = []
+        if self.prefer != "ipv6_only":
+            types.append((socket.AF_INET, TYPE_A))
+        if self.prefer != "ipv4_only":
+            types.append((socket.AF_INET6, TYPE_AAAA))
+        addresses: List[Address] = []
+        ttls: List[float] = []
+        negative_ttls: List[float] = []
+        failures = 0
+        for (family, qtype), result in zip(types, await self._gather(host, [qtype for _, qtype in types])):
+            if isinstance(result, DNSError):
+                failures += 1
+                continue
+            _, found, ttl = result
+            if found:
+                addresses.extend((family, address) for address in found)
+                ttls.append(ttl if ttl is not None else self.system_ttl)
+            else:
+                negative_ttls.append(ttl if ttl is not None else self.negative_ttl)
+        if addresses:
+            return addresses, self._clamp(min(ttls))
+        if failures == len(types):
+            # Nameservers unreachable or failing; the system resolver may still manage
+            return await self._system(host)
+        return [], self._clamp(min(negative_ttls))
+
+    async def _gather(self, host: str, qtypes: List[int]) -> list:
+        results = await gather(*(self._ask(host, qtype) for qtype in qtypes), return_exceptions=True)
+        for result in results:
+            if isinstance(result, BaseException) and not isinstance(result, DNSError):
+                raise result
+        return results
+
+    async def _ask(self, host: str, qtype: int) -> Tuple[int, List[str], Optional[float]]:
+        """One question, trying each nameserver in turn for the configured attempts"""
+        last: Exception = DNSError("no nameservers")
+        for _ in range(self.attempts):
+            for server in self.nameservers:
+                self.counters["queries"] += 1
+                ident, packet = build_query(host, qtype)
+                try:
+                    data = await wait_for(self._udp(server, packet), self.timeout)
+                    try:
+                        return parse_response(data, ident, qtype)
+                    except DNSError as e:
+                        if str(e) != "truncated":
+                            raise
+                    data = await wait_for(self._tcp(server, packet), self.timeout)
+                    return parse_response(data, ident, qtype)
+                except (OSError, TimeoutError, DNSError, struct.error, IndexError) as e:
+                    last = e
+        raise DNSError(f"{host}: {last}")
+
+    @staticmethod
+    async def _udp(server: Tuple[str, int], packet: bytes) -> bytes:
+        loop = get_running_loop()
+        future = loop.create_future()
+        transport, _ = await loop.create_datagram_endpoint(lambda: _Reply(future), remote_addr=server)
+        try:
+            transport.sendto(packet)
+            return await future
+        finally:
+            transport.close()
+
+    @staticmethod
+    async def _tcp(server: Tuple[str, int], packet: bytes) -> bytes:
+        reader, writer = await open_connection(*server)
+        try:
+            writer.write(struct.pack(">H", len(packet)) + packet)
+            length = struct.unpack(">H", await reader.readexactly(2))[0]
+            return await reader.readexactly(length)
+        finally:
+            writer.close()
+
+    async def _system(self, host: str) -> Tuple[List[Address], float]:
+        """getaddrinfo in the default executor, for names the stub client cannot handle"""
+        self.counters["system_lookups"] += 1
+        family = {"ipv4_only": socket.AF_INET, "ipv6_only": socket.AF_INET6}.get(self.prefer, socket.AF_UNSPEC)
+        try:
+            infos = await get_running_loop().getaddrinfo(host, None, family=family, type=socket.SOCK_STREAM)
+        except socket.gaierror as e:
+            if e.errno in (socket.EAI_NONAME, getattr(socket, "EAI_NODATA", socket.EAI_NONAME)):
+                return [], self.negative_ttl
+            raise
+        addresses = list(OrderedDict.fromkeys((info[0], info[4][0]) for info in infos))
+        return addresses, self.system_ttl
+
+    def _clamp(self, ttl: float) -> float:
+        return min(max(ttl, self.min_ttl), self.max_ttl)
+
+    def _literal(self, host: str) -> Optional[List[Address]]:
+        try:
+            address = ipaddress.ip_address(host.strip("[]"))
+        except ValueError:
+            return None
+        return [(socket.AF_INET6 if address.version == 6 else socket.AF_INET, str(address))]
+
+    def _order(self, addresses: List[Address]) -> List[Address]:
+        """Preferred family first, keeping the server's order within each family"""
+        if self.prefer == "ipv4_only":
+            return [a for a in addresses if a[0] == socket.AF_INET]
+        if self.prefer == "ipv6_only":
+            return [a for a in addresses if a[0] == socket.AF_INET6]
+        first = socket.AF_INET6 if self.prefer == "ipv6" else socket.AF_INET
+        return sorted(addresses, key=lambda address: address[0] != first)
+
@@ -0,0 +1,338 @@
+"""Cache Shared by Worker Processes over a Unix Socket"""
+
+from asyncio import (
+    Future, IncompleteReadError, StreamReader, StreamWriter, Task, create_task, get_running_loop,
+    open_unix_connection, shield, start_unix_server, wait_for,
+)
+from collections import deque
+from json import dumps, loads
+from typing import Deque, Dict, List, Optional, Set
+import logging
+import os
+import struct
+import time
+
+from bodystore import TEMP_SUFFIX, BodyRef, BodyStore
+
+# request id, op, key length, value length
+REQUEST = struct.Struct("<IBII")
+# request id, status, value length
+RESPONSE = struct.Struct("<IBI")
+SIZE = struct.Struct("<Q")
+
+GET, PUT, DELETE, STATS, BODY_ADD, BODY_TOUCH, BODY_DELETE = range(1, 8)
+MISSING, FOUND, FAILED = range(3)
+# Request id 0 asks for no response
+NO_REPLY = 0
+MAX_KEY = 64 * 1024
+MAX_VALUE = 1024 * 1024 * 1024
+
+
+def _encode_key(key: str) -> bytes:
+    return key.encode("utf-8", "surrogatepass")
+
+
+def _decode_key(key: bytes) -> str:
+    return key.decode("utf-8", "surrogatepass")
+
+
+class CacheServer:
+    """Serves one cache backend, and the accounting of a shared BodyStore, to every worker
+
+    The owner process is the only one that touches the backend, so its
+    eviction, LogStore/SQLite files and byte limits see the traffic of all
+    workers and capacity is not split between them. Requests on a connection
+    are handled concurrently and answered by request id, so a slow L2 read
+    does not hold up the hits queued behind it. Body files are written by the
+    workers straight into the shared directory; they only report them here so
+    that the store evicts across everyone's files.
+    """
+
+    def __init__(self, cache, bodies: Optional[BodyStore] = None) -> None:
+        self.cache = cache
+        self.bodies = bodies
+        self.server = None
+        self.writers: Set[StreamWriter] = set()
+        self.counters = {"gets": 0, "puts": 0, "deletes": 0, "errors": 0, "bad_frames": 0}
+
+    async def start(self, path: str) -> None:
+        """Listen on a Unix socket at path, replacing a stale one"""
+        try:
+            os.unlink(path)
+        except FileNotFoundError:
+            pass
+        self.server = await start_unix_server(self._handle, path=path)
+        # Only this user's workers may read or fill the cache
+        os.chmod(path, 0o600)
+
+    async def close(self) -> None:
+        if self.server is not None:
+            self.server.close()
+        for writer in list(self.writers):
+            writer.close()
+
+    def stats(self) -> Dict[str, float]:
+        """Backend and body store stats plus request counters, prefixed like Proxy.stats()"""
+        stats: Dict[str, float] = {"cache_clients": len(self.writers)}
+        for key, value in self.counters.items():
+            stats[f"cache_owner_{key}"] = value
+        for key, value in self.cache.stats().items():
+            stats[f"cache_{key}"] = value
+        if self.bodies is not None:
+            for key, value in self.bodies.stats().items():
+                stats[f"bodies_{key}"] = value
+        return stats
+
+    async def _handle(self, reader: StreamReader, writer: StreamWriter) -> None:
+        self.writers.add(writer)
+        tasks: Set[Task] = set()
+        try:
+            while True:
+                request_id, op, key_length, value_length = REQUEST.unpack(await reader.readexactly(REQUEST.size))
+                if key_length > MAX_KEY or value_length > MAX_VALUE:
+                    self.counters["bad_frames"] += 1
+                    logging.error(f"Cache client sent a {key_length}/{value_length} byte frame; disconnecting")
+                    return
+                key = _decode_key(await reader.readexactly(key_length))
+                value = await reader.readexactly(value_length) if value_length else b""
+                if op >= BODY_ADD:
+                    self._body(op, key, value)
+                    continue
+                task = create_task(self._serve(writer, request_id, op, key, value))
+                tasks.add(task)
+                task.add_done_callback(tasks.discard)
+        except (IncompleteReadError, ConnectionError):
+            pass  # Worker exited or restarted
+        finally:
+            for task in tasks:
+                task.cancel()
+            self.writers.discard(writer)
+            writer.close()
+
+    async def _serve(self, writer: StreamWriter, request_id: int, op: int, key: str, value: bytes) -> None:
+        result: Optional[bytes] = None
+        status = MISSING
+        try:
+            if op == GET:
+                self.counters["gets"] += 1
+                result = await self.cache.aget(key)
+            elif op == PUT:
+                self.counters["puts"] += 1
+                await self.cache.aput(key, value)
+            elif op == DELETE:
+                self.counters["deletes"] += 1
+                await self.cache.adelete(key)
+            elif op == STATS:
+                result = dumps(self.stats()).encode()
+            else:
+                raise ValueError(f"unknown op {op}")
+            if result is not None:
+                status = FOUND
+        except Exception as e:
+            self.counters["errors"] += 1
+            logging.error("Shared cache request failed: %s", e)
+            status, result = FAILED, None
+        if request_id == NO_REPLY or writer.is_closing():
+            return
+        writer.write(RESPONSE.pack(request_id, status, len(result) if result else 0))
+        if result:
+            writer.write(result)
+
+    def _body(self, op: int, name: str, value: bytes) -> None:
+        if self.bodies is None:
+            return
+        if op == BODY_ADD:
+            self.bodies.add(name, SIZE.unpack(value)[0])
+        elif op == BODY_TOUCH:
+            self.bodies.touch(name)
+        elif op == BODY_DELETE:
+            self.bodies.delete(name)
+
+
+class CacheClient:
+    """Cache backend that forwards aget/aput/adelete to a CacheServer
+
+    Drop-in for the in-process caches behind httpcache.HTTPCache. All
+    requests share one connection and are matched to responses by id. The
+    cache is an optimization, so an owner that is down, slow or restarting
+    turns lookups into misses and writes into no-ops instead of failing
+    requests; reconnects are attempted at most every retry_interval seconds.
+    """
+
+    def __init__(self, path: str, timeout: float = 1.0, retry_interval: float = 1.0,
+                 max_backlog: int = 4096) -> None:
+        self.path = path
+        self.timeout = timeout
+        self.retry_interval = retry_interval
+        self.reader: Optional[StreamReader] = None
+        self.writer: Optional[StreamWriter] = None
+        self.receiver: Optional[Task] = None
+        self.connecting: Optional[Task] = None
+        self.retry_at = 0.0
+        # Warn once per outage, not on every reconnect attempt
+        self.warned = False
+        self.next_id = 0
+        self.waiting: Dict[int, Future] = {}
+        # Notifications sent while disconnected, delivered on reconnect
+        self.backlog: Deque[bytes] = deque(maxlen=max_backlog)
+        self.counters = {"remote_gets": 0, "remote_puts": 0, "remote_deletes": 0, "remote_errors": 0,
+                         "remote_timeouts": 0, "unavailable": 0, "connects": 0}
+
+    async def aget(self, key: str) -> Optional[bytes]:
+        self.counters["remote_gets"] += 1
+        return await self._call(GET, key)
+
+    async def aput(self, key: str, value: bytes) -> None:
+        self.counters["remote_puts"] += 1
+        await self._call(PUT, key, value)
+
+    async def adelete(self, key: str) -> None:
+        self.counters["remote_deletes"] += 1
+        await self._call(DELETE, key)
+
+    async def astats(self) -> Dict[str, float]:
+        """The owner's stats, or {} if it cannot be reached"""
+        data = await self._call(STATS, "")
+        return loads(data) if data else {}
+
+    def notify(self, op: int, key: str, value: bytes = b"") -> None:
+        """Send a request that needs no answer without waiting for it"""
+        frame = self._frame(NO_REPLY, op, key, value)
+        if self._connected():
+            self.writer.writelines(frame)
+            return
+        self.backlog.append(b"".join(frame))
+        if self.connecting is None and time.monotonic() >= self.retry_at:
+            self.connecting = create_task(self._connect())
+
+    def stats(self) -> Dict[str, int]:
+        """Request counters; the cache's own stats live in the owner process"""
+        return dict(self.counters, in_flight=len(self.waiting))
+
+    def close(self) -> None:
+        if self.writer is not None:
+            self.writer.close()
+        if self.receiver is not None:
+            self.receiver.cancel()
+
+    def _connected(self) -> bool:
+        return self.writer is not None and not self.writer.is_closing()
+
+    def _frame(self, request_id: int, op: int, key: str, value: bytes) -> List[bytes]:
+        encoded = _encode_key(key)
+        return [REQUEST.pack(request_id, op, len(encoded), len(value)), encoded, value]
+
+    async def _call(self, op: int, key: str, value: bytes = b"") -> Optional[bytes]:
+        if not self._connected():
+            if self.connecting is None:
+                if time.monotonic() < self.retry_at:
+                    self.counters["unavailable"] += 1
+                    return None
+                self.connecting = create_task(self._connect())
+            if not await shield(self.connecting):
+                self.counters["unavailable"] += 1
+                return None
+        self.next_id = self.next_id % 0xFFFFFFFF + 1
+        request_id = self.next_id
+        future = get_running_loop().create_future()
+        self.waiting[request_id] = future
+        try:
+            self.writer.writelines(self._frame(request_id, op, key, value))
+            await self.writer.drain()
+            return await wait_for(future, self.timeout)
+        except TimeoutError:
+            self.counters["remote_timeouts"] += 1
+            return None
+        except (ConnectionError, RuntimeError) as e:
+            self.counters["remote_errors"] += 1
+            logging.debug("Shared cache request failed: %s", e)
+            return None
+        finally:
+            self.waiting.pop(request_id, None)
+
+    async def _connect(self) -> bool:
+        try:
+            self.reader, self.writer = await wait_for(open_unix_connection(self.path), self.timeout)
+        except (OSError, TimeoutError) as e:
+            if not self.warned:
+                self.warned = True
+                logging.warning(f"Shared cache at {self.path} is unavailable, serving without it: {e}")
+            self.retry_at = time.monotonic() + self.retry_interval
+            return False
+        finally:
+            self.connecting = None
+        self.counters["connects"] += 1
+        self.warned = False
+        self.receiver = create_task(self._receive(self.reader))
+        while self.backlog:
+            self.writer.write(self.backlog.popleft())
+        return True
+
+    async def _receive(self, reader: StreamReader) -> None:
+        """Resolve waiting requests as their responses arrive"""
+        try:
+            while True:
+                request_id, status, length = RESPONSE.unpack(await reader.readexactly(RESPONSE.size))
+                value = await reader.readexactly(length) if length else b""
+                future = self.waiting.pop(request_id, None)
+                if future is None or future.done():
+                    continue  # Timed out meanwhile
+                if status == FAILED:
+                    future.set_exception(RuntimeError("the cache owner could not serve the request"))
+                else:
+                    future.set_result(value if status == FOUND else None)
+        except (IncompleteReadError, ConnectionError):
+            logging.warning(f"Lost the shared cache at {self.path}")
+        finally:
+            if self.writer is not None:
+                self.writer.close()
+            self.writer = self.reader = None
+            self.retry_at = time.monotonic() + self.retry_interval
+            for future in self.waiting.values():
+                if not future.done():
+                    future.set_exception(ConnectionError("the cache owner went away"))
+            self.waiting.clear()
+
+
+class RemoteBodyStore(BodyStore):
+    """Worker side of a BodyStore whose accounting lives in the cache owner
+
+    Files are written, published and opened in the shared directory as
+    usual; commits, opens and deletes are reported to the owner, which
+    holds the LRU order for every worker's files and deletes the victims.
+    Presence is checked on disk since other workers add files too.
+    """
+
+    def __init__(self, directory: str, client: CacheClient, max_body_size: int = 1024 * 1024 * 1024,
+                 spill_threshold: int = 64 * 1024) -> None:
+        self.client = client
+        self.commits = 0
+        self.opens = 0
+        super().__init__(directory, 0, max_body_size, spill_threshold)
+
+    def commit(self, name: str, size: int) -> BodyRef:
+        os.replace(self.path(name) + TEMP_SUFFIX, self.path(name))
+        self.commits += 1
+        self.client.notify(BODY_ADD, name, SIZE.pack(size))
+        return name, size
+
+    def open(self, name: str):
+        try:
+            file = open(self.path(name), "rb")
+        except FileNotFoundError:
+            return None
+        self.opens += 1
+        self.client.notify(BODY_TOUCH, name)
+        return file
+
+    def __contains__(self, name: str) -> bool:
+        return os.path.exists(self.path(name))
+
+    def delete(self, name: str) -> None:
+        self.client.notify(BODY_DELETE, name)
+
+    def stats(self) -> Dict[str, int]:
+        return {"commits": self.commits, "opens": self.opens}
+
+    def _load(self) -> None:
+        """The owner indexes the directory"""
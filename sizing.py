@@ -0,0 +1,10 @@
+"""Cache Entry Size Accounting"""
+
+from typing import Any, Hashable
+
+
+def entry_size(key: Hashable, value: Any) -> int:
+    """Bytes charged for an entry: key plus value (headers and body for responses)"""
+    key_size = len(key) if isinstance(key, (str, bytes)) else 0
+    value_size = len(value) if isinstance(value, (bytes, bytearray, memoryview, str)) else 0
+    return key_size + value_size
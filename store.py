@@ -0,0 +1,303 @@
+"""Append-Only Log Store for Cached Responses"""
+
+from queue import Empty, SimpleQueue
+from threading import Event, Lock, Thread
+from typing import Dict, Iterator, List, Optional, Tuple
+import logging
+import os
+import struct
+import zlib
+
+try:
+    import fcntl
+except ImportError:  # Windows
+    fcntl = None
+
+# crc32, flags, key length, value length
+HEADER = struct.Struct("<IBII")
+TOMBSTONE = 1
+SEGMENT_SUFFIX = ".seg"
+LOCK_FILE = "lock"
+
+Location = Tuple[int, int, int]  # segment id, value offset, value length
+
+
+class StoreLocked(OSError):
+    """Another LogStore, usually in another process, already owns the directory"""
+
+
+class LogStore:
+    """Key/value store made of append-only segment files
+
+    put() and delete() only enqueue the operation; a background thread appends
+    records in batches, so persisting an entry costs O(size of that entry) and
+    never blocks the caller. The in-memory index maps each key to the
+    segment/offset of its latest value and is rebuilt on open by scanning
+    record headers. Segments are rewritten without dead records once garbage
+    outweighs live data.
+
+    Segment numbering and compaction assume a single writer, so the store
+    holds an exclusive flock on a lock file in directory for as long as it
+    is open; opening a directory that is already in use raises StoreLocked.
+    """
+
+    def __init__(self, directory: str, segment_size: int = 64 * 1024 * 1024,
+                 flush_interval: float = 0.05, batch_size: int = 256,
+                 compact_ratio: float = 1.0, compact_min_bytes: int = 16 * 1024 * 1024,
+                 fsync: bool = False) -> None:
+        self.directory = directory
+        self.segment_size = segment_size
+        self.flush_interval = flush_interval
+        self.batch_size = batch_size
+        self.compact_ratio = compact_ratio
+        self.compact_min_bytes = compact_min_bytes
+        self.fsync = fsync
+        self.index: Dict[str, Location] = {}
+        # Writes accepted but not yet on disk; None marks a pending delete
+        self.pending: Dict[str, Optional[bytes]] = {}
+        self.live_bytes = 0
+        self.dead_bytes = 0
+        self.compactions = 0
+        self.lock = Lock()
+        self.queue: SimpleQueue = SimpleQueue()
+        self.closed = Event()
+        os.makedirs(directory, exist_ok=True)
+        self.lock_file = self._lock()
+        self._load()
+        self.active_id = max(self._segments(), default=0) + 1
+        self.active = open(self._path(self.active_id), "ab")
+        self.thread = Thread(target=self._run, name="log-store-flusher", daemon=True)
+        self.thread.start()
+
+    def __len__(self) -> int:
+        with self.lock:
+            return len(self.index) + sum(1 for key, value in self.pending.items()
+                                         if value is not None and key not in self.index)
+
+    def put(self, key: str, value: bytes) -> None:
+        """Queue a write"""
+        with self.lock:
+            self.pending[key] = value
+        self.queue.put((key, value))
+
+    def delete(self, key: str) -> None:
+        """Queue a delete"""
+        with self.lock:
+            if key not in self.index and key not in self.pending:
+                return
+            self.pending[key] = None
+        self.queue.put((key, None))
+
+    def get(self, key: str) -> Optional[bytes]:
+        """Read the latest value for key"""
+        with self.lock:
+            if key in self.pending:
+                return self.pending[key]
+            location = self.index.get(key)
+        if location is None:
+            return None
+        return self._read(key, location)
+
+    def items(self) -> Iterator[Tuple[str, bytes]]:
+        """Iterate over every stored entry"""
+        with self.lock:
+            keys = list(self.index) + [key for key in self.pending if key not in self.index]
+        for key in keys:
+            value = self.get(key)
+            if value is not None:
+                yield key, value
+
+    def flush(self) -> None:
+        """Block until everything queued so far is on disk"""
+        done = Event()
+        self.queue.put(done)
+        done.wait()
+
+    def close(self) -> None:
+        """Flush and stop the background thread"""
+        if self.closed.is_set():
+            return
+        self.flush()
+        self.closed.set()
+        self.queue.put(None)
+        self.thread.join()
+        self.active.close()
+        self.lock_file.close()
+
+    def stats(self) -> Dict[str, int]:
+        """Size counters"""
+        with self.lock:
+            return {"entries": len(self.index), "live_bytes": self.live_bytes,
+                    "dead_bytes": self.dead_bytes, "segments": len(self._segments()),
+                    "compactions": self.compactions}
+
+    def _run(self) -> None:
+        """Background flusher: write queued operations in batches"""
+        while not self.closed.is_set():
+            try:
+                item = self.queue.get(timeout=self.flush_interval)
+            except Empty:
+                continue
+            batch: List[Tuple[str, Optional[bytes]]] = []
+            waiters: List[Event] = []
+            while item is not None:
+                if isinstance(item, Event):
+                    waiters.append(item)
+                else:
+                    batch.append(item)
+                if len(batch) >= self.batch_size:
+                    break
+                try:
+                    item = self.queue.get_nowait()
+                except Empty:
+                    break
+            try:
+                if batch:
+                    self._write_batch(batch)
+                if self.dead_bytes > self.compact_min_bytes and \
+                        self.dead_bytes > self.live_bytes * self.compact_ratio:
+                    self._compact()
+            except OSError as e:
+                logging.error("Cache store write failed: %s", e)
+            for waiter in waiters:
+                waiter.set()
+
+    def _write_batch(self, batch: List[Tuple[str, Optional[bytes]]]) -> None:
+        updates: List[Tuple[str, Optional[bytes], Optional[Location]]] = []
+        for key, value in batch:
+            if self.active.tell() >= self.segment_size:
+                self._roll()
+            location = self._append(self.active, self.active_id, key, value)
+            updates.append((key, value, location))
+        self.active.flush()
+        if self.fsync:
+            os.fsync(self.active.fileno())
+
+        with self.lock:
+            for key, value, location in updates:
+                old = self.index.pop(key, None)
+                if old is not None:
+                    self.live_bytes -= old[2]
+                    self.dead_bytes += old[2]
+                if value is None:
+                    self.dead_bytes += len(key)
+                else:
+                    self.index[key] = location
+                    self.live_bytes += location[2]
+                # Only clear the pending entry if no newer operation replaced it
+                if key in self.pending and self.pending[key] is value:
+                    del self.pending[key]
+
+    def _append(self, file, segment_id: int, key: str, value: Optional[bytes]) -> Location:
+        raw_key = key.encode("utf-8")
+        payload = value if value is not None else b""
+        flags = TOMBSTONE if value is None else 0
+        crc = zlib.crc32(payload, zlib.crc32(raw_key))
+        offset = file.tell()
+        file.write(HEADER.pack(crc, flags, len(raw_key), len(payload)))
+        file.write(raw_key)
+        file.write(payload)
+        return segment_id, offset + HEADER.size + len(raw_key), len(payload)
+
+    def _roll(self) -> None:
+        self.active.flush()
+        self.active.close()
+        self.active_id += 1
+        self.active = open(self._path(self.active_id), "ab")
+
+    def _compact(self) -> None:
+        """Rewrite every live record into fresh segments and drop the old ones"""
+        self.active.flush()
+        old_segments = self._segments()
+        with self.lock:
+            snapshot = dict(self.index)
+        self.active.close()
+        self.active_id += 1
+        self.active = open(self._path(self.active_id), "ab")
+
+        moved: Dict[str, Location] = {}
+        for key, location in snapshot.items():
+            value = self._read(key, location)
+            if value is None:
+                continue
+            if self.active.tell() >= self.segment_size:
+                self._roll()
+            moved[key] = self._append(self.active, self.active_id, key, value)
+        self.active.flush()
+        if self.fsync:
+            os.fsync(self.active.fileno())
+
+        with self.lock:
+            for key, location in moved.items():
+                # Compaction runs on the flusher thread, so the index cannot have changed
+                self.index[key] = location
+            self.live_bytes = sum(location[2] for location in self.index.values())
+            self.dead_bytes = 0
+        for segment_id in old_segments:
+            os.remove(self._path(segment_id))
+        self.compactions += 1
+
+    def _read(self, key: str, location: Location) -> Optional[bytes]:
+        """Read a value and check the record checksum"""
+        segment_id, offset, length = location
+        raw_key = key.encode("utf-8")
+        start = offset - len(raw_key) - HEADER.size
+        try:
+            with open(self._path(segment_id), "rb") as file:
+                file.seek(start)
+                record = file.read(HEADER.size + len(raw_key) + length)
+        except FileNotFoundError:
+            # Compacted away between the index lookup and the read
+            return None
+        crc = HEADER.unpack_from(record)[0]
+        value = record[HEADER.size + len(raw_key):]
+        if len(value) != length or zlib.crc32(value, zlib.crc32(raw_key)) != crc:
+            logging.warning("Corrupt cache record for %s in segment %s", key, segment_id)
+            return None
+        return value
+
+    def _lock(self):
+        """Take the directory's writer lock, released when the returned file is closed"""
+        lock_file = open(os.path.join(self.directory, LOCK_FILE), "a")
+        if fcntl is not None:
+            try:
+                fcntl.flock(lock_file.fileno(), fcntl.LOCK_EX | fcntl.LOCK_NB)
+            except BlockingIOError:
+                lock_file.close()
+                raise StoreLocked(f"Cache directory {self.directory} is in use by another process")
+        return lock_file
+
+    def _load(self) -> None:
+        """Rebuild the index by scanning record headers in segment order"""
+        for segment_id in self._segments():
+            path = self._path(segment_id)
+            size = os.path.getsize(path)
+            with open(path, "rb") as file:
+                offset = 0
+                while offset + HEADER.size <= size:
+                    header = file.read(HEADER.size)
+                    _, flags, key_length, value_length = HEADER.unpack(header)
+                    if offset + HEADER.size + key_length + value_length > size:
+                        break
+                    key = file.read(key_length).decode("utf-8", errors="replace")
+                    value_offset = offset + HEADER.size + key_length
+                    file.seek(value_length, os.SEEK_CUR)
+                    old = self.index.pop(key, None)
+                    if old is not None:
+                        self.live_bytes -= old[2]
+                        self.dead_bytes += old[2]
+                    if flags & TOMBSTONE:
+                        self.dead_bytes += key_length
+                    else:
+                        self.index[key] = (segment_id, value_offset, value_length)
+                        self.live_bytes += value_length
+                    offset = value_offset + value_length
+                if offset < size:
+                    logging.warning("Truncated record at %s:%s, ignoring the tail", path, offset)
+
+    def _segments(self) -> List[int]:
+        return sorted(int(name[:-len(SEGMENT_SUFFIX)]) for name in os.listdir(self.directory)
+                      if name.endswith(SEGMENT_SUFFIX) and name[:-len(SEGMENT_SUFFIX)].isdigit())
+
+    def _path(self, segment_id: int) -> str:
+        return os.path.join(self.directory, f"{segment_id:08d}{SEGMENT_SUFFIX}")
@@ -0,0 +1,359 @@
+"""Supervisor: One Listening Address Served by a Pool of Worker Processes"""
+
+from typing import Dict, List, Optional
+import argparse
+import asyncio
+import logging
+import multiprocessing
+import os
+import queue
+import signal
+import socket
+import tempfile
+import time
+
+from HTTP_Proxy import Proxy, build_body_store, build_cache, resize_cache
+from config import CONFIG_FILE, ConfigWatcher, load_config
+from metrics import MetricsServer, Snapshot, merge, render
+from sharedcache import CacheServer
+from tiered import TieredCache
+
+REUSE_PORT = hasattr(socket, "SO_REUSEPORT")
+OWNER_NAME = "proxy-cache-owner"
+
+
+def run_worker(host: str, port: int, sock: Optional[socket.socket], stats_queue, stats_interval: float,
+               drain_timeout: float, cache_socket: Optional[str] = None) -> None:
+    """Worker process body: serve until SIGTERM, then drain"""
+    # Ctrl+C reaches the whole process group; the supervisor decides when workers stop
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+    proxy = Proxy(IP=host, PORT=port, cache_socket=cache_socket)
+    asyncio.run(proxy.Start(sock=sock, reuse_port=sock is None, stats_queue=stats_queue,
+                            stats_interval=stats_interval, drain_timeout=drain_timeout))
+
+
+def run_cache_owner(path: str, stats_queue, stats_interval: float) -> None:
+    """Cache owner process body: serve the shared cache on path until SIGTERM"""
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+    logging.basicConfig(level=logging.INFO, format="%(asctime)s - %(levelname)s - %(message)s")
+    asyncio.run(_serve_cache(path, stats_queue, stats_interval))
+
+
+async def _serve_cache(path: str, stats_queue, stats_interval: float) -> None:
+    data = load_config(CONFIG_FILE)
+    cache = build_cache(data)
+    bodies = build_body_store(data)
+    server = CacheServer(cache, bodies)
+    loop = asyncio.get_running_loop()
+
+    async def reload() -> bool:
+        try:
+            new = await loop.run_in_executor(None, load_config, CONFIG_FILE)
+        except (OSError, ValueError) as e:
+            logging.error(f"Cache owner rejected new {CONFIG_FILE}: {e}")
+            return False
+        resize_cache(cache, new)
+        bodies.max_bytes = new.get("Body_Store_Bytes", 4 * 1024 * 1024 * 1024)
+        bodies.max_body_size = new.get("Max_Body_Object_Size", 1024 * 1024 * 1024)
+        return True
+
+    stopping = asyncio.Event()
+    loop.add_signal_handler(signal.SIGTERM, stopping.set)
+    watcher = ConfigWatcher(CONFIG_FILE, reload, data.get("Config_Poll_Interval", 2.0))
+    watcher.start()
+    await server.start(path)
+    logging.info(f"Serving the shared cache on {path}")
+    try:
+        while not stopping.is_set():
+            stats_queue.put((os.getpid(), server.stats(), {}))
+            try:
+                await asyncio.wait_for(stopping.wait(), stats_interval)
+            except TimeoutError:
+                pass
+    finally:
+        await watcher.stop()
+        await server.close()
+        if isinstance(cache, TieredCache):
+            await cache.aclose()
+        cache.close()
+        try:
+            os.unlink(path)
+        except FileNotFoundError:
+            pass
+
+
+class Supervisor:
+    """Runs workers that all accept on host:port and keeps them running
+
+    Where the OS has SO_REUSEPORT every worker binds its own listening
+    socket on the shared address and the kernel spreads new connections
+    across them; elsewhere the supervisor binds one socket and the forked
+    workers accept on it. The supervisor holds the address (bound, not
+    listening, so it never receives connections) so a busy port fails at
+    startup rather than in every worker.
+
+    With shared_cache (and Unix sockets available) a cache owner process
+    holds the one cache and body store accounting for all workers, which
+    reach it through sharedcache.CacheClient, so capacity and hit ratio grow
+    with the worker count instead of being divided by it. Otherwise each
+    worker builds its own cache.
+
+    Workers (and the owner) that die are restarted, with a growing delay if
+    they keep dying straight after starting; each slot waits out its own
+    delay while the loop goes on reaping, forwarding signals and taking
+    stats. SIGHUP is forwarded so every
+    process reloads Config.json; SIGTERM or SIGINT drains all workers (each
+    stops accepting and finishes its in-flight requests for up to
+    drain_timeout seconds) and then stops the owner before the supervisor
+    exits. Each process reports its counters and histograms every
+    stats_interval seconds; stats() and histograms() sum them, and with
+    Metrics_Port set the supervisor serves both to Prometheus.
+    """
+
+    def __init__(self, workers: Optional[int] = None, host: str = "0.0.0.0", port: int = 19132,
+                 drain_timeout: float = 30.0, stats_interval: float = 5.0, log_interval: float = 60.0,
+                 shared_cache: bool = True) -> None:
+        # Reserve one core for the OS
+        self.workers = workers or max(1, multiprocessing.cpu_count() - 1)
+        self.host = host
+        self.port = port
+        self.drain_timeout = drain_timeout
+        self.stats_interval = stats_interval
+        self.log_interval = log_interval
+        self.context = multiprocessing.get_context("spawn" if REUSE_PORT else "fork")
+        self.stats_queue = self.context.Queue()
+        self.processes: List[multiprocessing.Process] = []
+        self.started: Dict[int, float] = {}
+        self.worker_stats: Dict[int, Dict[str, float]] = {}
+        self.worker_histograms: Dict[int, Dict[str, Snapshot]] = {}
+        self.restarts = 0
+        # Per process slot (its name): current restart delay, and when a dead one is due back
+        self.backoff: Dict[str, float] = {}
+        self.next_restart_at: Dict[str, float] = {}
+        self.stopping = False
+        self.reloading = False
+        self.sock: Optional[socket.socket] = None
+        self.cache_socket: Optional[str] = None
+        if shared_cache and hasattr(socket, "AF_UNIX"):
+            self.cache_socket = os.path.join(tempfile.gettempdir(), f"proxy-cache-{os.getpid()}.sock")
+        self.owner: Optional[multiprocessing.Process] = None
+
+    def run(self) -> None:
+        """Start the workers and supervise them until told to stop"""
+        self.sock = self._bind()
+        signal.signal(signal.SIGINT, self._stop)
+        signal.signal(signal.SIGTERM, self._stop)
+        if hasattr(signal, "SIGHUP"):
+            signal.signal(signal.SIGHUP, self._reload)
+        mode = "SO_REUSEPORT" if REUSE_PORT else "a shared socket"
+        logging.info(f"Starting {self.workers} workers on {self.host}:{self.port} with {mode}")
+        if self.cache_socket is not None:
+            self._spawn_owner()
+            self._wait_for_owner()
+        for slot in range(self.workers):
+            self._spawn(f"proxy-worker-{slot}")
+        metrics = self._serve_metrics()
+        last_log = time.monotonic()
+        try:
+            while not self.stopping:
+                # Wake up for the next restart that falls due within the tick
+                now = time.monotonic()
+                self._collect(timeout=min([1.0] + [max(at - now, 0.0) for at in self.next_restart_at.values()]))
+                if self.reloading:
+                    self.reloading = False
+                    self._signal_all(signal.SIGHUP)
+                    if self.owner is not None and self.owner.is_alive():
+                        os.kill(self.owner.pid, signal.SIGHUP)
+                self._restart_dead()
+                if time.monotonic() - last_log >= self.log_interval:
+                    last_log = time.monotonic()
+                    self._log_stats()
+        finally:
+            if metrics is not None:
+                metrics.stop_thread()
+            self._shutdown()
+
+    def stats(self) -> Dict[str, float]:
+        """Counters summed over the latest reports of the workers and cache owner (ratios are averaged)"""
+        alive = {p.pid for p in self.processes if p.is_alive()}
+        total: Dict[str, float] = {"workers": len(alive), "restarts": self.restarts}
+        if self.owner is not None and self.owner.is_alive():
+            alive.add(self.owner.pid)
+        # Copied first: the metrics thread calls this while the main thread takes new reports
+        reports = [stats for pid, stats in list(self.worker_stats.items()) if pid in alive]
+        reported: Dict[str, int] = {}
+        for stats in reports:
+            for key, value in stats.items():
+                if isinstance(value, (int, float)):
+                    total[key] = total.get(key, 0) + value
+                    reported[key] = reported.get(key, 0) + 1
+        for key, count in reported.items():
+            if key.endswith("ratio"):
+                total[key] /= count
+        return total
+
+    def histograms(self) -> Dict[str, Snapshot]:
+        """Histograms summed over the latest reports of the live workers"""
+        alive = {p.pid for p in self.processes if p.is_alive()}
+        reports = [histograms for pid, histograms in list(self.worker_histograms.items()) if pid in alive]
+        names = sorted({name for histograms in reports for name in histograms})
+        return {name: merge(histograms[name] for histograms in reports if name in histograms) for name in names}
+
+    def _serve_metrics(self) -> Optional[MetricsServer]:
+        """Serve the summed stats on Metrics_Port from a thread, if configured"""
+        try:
+            data = load_config(CONFIG_FILE)
+        except (OSError, ValueError):
+            return None
+        if not data.get("Metrics_Port"):
+            return None
+        server = MetricsServer(lambda: render(self.stats(), self.histograms()))
+        try:
+            server.start_thread(data.get("Metrics_Host", "127.0.0.1"), data["Metrics_Port"])
+        except OSError as e:
+            logging.warning(f"Not serving metrics on port {data['Metrics_Port']}: {e}")
+            return None
+        return server
+
+    def _bind(self) -> socket.socket:
+        family = socket.AF_INET6 if ":" in self.host else socket.AF_INET
+        sock = socket.socket(family, socket.SOCK_STREAM)
+        sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        if REUSE_PORT:
+            sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEPORT, 1)
+        sock.bind((self.host, self.port))
+        if not REUSE_PORT:
+            sock.listen(1024)
+            sock.set_inheritable(True)
+        self.port = sock.getsockname()[1]
+        return sock
+
+    def _spawn(self, name: str) -> None:
+        process = self.context.Process(
+            target=run_worker, name=name,
+            args=(self.host, self.port, None if REUSE_PORT else self.sock, self.stats_queue,
+                  self.stats_interval, self.drain_timeout, self.cache_socket))
+        process.start()
+        self.processes.append(process)
+        self.started[process.pid] = time.monotonic()
+
+    def _spawn_owner(self) -> None:
+        self.owner = self.context.Process(target=run_cache_owner, name=OWNER_NAME,
+                                          args=(self.cache_socket, self.stats_queue, self.stats_interval))
+        self.owner.start()
+        self.started[self.owner.pid] = time.monotonic()
+
+    def _wait_for_owner(self, timeout: float = 10.0) -> None:
+        """Give the owner time to load the cache so the first requests do not all miss"""
+        deadline = time.monotonic() + timeout
+        while not os.path.exists(self.cache_socket) and self.owner.is_alive() and time.monotonic() < deadline:
+            time.sleep(0.05)
+        if not os.path.exists(self.cache_socket):
+            logging.warning("The cache owner is not up yet; workers will serve without it until it is")
+
+    def _restart_dead(self) -> None:
+        """Reap dead processes and respawn every slot whose restart is due"""
+        if self.stopping:
+            return
+        if self.owner is not None and not self.owner.is_alive():
+            # Workers treat the cache as empty meanwhile and reconnect on their own
+            self._reap(self.owner)
+            self.owner = None
+        for process in list(self.processes):
+            if not process.is_alive():
+                self.processes.remove(process)
+                self._reap(process)
+        now = time.monotonic()
+        for name, at in list(self.next_restart_at.items()):
+            if at > now:
+                continue
+            del self.next_restart_at[name]
+            if name == OWNER_NAME:
+                self._spawn_owner()
+            else:
+                self._spawn(name)
+
+    def _reap(self, process: multiprocessing.Process) -> None:
+        """Forget a dead process and schedule its slot's restart"""
+        self.worker_stats.pop(process.pid, None)
+        self.worker_histograms.pop(process.pid, None)
+        lifetime = time.monotonic() - self.started.pop(process.pid, 0.0)
+        # A process that dies on startup would otherwise be respawned in a tight loop
+        backoff = self.backoff.get(process.name, 0.0)
+        backoff = min(max(backoff * 2, 1.0), 30.0) if lifetime < 5.0 else 0.0
+        self.backoff[process.name] = backoff
+        self.next_restart_at[process.name] = time.monotonic() + backoff
+        logging.warning(f"{process.name} (pid {process.pid}) exited with {process.exitcode}; "
+                        f"restarting{f' in {backoff:.0f}s' if backoff else ''}")
+        self.restarts += 1
+
+    def _collect(self, timeout: float) -> None:
+        """Take worker reports, waiting up to timeout for the first one"""
+        try:
+            pid, stats, histograms = self.stats_queue.get(timeout=timeout)
+            self.worker_stats[pid], self.worker_histograms[pid] = stats, histograms
+            while True:
+                pid, stats, histograms = self.stats_queue.get_nowait()
+                self.worker_stats[pid], self.worker_histograms[pid] = stats, histograms
+        except queue.Empty:
+            pass
+        except (EOFError, OSError, InterruptedError):
+            pass
+
+    def _log_stats(self) -> None:
+        stats = self.stats()
+        logging.info(f"workers={stats['workers']:.0f} restarts={stats['restarts']:.0f} "
+                     f"connections={stats.get('connections', 0):.0f} requests={stats.get('requests', 0):.0f} "
+                     f"cache_hits={stats.get('http_cache_hits', 0):.0f} "
+                     f"cache_misses={stats.get('http_cache_misses', 0):.0f}")
+
+    def _signal_all(self, signum: int) -> None:
+        for process in self.processes:
+            if process.is_alive():
+                os.kill(process.pid, signum)
+
+    def _reload(self, signum, frame) -> None:
+        logging.info("Reload signal received. Reloading all workers...")
+        self.reloading = True
+
+    def _stop(self, signum, frame) -> None:
+        logging.info("Shutdown signal received. Draining all workers...")
+        self.stopping = True
+
+    def _shutdown(self) -> None:
+        """Drain every worker, then kill any that outlive the drain timeout"""
+        self._signal_all(signal.SIGTERM)
+        deadline = time.monotonic() + self.drain_timeout + 5.0
+        for process in self.processes:
+            process.join(max(deadline - time.monotonic(), 0.0))
+            if process.is_alive():
+                logging.warning(f"Killing {process.name} (pid {process.pid}) after the drain timeout")
+                process.kill()
+                process.join()
+        # Last, so draining workers can still use the cache
+        if self.owner is not None and self.owner.is_alive():
+            self.owner.terminate()
+            self.owner.join(10.0)
+            if self.owner.is_alive():
+                self.owner.kill()
+                self.owner.join()
+        if self.sock is not None:
+            self.sock.close()
+        logging.info("All workers stopped.")
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--workers", type=int, default=None, help="default: CPU count - 1")
+    parser.add_argument("--host", default="0.0.0.0")
+    parser.add_argument("--port", type=int, default=19132)
+    parser.add_argument("--drain-timeout", type=float, default=30.0)
+    parser.add_argument("--no-shared-cache", action="store_true", help="give every worker its own cache")
+    args = parser.parse_args()
+    logging.basicConfig(level=logging.INFO, format="%(asctime)s - %(levelname)s - %(message)s")
+    Supervisor(args.workers, args.host, args.port, args.drain_timeout,
+               shared_cache=not args.no_shared_cache).run()
+
+
+if __name__ == "__main__":
+    main()
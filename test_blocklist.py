@@ -0,0 +1,59 @@
+"""Blocklist rule matching and blocklist file loading"""
+
+from blocklist import AhoCorasick, Blocklist, load_rules
+
+
+def test_domain_rules_cover_subdomains_only():
+    blocklist = Blocklist(["||ads.example", "*.tracker.test", "||dotted.test^"])
+    assert blocklist.blocked("ads.example")
+    assert blocklist.blocked("x.y.ads.example")
+    assert blocklist.blocked("ADS.Example.")
+    assert blocklist.blocked("tracker.test") and blocklist.blocked("a.tracker.test")
+    assert blocklist.blocked("dotted.test")
+    assert not blocklist.blocked("badads.example")
+    assert not blocklist.blocked("ads.example.org")
+
+
+def test_exact_rules_match_only_the_host():
+    blocklist = Blocklist(["=exact.test"])
+    assert blocklist.blocked("exact.test") and blocklist.blocked("Exact.Test.")
+    assert not blocklist.blocked("www.exact.test")
+
+
+def test_other_rules_are_substrings():
+    blocklist = Blocklist(["porn", "Casino", " ", ""])
+    assert len(blocklist) == 2
+    assert blocklist.blocked("freeporn.example") and blocklist.blocked("online-casino.test")
+    assert not blocklist.blocked("example.com")
+
+
+def test_automaton_finds_overlapping_patterns():
+    automaton = AhoCorasick(["he", "she", "hers", "his"])
+    assert automaton.search("ushers")
+    assert automaton.search("ahis")
+    assert not automaton.search("hxs")
+    assert AhoCorasick(["abcd", "bc"]).search("abce")
+
+
+def test_verdicts_are_memoised():
+    blocklist = Blocklist(["||ads.example"], cache_size=2)
+    for _ in range(3):
+        assert blocklist.blocked("ads.example")
+        assert not blocklist.blocked("fine.example")
+    assert blocklist.stats()["lookups"] == 6 and blocklist.stats()["cache_hits"] == 4
+
+
+def test_load_rules_reads_hosts_domain_and_adblock_lists(tmp_path):
+    path = tmp_path / "list.txt"
+    path.write_text("# comment\n"
+                    "0.0.0.0 ads.example tracker.example  # inline\n"
+                    "127.0.0.1 localhost\n"
+                    "::1 ip6-host.example\n"
+                    "plain.example\n"
+                    "! adblock comment\n"
+                    "||adblock.example^\n"
+                    "||path.example/banner^\n"
+                    "||wild*.example^\n"
+                    "two words\n")
+    assert load_rules(str(path)) == ["||ads.example", "||tracker.example", "||ip6-host.example", "||plain.example",
+                                     "||adblock.example"]
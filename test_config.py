@@ -0,0 +1,85 @@
+"""Config validation, loading and the reload watcher"""
+
+import asyncio
+import json
+import os
+
+import pytest
+
+from config import ConfigWatcher, load_config, validate_config
+
+
+def minimal(**overrides):
+    return dict({"BlockedSites": [], "Max_Cache_Size": 100}, **overrides)
+
+
+def test_shipped_config_is_valid():
+    config = load_config(os.path.join(os.path.dirname(os.path.abspath(__file__)), "Config.json"))
+    assert config["Max_Cache_Size"] > 0
+
+
+def test_minimal_config_is_accepted_as_is():
+    data = minimal(Keep_Alive_Timeout=0, Stale_If_Error=2.5, Cache_Policy="gdsf", Metrics_Port=0, Access_Log="")
+    assert validate_config(data) is data
+
+
+@pytest.mark.parametrize("data, message", [
+    ([], "JSON object"),
+    ({"Max_Cache_Size": 100}, "BlockedSites"),
+    (minimal(BlockedSites=["ok", 3]), "BlockedSites"),
+    ({"BlockedSites": []}, "Max_Cache_Size is required"),
+    (minimal(Max_Cache_Size=0), "positive integer"),
+    (minimal(Max_Object_Size=True), "positive integer"),
+    (minimal(Tunnel_Buffer_Size=1.5), "positive integer"),
+    (minimal(Keep_Alive_Timeout=-1), "non-negative"),
+    (minimal(Stale_If_Error="5"), "non-negative"),
+    (minimal(Access_Log_Sample=1.5), "fraction"),
+    (minimal(Cache_Policy="lru"), "Cache_Policy must be one of"),
+    (minimal(DNS_Prefer="both"), "DNS_Prefer"),
+    (minimal(Metrics_Port=70000), "Metrics_Port"),
+    (minimal(Metrics_Port=False), "Metrics_Port"),
+    (minimal(Access_Log=None), "Access_Log"),
+    (minimal(DNS_Servers="1.1.1.1"), "DNS_Servers"),
+    (minimal(MITM_Domains=[1]), "MITM_Domains"),
+    (minimal(TLS_CA_File=1), "TLS_CA_File"),
+])
+def test_invalid_configs_are_rejected(data, message):
+    with pytest.raises(ValueError, match=message):
+        validate_config(data)
+
+
+def test_load_config_reports_bad_json_as_valueerror(tmp_path):
+    path = tmp_path / "Config.json"
+    path.write_text("{not json")
+    with pytest.raises(ValueError):
+        load_config(str(path))
+
+
+def test_watcher_reloads_on_change_and_survives_failures(tmp_path):
+    async def main():
+        path = tmp_path / "Config.json"
+        path.write_text(json.dumps(minimal()))
+        calls = []
+
+        async def reload():
+            calls.append(load_config(str(path)))
+            return True
+
+        watcher = ConfigWatcher(str(path), reload, interval=0.01)
+        watcher.start()
+        try:
+            await asyncio.sleep(0.05)
+            assert calls == []
+            path.write_text(json.dumps(minimal(Max_Cache_Size=7)))
+            await asyncio.sleep(0.05)
+            assert calls[-1]["Max_Cache_Size"] == 7 and watcher.reloads == 1
+            path.write_text("{broken")
+            await asyncio.sleep(0.05)
+            assert watcher.reloads == 1 and not watcher.task.done()
+            watcher.trigger()
+            await asyncio.sleep(0.05)
+            assert watcher.reloads == 1
+        finally:
+            await watcher.stop()
+
+    asyncio.run(main())
@@ -0,0 +1,151 @@
+"""HTTP/1.1 head parsing, framing and request bodies"""
+
+import asyncio
+
+import pytest
+
+from http1 import (
+    BodyTooLarge, ProtocolError, RequestBody, content_length, framed_headers, has_body, is_chunked, keep_alive,
+    read_chunked, read_headers, read_response_head, serialize_head, strip_hop_by_hop, with_connection,
+)
+
+
+def reader_for(data: bytes) -> asyncio.StreamReader:
+    reader = asyncio.StreamReader()
+    reader.feed_data(data)
+    reader.feed_eof()
+    return reader
+
+
+class Sink:
+    def __init__(self) -> None:
+        self.data = bytearray()
+
+    def write(self, data) -> None:
+        self.data += data
+
+    async def drain(self) -> None:
+        pass
+
+
+def test_response_head_is_parsed():
+    async def main():
+        reader = reader_for(b"HTTP/1.1 404 Not Found\r\nContent-Length: 3\r\nX-A:  b \r\nbogus\r\n\r\nabc")
+        version, status, reason, headers = await read_response_head(reader)
+        assert (version, status, reason) == ("HTTP/1.1", 404, "Not Found")
+        assert headers == [("Content-Length", "3"), ("X-A", "b")]
+        assert await reader.read() == b"abc"
+        assert (await read_response_head(reader_for(b"HTTP/1.0 200\n\n")))[:3] == ("HTTP/1.0", 200, "")
+
+    asyncio.run(main())
+
+
+@pytest.mark.parametrize("line", [b"NOT HTTP AT ALL\r\n\r\n", b"HTTP/1.1 OK\r\n\r\n", b"HTTP/1.1\r\n\r\n"])
+def test_bad_status_lines_are_protocol_errors(line):
+    async def main():
+        with pytest.raises(ProtocolError):
+            await read_response_head(reader_for(line))
+
+    asyncio.run(main())
+
+
+def test_header_count_is_limited():
+    async def main():
+        head = b"".join(b"X-%d: v\r\n" % n for n in range(101)) + b"\r\n"
+        with pytest.raises(ProtocolError):
+            await read_headers(reader_for(head))
+
+    asyncio.run(main())
+
+
+def test_body_framing_rules():
+    assert not has_body("HEAD", 200)
+    assert not has_body("GET", 204) and not has_body("GET", 304) and not has_body("GET", 101)
+    assert has_body("GET", 200)
+    assert is_chunked([("Transfer-Encoding", "gzip, Chunked")])
+    assert not is_chunked([("Transfer-Encoding", "chunked, gzip")])
+    assert content_length([("content-length", "12")]) == 12
+    assert content_length([]) is None
+    for value in ("-1", "12abc"):
+        with pytest.raises(ProtocolError):
+            content_length([("Content-Length", value)])
+
+
+def test_chunked_bodies_are_decoded_with_extensions_and_trailers():
+    async def main():
+        reader = reader_for(b"5;name=value\r\nhello\r\n6\r\n world\r\n0\r\nTrailer: x\r\n\r\nnext")
+        assert await read_chunked(reader) == b"hello world"
+        assert await reader.read() == b"next"
+        with pytest.raises(ProtocolError):
+            await read_chunked(reader_for(b"zz\r\n"))
+
+    asyncio.run(main())
+
+
+def test_hop_by_hop_headers_are_stripped():
+    headers = [("Connection", "close, X-Secret"), ("X-Secret", "1"), ("Keep-Alive", "timeout=5"),
+               ("Transfer-Encoding", "chunked"), ("Content-Type", "text/plain")]
+    assert strip_hop_by_hop(headers) == [("Content-Type", "text/plain")]
+    assert framed_headers(headers + [("Content-Length", "9")], 4) == [("Content-Type", "text/plain"),
+                                                                       ("Content-Length", "4")]
+
+
+def test_serialized_heads_cannot_inject_headers():
+    head = serialize_head("HTTP/1.1 200 OK", [("X-A", "b\r\nSet-Cookie: evil")])
+    assert head == b"HTTP/1.1 200 OK\r\nX-A: bSet-Cookie: evil\r\n\r\n"
+    assert b"".join(with_connection(head, False)) == \
+        b"HTTP/1.1 200 OK\r\nConnection: close\r\nX-A: bSet-Cookie: evil\r\n\r\n"
+
+
+def test_keep_alive_defaults_by_version():
+    assert keep_alive("HTTP/1.1", [])
+    assert not keep_alive("HTTP/1.1", [("Connection", "Close")])
+    assert not keep_alive("HTTP/1.0", [])
+    assert keep_alive("HTTP/1.0", [("Proxy-Connection", "keep-alive")])
+
+
+def test_request_body_with_content_length_stops_at_the_length():
+    async def main():
+        reader = reader_for(b"hello worldGET / HTTP/1.1\r\n")
+        body = RequestBody(reader, [("Content-Length", "11")], chunk_size=4)
+        assert bool(body)
+        assert [data async for data in body] == [b"hell", b"o wo", b"rld"]
+        assert body.consumed and body.received == 11
+        assert await reader.readline() == b"GET / HTTP/1.1\r\n"
+        with pytest.raises(RuntimeError):
+            await body.read()
+
+    asyncio.run(main())
+
+
+def test_chunked_request_body_and_100_continue():
+    async def main():
+        writer = Sink()
+        body = RequestBody(reader_for(b"3\r\nabc\r\n0\r\n\r\n"),
+                           [("Transfer-Encoding", "chunked"), ("Expect", "100-continue")], writer=writer)
+        assert bytes(writer.data) == b""
+        assert await body.read() == b"abc"
+        assert bytes(writer.data) == b"HTTP/1.1 100 Continue\r\n\r\n"
+        assert body.consumed
+
+    asyncio.run(main())
+
+
+def test_request_body_limits():
+    async def main():
+        declared = RequestBody(reader_for(b"x" * 20), [("Content-Length", "20")], max_size=10)
+        assert declared.too_large
+        with pytest.raises(BodyTooLarge):
+            await declared.read()
+        streamed = RequestBody(reader_for(b"8\r\n12345678\r\n8\r\n12345678\r\n0\r\n\r\n"),
+                               [("Transfer-Encoding", "chunked")], max_size=10)
+        assert not streamed.too_large
+        with pytest.raises(BodyTooLarge):
+            await streamed.read()
+        truncated = RequestBody(reader_for(b"abc"), [("Content-Length", "5")])
+        with pytest.raises(asyncio.IncompleteReadError):
+            await truncated.read()
+        empty = RequestBody(reader_for(b""), [])
+        assert not empty and empty.consumed and await empty.read() == b""
+
+    asyncio.run(main())
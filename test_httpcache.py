@@ -0,0 +1,207 @@
+"""HTTPCache freshness, Vary, revalidation and stale-if-error against a canned origin"""
+
+import asyncio
+import time
+from email.utils import formatdate
+
+import pytest
+
+from http1 import get_header
+from httpcache import HTTPCache
+from LRU import LRUCache
+from upstream import UpstreamResponse
+
+URL = "http://example.test/page"
+
+
+class Sink:
+    """StreamWriter stand-in that keeps what was written"""
+
+    def __init__(self) -> None:
+        self.data = bytearray()
+        self.closed = False
+
+    def write(self, data) -> None:
+        self.data += data
+
+    def writelines(self, lines) -> None:
+        for data in lines:
+            self.data += data
+
+    async def drain(self) -> None:
+        pass
+
+    def is_closing(self) -> bool:
+        return self.closed
+
+    def close(self) -> None:
+        self.closed = True
+
+
+class Origin:
+    """Answers each fetch with respond(request headers) -> (status, headers, body)"""
+
+    def __init__(self, respond) -> None:
+        self.respond = respond
+        self.requests = []
+
+    async def fetch(self, headers):
+        self.requests.append(headers)
+        status, headers, body = self.respond(self.requests[-1])
+        reader = asyncio.StreamReader()
+        reader.feed_data(body)
+        reader.feed_eof()
+        if get_header(headers, "Date") is None:
+            headers = [("Date", formatdate(usegmt=True))] + headers
+        headers = headers + [("Content-Length", str(len(body)))]
+        return UpstreamResponse("GET", "HTTP/1.1", status, "Whatever", headers, reader, Sink())
+
+
+async def get(cache: HTTPCache, origin: Origin, headers=()):
+    writer = Sink()
+    await cache.serve(origin.fetch, writer, "GET", URL, list(headers), None, "HTTP/1.1", True)
+    head, _, body = bytes(writer.data).partition(b"\r\n\r\n")
+    return int(head.split()[1]), body
+
+
+def dated(seconds_ago: float):
+    return ("Date", formatdate(time.time() - seconds_ago, usegmt=True))
+
+
+def test_fresh_responses_are_served_from_the_cache():
+    async def main():
+        cache = HTTPCache(LRUCache(100))
+        origin = Origin(lambda _: (200, [("Cache-Control", "max-age=60")], b"hello"))
+        assert await get(cache, origin) == (200, b"hello")
+        assert await get(cache, origin) == (200, b"hello")
+        assert len(origin.requests) == 1
+        assert cache.stats()["hits"] == 1 and cache.stats()["stored"] == 1
+
+    asyncio.run(main())
+
+
+@pytest.mark.parametrize("headers", [[("Cache-Control", "no-store")], [("Cache-Control", "private, max-age=60")],
+                                     [("Cache-Control", "max-age=60"), ("Set-Cookie", "a=b")]])
+def test_unshareable_responses_are_not_stored(headers):
+    async def main():
+        cache = HTTPCache(LRUCache(100))
+        origin = Origin(lambda _: (200, headers, b"mine"))
+        await get(cache, origin)
+        await get(cache, origin)
+        assert len(origin.requests) == 2
+        assert cache.stats()["uncacheable"] == 2
+
+    asyncio.run(main())
+
+
+def test_client_no_cache_goes_to_the_origin():
+    async def main():
+        cache = HTTPCache(LRUCache(100))
+        origin = Origin(lambda _: (200, [("Cache-Control", "max-age=60")], b"x"))
+        await get(cache, origin)
+        await get(cache, origin, [("Cache-Control", "no-cache")])
+        assert len(origin.requests) == 2
+
+    asyncio.run(main())
+
+
+def test_vary_keeps_one_entry_per_header_value():
+    async def main():
+        cache = HTTPCache(LRUCache(100))
+
+        def respond(headers):
+            language = get_header(headers, "Accept-Language")
+            return 200, [("Cache-Control", "max-age=60"), ("Vary", "Accept-Language")], language.encode()
+
+        origin = Origin(respond)
+        for language in ("en", "fr", "en", "fr"):
+            assert await get(cache, origin, [("Accept-Language", language)]) == (200, language.encode())
+        assert len(origin.requests) == 2
+        assert cache.stats()["hits"] == 2
+
+    asyncio.run(main())
+
+
+def test_stale_entries_are_revalidated_with_a_304():
+    async def main():
+        cache = HTTPCache(LRUCache(100))
+
+        def respond(headers):
+            if get_header(headers, "If-None-Match") == '"v1"':
+                return 304, [("Cache-Control", "max-age=60"), ("ETag", '"v1"')], b""
+            return 200, [("Cache-Control", "max-age=0"), ("ETag", '"v1"')], b"body"
+
+        origin = Origin(respond)
+        assert await get(cache, origin) == (200, b"body")
+        assert await get(cache, origin) == (200, b"body")
+        assert cache.stats()["revalidated"] == 1
+        # Freshened by the 304: the third request is a plain hit
+        assert await get(cache, origin) == (200, b"body")
+        assert len(origin.requests) == 2 and cache.stats()["hits"] == 1
+
+    asyncio.run(main())
+
+
+def test_matching_client_validators_get_a_304_from_the_cache():
+    async def main():
+        cache = HTTPCache(LRUCache(100))
+        origin = Origin(lambda _: (200, [("Cache-Control", "max-age=60"), ("ETag", '"v1"')], b"body"))
+        await get(cache, origin)
+        assert await get(cache, origin, [("If-None-Match", 'W/"v1"')]) == (304, b"")
+        assert await get(cache, origin, [("If-None-Match", '"v2"')]) == (200, b"body")
+        assert len(origin.requests) == 1
+
+    asyncio.run(main())
+
+
+def stale_then(failure, cache_control: str = "max-age=10"):
+    """An origin whose first answer is already 100 seconds old, then fails"""
+    def respond(_):
+        if not origin.requests[1:]:
+            return 200, [dated(100), ("Cache-Control", cache_control), ("ETag", '"v1"')], b"old"
+        if isinstance(failure, Exception):
+            raise failure
+        return failure, [], b"broken"
+    origin = Origin(respond)
+    return origin
+
+
+@pytest.mark.parametrize("window, served", [(60, False), (120, True)])
+def test_stale_if_error_directive_bounds_stale_use_on_5xx(window, served):
+    async def main():
+        cache = HTTPCache(LRUCache(100), stale_if_error=0.0)
+        origin = stale_then(503, f"max-age=10, stale-if-error={window}")
+        await get(cache, origin)
+        assert await get(cache, origin) == ((200, b"old") if served else (503, b"broken"))
+        assert cache.stats()["stale_if_error"] == int(served)
+        assert cache.stats()["stale_served"] == 0
+
+    asyncio.run(main())
+
+
+def test_configured_stale_if_error_applies_without_a_directive():
+    async def main():
+        cache = HTTPCache(LRUCache(100), stale_if_error=120.0)
+        origin = stale_then(ConnectionRefusedError())
+        await get(cache, origin)
+        assert await get(cache, origin) == (200, b"old")
+        cache.stale_if_error = 60.0
+        with pytest.raises(ConnectionRefusedError):
+            await get(cache, origin)
+        assert cache.stats()["stale_if_error"] == 1
+
+    asyncio.run(main())
+
+
+def test_other_errors_and_must_revalidate_are_passed_through():
+    async def main():
+        cache = HTTPCache(LRUCache(100))
+        origin = stale_then(501)
+        await get(cache, origin)
+        assert await get(cache, origin) == (501, b"broken")
+        origin = stale_then(503, "max-age=10, must-revalidate")
+        await get(cache, origin)
+        assert await get(cache, origin) == (503, b"broken")
+        assert cache.stats()["stale_if_error"] == 0
+
+    asyncio.run(main())
@@ -0,0 +1,79 @@
+"""Interceptor leaf minting with a throwaway CA"""
+
+import asyncio
+import time
+
+import pytest
+
+from mitm import Interceptor
+
+
+def interceptor(tmp_path) -> Interceptor:
+    return Interceptor(str(tmp_path / "ca.pem"), str(tmp_path / "certs"), ["example.test"])
+
+
+def slow_build(mitm: Interceptor, delay: float) -> None:
+    build = mitm._build
+
+    def slow(*args):
+        time.sleep(delay)
+        return build(*args)
+    mitm._build = slow
+
+
+def test_concurrent_connects_share_one_mint(tmp_path):
+    async def main():
+        mitm = interceptor(tmp_path)
+        contexts = await asyncio.gather(*(mitm.context("www.example.test") for _ in range(4)))
+        assert all(context is contexts[0] for context in contexts)
+        assert mitm.counters["minted"] == 1
+        assert await mitm.context("WWW.example.test.") is contexts[0]
+        assert mitm.counters["context_hits"] == 1
+
+    asyncio.run(main())
+
+
+def test_cancelled_follower_does_not_cancel_the_shared_mint(tmp_path):
+    async def main():
+        mitm = interceptor(tmp_path)
+        slow_build(mitm, 0.2)
+        leader = asyncio.create_task(mitm.context("a.example.test"))
+        await asyncio.sleep(0)
+        impatient = asyncio.create_task(asyncio.wait_for(mitm.context("a.example.test"), 0.05))
+        patient = asyncio.create_task(mitm.context("a.example.test"))
+        with pytest.raises(TimeoutError):
+            await impatient
+        assert await patient is await leader
+        assert not mitm.minting
+
+    asyncio.run(main())
+
+
+def test_cancelled_leader_fails_followers_with_oserror(tmp_path):
+    async def main():
+        mitm = interceptor(tmp_path)
+        slow_build(mitm, 0.2)
+        leader = asyncio.create_task(mitm.context("b.example.test"))
+        await asyncio.sleep(0)
+        follower = asyncio.create_task(mitm.context("b.example.test"))
+        await asyncio.sleep(0.05)
+        leader.cancel()
+        with pytest.raises(OSError):
+            await follower
+        assert leader.cancelled()
+        assert not mitm.minting
+
+    asyncio.run(main())
+
+
+def test_unmintable_host_raises_valueerror_and_can_be_bypassed(tmp_path):
+    async def main():
+        mitm = interceptor(tmp_path)
+        assert mitm.intercepts("bücher.example.test")
+        with pytest.raises(ValueError):
+            await mitm.context("bücher.example.test")
+        mitm.failed("bücher.example.test", minting=True)
+        assert not mitm.intercepts("bücher.example.test")
+        assert mitm.stats()["mint_failures"] == 1 and mitm.stats()["client_handshake_failures"] == 0
+
+    asyncio.run(main())
@@ -0,0 +1,67 @@
+"""ConnectionPool reuse and idle expiry against a local echo server"""
+
+import asyncio
+
+from pool import ConnectionPool
+
+
+async def start_server():
+    async def hold(reader, writer):
+        await reader.read()
+        writer.close()
+    server = await asyncio.start_server(hold, "127.0.0.1", 0)
+    return server, ("http", "127.0.0.1", server.sockets[0].getsockname()[1])
+
+
+def test_released_connections_are_reused():
+    async def main():
+        server, key = await start_server()
+        pool = ConnectionPool()
+        try:
+            reader, writer, reused = await pool.acquire(key)
+            assert not reused
+            pool.release(key, reader, writer)
+            assert (await pool.acquire(key))[1] is writer
+            assert pool.stats()["hits"] == 1 and pool.stats()["misses"] == 1
+        finally:
+            pool.close()
+            server.close()
+
+    asyncio.run(main())
+
+
+def test_idle_connections_expire_without_further_traffic():
+    async def main():
+        server, key = await start_server()
+        pool = ConnectionPool(idle_timeout=0.05, sweep_interval=0.02)
+        try:
+            reader, writer, _ = await pool.acquire(key)
+            pool.release(key, reader, writer)
+            await asyncio.sleep(0.15)
+            assert pool.stats()["idle"] == 0 and writer.is_closing()
+            assert pool.stats()["evictions"] == 1
+            assert pool.sweeper.done()
+        finally:
+            pool.close()
+            server.close()
+
+    asyncio.run(main())
+
+
+def test_acquire_sweeps_expired_connections_of_other_origins():
+    async def main():
+        server, key = await start_server()
+        other, other_key = await start_server()
+        pool = ConnectionPool(idle_timeout=0.05, sweep_interval=60.0)
+        try:
+            reader, writer, _ = await pool.acquire(key)
+            pool.release(key, reader, writer)
+            await asyncio.sleep(0.1)
+            await pool.acquire(other_key)
+            assert writer.is_closing() and pool.stats()["origins"] == 0
+        finally:
+            pool.close()
+            server.close()
+            other.close()
+
+    asyncio.run(main())
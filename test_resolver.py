@@ -0,0 +1,183 @@
+"""Resolver against a stub nameserver on localhost"""
+
+import asyncio
+import socket
+import struct
+
+import pytest
+
+from resolver import RCODE_NXDOMAIN, TYPE_A, TYPE_SOA, Resolver
+
+
+def _name(name: str) -> bytes:
+    return b"".join(bytes((len(label),)) + label.encode() for label in name.split(".")) + b"\0"
+
+
+class StubServer(asyncio.DatagramProtocol):
+    """Answers A queries from records, NXDOMAIN (with an SOA) for anything else, after delay seconds"""
+
+    def __init__(self, records, ttl: int = 300, negative_ttl: int = 60, delay: float = 0.0) -> None:
+        self.records = records
+        self.ttl = ttl
+        self.negative_ttl = negative_ttl
+        self.delay = delay
+        self.queries = []
+        self.transport = None
+
+    def connection_made(self, transport) -> None:
+        self.transport = transport
+
+    def datagram_received(self, data: bytes, addr) -> None:
+        asyncio.get_running_loop().call_later(self.delay, self._answer, data, addr)
+
+    def _answer(self, data: bytes, addr) -> None:
+        ident = struct.unpack_from(">H", data)[0]
+        labels, offset = [], 12
+        while data[offset]:
+            labels.append(data[offset + 1:offset + 1 + data[offset]].decode())
+            offset += 1 + data[offset]
+        name = ".".join(labels)
+        qtype = struct.unpack_from(">H", data, offset + 1)[0]
+        self.queries.append((name, qtype))
+        question = data[12:offset + 5]
+        addresses = self.records.get(name, []) if qtype == TYPE_A else []
+        if name in self.records:
+            header = struct.pack(">HHHHHH", ident, 0x8180, 1, len(addresses), 0, 0)
+            answers = b"".join(b"\xc0\x0c" + struct.pack(">HHIH", TYPE_A, 1, self.ttl, 4) +
+                               socket.inet_aton(address) for address in addresses)
+            self.transport.sendto(header + question + answers, addr)
+            return
+        header = struct.pack(">HHHHHH", ident, 0x8180 | RCODE_NXDOMAIN, 1, 0, 1, 0)
+        soa = _name("ns.test") + _name("admin.test") + struct.pack(">IIIII", 1, 3600, 600, 86400,
+                                                                      self.negative_ttl)
+        authority = b"\xc0\x0c" + struct.pack(">HHIH", TYPE_SOA, 1, 3600, len(soa)) + soa
+        self.transport.sendto(header + question + authority, addr)
+
+
+async def start_stub(**kwargs):
+    transport, stub = await asyncio.get_running_loop().create_datagram_endpoint(
+        lambda: StubServer(**kwargs), local_addr=("127.0.0.1", 0))
+    return transport, stub, ("127.0.0.1", transport.get_extra_info("sockname")[1])
+
+
+def resolver_for(server, **kwargs) -> Resolver:
+    return Resolver(nameservers=[server], prefer="ipv4_only", hosts={}, timeout=1.0, attempts=1, **kwargs)
+
+
+def test_positive_answers_are_cached_for_their_ttl():
+    async def main():
+        transport, stub, server = await start_stub(records={"www.example.test": ["192.0.2.1", "192.0.2.2"]},
+                                                   ttl=120)
+        resolver = resolver_for(server)
+        try:
+            expected = [(socket.AF_INET, "192.0.2.1"), (socket.AF_INET, "192.0.2.2")]
+            assert await resolver.resolve("WWW.example.test.") == expected
+            assert await resolver.resolve("www.example.test") == expected
+            assert len(stub.queries) == 1
+            assert 119 <= resolver.cache["www.example.test"].ttl <= 120
+            # Once the TTL has run out the name is asked for again
+            resolver.cache["www.example.test"].expires = 0.0
+            await resolver.resolve("www.example.test")
+            assert len(stub.queries) == 2
+            assert resolver.stats()["hits"] == 1 and resolver.stats()["misses"] == 2
+        finally:
+            transport.close()
+
+    asyncio.run(main())
+
+
+def test_ttl_is_clamped():
+    async def main():
+        transport, _, server = await start_stub(records={"a.example.test": ["192.0.2.1"]}, ttl=86400)
+        resolver = resolver_for(server, max_ttl=600.0)
+        try:
+            await resolver.resolve("a.example.test")
+            assert resolver.cache["a.example.test"].ttl == 600.0
+        finally:
+            transport.close()
+
+    asyncio.run(main())
+
+
+def test_nxdomain_is_cached_for_the_soa_negative_ttl():
+    async def main():
+        transport, stub, server = await start_stub(records={}, negative_ttl=45)
+        resolver = resolver_for(server)
+        try:
+            for _ in range(2):
+                with pytest.raises(socket.gaierror):
+                    await resolver.resolve("missing.example.test")
+            assert len(stub.queries) == 1
+            assert resolver.cache["missing.example.test"].ttl == 45
+            assert resolver.stats()["negative_hits"] == 1
+        finally:
+            transport.close()
+
+    asyncio.run(main())
+
+
+def test_concurrent_lookups_share_one_query():
+    async def main():
+        transport, stub, server = await start_stub(records={"c.example.test": ["192.0.2.7"]}, delay=0.05)
+        resolver = resolver_for(server)
+        try:
+            results = await asyncio.gather(*(resolver.resolve("c.example.test") for _ in range(5)))
+            assert all(result == [(socket.AF_INET, "192.0.2.7")] for result in results)
+            assert len(stub.queries) == 1
+            assert resolver.stats()["coalesced"] == 4
+        finally:
+            transport.close()
+
+    asyncio.run(main())
+
+
+def test_cancelled_follower_does_not_cancel_the_shared_lookup():
+    async def main():
+        transport, stub, server = await start_stub(records={"slow.example.test": ["192.0.2.9"]}, delay=0.2)
+        resolver = resolver_for(server)
+        try:
+            leader = asyncio.create_task(resolver.resolve("slow.example.test"))
+            await asyncio.sleep(0)
+            impatient = asyncio.create_task(asyncio.wait_for(resolver.resolve("slow.example.test"), 0.05))
+            patient = asyncio.create_task(resolver.resolve("slow.example.test"))
+            with pytest.raises(TimeoutError):
+                await impatient
+            assert await leader == [(socket.AF_INET, "192.0.2.9")]
+            assert await patient == [(socket.AF_INET, "192.0.2.9")]
+            assert "slow.example.test" in resolver.cache
+            assert len(stub.queries) == 1
+        finally:
+            transport.close()
+
+    asyncio.run(main())
+
+
+def test_cancelled_leader_fails_followers_with_gaierror():
+    async def main():
+        transport, _, server = await start_stub(records={"slow.example.test": ["192.0.2.9"]}, delay=0.2)
+        resolver = resolver_for(server)
+        try:
+            leader = asyncio.create_task(resolver.resolve("slow.example.test"))
+            await asyncio.sleep(0)
+            follower = asyncio.create_task(resolver.resolve("slow.example.test"))
+            await asyncio.sleep(0.05)
+            leader.cancel()
+            with pytest.raises(socket.gaierror):
+                await follower
+            assert leader.cancelled()
+            assert not resolver.inflight
+        finally:
+            transport.close()
+
+    asyncio.run(main())
+
+
+def test_literals_and_hosts_skip_the_network():
+    async def main():
+        resolver = Resolver(nameservers=[("127.0.0.1", 9)], hosts={"box": [(socket.AF_INET, "10.0.0.5")]})
+        assert await resolver.resolve("192.0.2.3") == [(socket.AF_INET, "192.0.2.3")]
+        assert await resolver.resolve("[::1]") == [(socket.AF_INET6, "::1")]
+        assert await resolver.resolve("box") == [(socket.AF_INET, "10.0.0.5")]
+        assert resolver.stats()["queries"] == 0
+
+    asyncio.run(main())
@@ -0,0 +1,103 @@
+"""TieredCache write-behind against a slow in-memory L2"""
+
+import asyncio
+
+from LRU import LRUCache
+from tiered import TieredCache
+
+
+class SlowStore:
+    """L2 stand-in whose writes take delay seconds"""
+
+    def __init__(self, delay: float = 0.01) -> None:
+        self.delay = delay
+        self.d = {}
+        self.writes = 0
+
+    async def aget(self, key):
+        return self.d.get(key)
+
+    async def aput(self, key, value):
+        await asyncio.sleep(self.delay)
+        self.d[key] = value
+        self.writes += 1
+
+    async def adelete(self, key):
+        self.d.pop(key, None)
+
+
+def tiered(l2, **kwargs) -> TieredCache:
+    return TieredCache(LRUCache(100), l2, flush_delay=0.0, **kwargs)
+
+
+def test_writes_reach_l2_in_the_background():
+    async def main():
+        l2 = SlowStore(delay=0.0)
+        cache = tiered(l2)
+        await cache.aput("a", b"1")
+        assert await cache.aget("a") == b"1"
+        await cache.aclose()
+        assert l2.d == {"a": b"1"}
+        assert cache.stats()["pending"] == 0 and cache.pending_bytes == 0
+
+    asyncio.run(main())
+
+
+def test_delete_during_a_batch_is_not_undone():
+    async def main():
+        l2 = SlowStore()
+        cache = tiered(l2)
+        for key in "abc":
+            await cache.aput(key, key.encode())
+        await asyncio.sleep(0.015)  # the flusher is writing "a" or "b"
+        await cache.adelete("c")
+        await asyncio.sleep(0.05)  # let the batch finish on its own
+        await cache.aclose()
+        assert "c" not in l2.d
+        assert await cache.aget("c") is None
+
+    asyncio.run(main())
+
+
+def test_newer_value_during_a_batch_wins():
+    async def main():
+        l2 = SlowStore()
+        cache = tiered(l2)
+        for key in "abc":
+            await cache.aput(key, b"old")
+        await asyncio.sleep(0.015)
+        await cache.aput("c", b"new")
+        await asyncio.sleep(0.05)
+        await cache.aclose()
+        assert l2.d["c"] == b"new"
+        assert await cache.aget("c") == b"new"
+
+    asyncio.run(main())
+
+
+def test_queue_is_bounded_by_bytes():
+    async def main():
+        l2 = SlowStore(delay=0.05)
+        cache = tiered(l2, max_pending_bytes=10)
+        for n in range(5):
+            await cache.aput(f"k{n}", b"xxxx")
+            assert cache.pending_bytes <= 10
+        assert cache.counters["write_through"] >= 1
+        await cache.aclose()
+        assert len(l2.d) == 5
+
+    asyncio.run(main())
+
+
+def test_l2_hits_are_promoted_after_repeated_reads():
+    async def main():
+        l2 = SlowStore(delay=0.0)
+        l2.d["cold"] = b"v"
+        cache = tiered(l2, promote_after=2)
+        assert await cache.aget("cold") == b"v"
+        assert cache.l1.get("cold") is None
+        assert await cache.aget("cold") == b"v"
+        assert cache.l1.get("cold") == b"v"
+        assert cache.counters["promotions"] == 1
+
+    asyncio.run(main())
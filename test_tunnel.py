@@ -0,0 +1,44 @@
+"""tunnel.relay byte accounting between local sockets"""
+
+import asyncio
+
+import pytest
+
+import tunnel
+
+
+@pytest.mark.parametrize("engine", ["auto", "buffered"])
+def test_relay_counts_bytes_already_buffered(engine):
+    async def main():
+        async def echo(reader, writer):
+            while data := await reader.read(65536):
+                writer.write(data)
+                await writer.drain()
+            writer.close()
+
+        relayed = asyncio.get_running_loop().create_future()
+
+        async def handle(reader, writer):
+            # The head and the first tunnelled bytes arrive in one segment
+            await reader.readuntil(b"\r\n\r\n")
+            target_reader, target_writer = await asyncio.open_connection("127.0.0.1", origin_port)
+            relayed.set_result(await tunnel.relay(reader, writer, target_reader, target_writer, engine))
+            writer.close()
+
+        origin = await asyncio.start_server(echo, "127.0.0.1", 0)
+        origin_port = origin.sockets[0].getsockname()[1]
+        proxy = await asyncio.start_server(handle, "127.0.0.1", 0)
+        reader, writer = await asyncio.open_connection("127.0.0.1", proxy.sockets[0].getsockname()[1])
+        writer.write(b"CONNECT x:1 HTTP/1.1\r\n\r\n" + b"early" * 100)
+        await writer.drain()
+        await asyncio.sleep(0.05)
+        writer.write(b"late" * 100)
+        writer.write_eof()
+        echoed = await reader.read()
+        assert echoed == b"early" * 100 + b"late" * 100
+        assert await relayed == 2 * len(echoed)
+        writer.close()
+        proxy.close()
+        origin.close()
+
+    asyncio.run(main())
@@ -0,0 +1,164 @@
+"""Two-Tier Cache: In-Memory L1 over a Persistent L2"""
+
+from asyncio import Event, Task, create_task, sleep
+from collections import OrderedDict
+from itertools import islice
+from typing import Dict, Optional
+import logging
+
+
+class TieredCache:
+    """Bounded in-memory L1 in front of a persistent L2
+
+    Both tiers expose the common cache interface: async aget(key),
+    aput(key, value) and adelete(key), so a TieredCache can itself be used
+    anywhere a single cache can (e.g. behind httpcache.HTTPCache).
+
+    Writes go to L1 at once and reach L2 through a write-behind queue that a
+    background task drains in batches, so the request path never waits for
+    disk or SQLite; reads check that queue before L2. An L2 hit is only
+    promoted into L1 once the key has been read promote_after times from L2,
+    so one-off reads do not churn the hot tier. Every write reaches L2 through
+    that queue, so an entry evicted from L1 needs no demotion: it is already
+    in L2 or still queued for it. Once max_pending_bytes are queued, L2 is
+    falling behind and further writes go straight through to it, so the
+    queue stays bounded and the writers wait instead. L2 keeps its contents
+    across restarts, so a restarted proxy starts with a warm cache.
+    """
+
+    def __init__(self, l1, l2, promote_after: int = 2, flush_delay: float = 0.05,
+                 batch_size: int = 256, max_candidates: int = 65536,
+                 max_pending_bytes: int = 64 * 1024 * 1024) -> None:
+        self.l1 = l1
+        self.l2 = l2
+        self.promote_after = promote_after
+        self.flush_delay = flush_delay
+        self.batch_size = batch_size
+        self.max_candidates = max_candidates
+        self.max_pending_bytes = max_pending_bytes
+        # Writes not yet in L2, in arrival order
+        self.pending: "OrderedDict[str, bytes]" = OrderedDict()
+        self.pending_bytes = 0
+        # L2 hit counts for keys not (yet) in L1
+        self.candidates: "OrderedDict[str, int]" = OrderedDict()
+        self.wakeup: Optional[Event] = None
+        self.flusher: Optional[Task] = None
+        self.counters = {"l1_hits": 0, "l2_hits": 0, "misses": 0, "promotions": 0,
+                         "write_behind": 0, "write_through": 0, "write_errors": 0}
+
+    async def aget(self, key: str) -> Optional[bytes]:
+        """Look up L1, then queued writes, then L2"""
+        value = await self.l1.aget(key)
+        if value is not None:
+            self.counters["l1_hits"] += 1
+            return value
+        value = self.pending.get(key)
+        if value is None:
+            value = await self.l2.aget(key)
+        if value is None:
+            self.counters["misses"] += 1
+            return None
+        self.counters["l2_hits"] += 1
+        hits = self.candidates.pop(key, 0) + 1
+        if hits >= self.promote_after:
+            await self.l1.aput(key, value)
+            self.counters["promotions"] += 1
+        else:
+            self.candidates[key] = hits
+            if len(self.candidates) > self.max_candidates:
+                self.candidates.popitem(last=False)
+        return value
+
+    async def aput(self, key: str, value: bytes) -> None:
+        """Store in L1 and queue the write to L2 (or make it, if L2 is behind)"""
+        self.candidates.pop(key, None)
+        self._unqueue(key)
+        if self.pending_bytes + len(value) > self.max_pending_bytes:
+            await self.l1.aput(key, value)
+            self.counters["write_through"] += 1
+            await self._write(key, value)
+            return
+        self.pending[key] = value
+        self.pending_bytes += len(value)
+        self._start()
+        await self.l1.aput(key, value)
+        self.wakeup.set()
+
+    async def adelete(self, key: str) -> None:
+        """Remove from both tiers"""
+        self.candidates.pop(key, None)
+        self._unqueue(key)
+        await self.l1.adelete(key)
+        await self.l2.adelete(key)
+
+    async def flush(self) -> None:
+        """Write every queued entry to L2"""
+        while self.pending:
+            # Entries stay readable from the queue until L2 has them
+            batch = list(islice(self.pending.items(), self.batch_size))
+            for key, value in batch:
+                # Deleted or overwritten while earlier writes of the batch were awaited
+                if self.pending.get(key) is not value:
+                    continue
+                if await self._write(key, value):
+                    self.counters["write_behind"] += 1
+                if self.pending.get(key) is value:
+                    self._unqueue(key)
+
+    async def _write(self, key: str, value: bytes) -> bool:
+        try:
+            await self.l2.aput(key, value)
+            return True
+        except Exception as e:
+            # Losing a cache write is harmless; keep the flusher alive
+            self.counters["write_errors"] += 1
+            logging.error("Write of %s to L2 failed: %s", key, e)
+            return False
+
+    def _unqueue(self, key: str) -> None:
+        value = self.pending.pop(key, None)
+        if value is not None:
+            self.pending_bytes -= len(value)
+
+    async def aclose(self) -> None:
+        """Drain the write-behind queue and stop the flusher"""
+        if self.flusher is not None:
+            self.flusher.cancel()
+            self.flusher = None
+        await self.flush()
+
+    def close(self) -> None:
+        """Close both tiers (call aclose() first to drain queued writes)"""
+        for tier in (self.l1, self.l2):
+            if hasattr(tier, "close"):
+                tier.close()
+
+    def stats(self) -> Dict[str, float]:
+        """Per-tier hit ratios plus promotion and write-behind counters"""
+        stats: Dict[str, float] = dict(self.counters)
+        lookups = self.counters["l1_hits"] + self.counters["l2_hits"] + self.counters["misses"]
+        l2_lookups = lookups - self.counters["l1_hits"]
+        stats["l1_hit_ratio"] = self.counters["l1_hits"] / lookups if lookups else 0.0
+        stats["l2_hit_ratio"] = self.counters["l2_hits"] / l2_lookups if l2_lookups else 0.0
+        stats["hit_ratio"] = (lookups - self.counters["misses"]) / lookups if lookups else 0.0
+        stats["pending"] = len(self.pending)
+        stats["pending_bytes"] = self.pending_bytes
+        for name, tier in (("l1", self.l1), ("l2", self.l2)):
+            if hasattr(tier, "stats"):
+                for stat, value in tier.stats().items():
+                    stats[f"{name}_{stat}"] = value
+        return stats
+
+    def _start(self) -> None:
+        if self.flusher is None or self.flusher.done():
+            self.wakeup = Event()
+            self.flusher = create_task(self._run())
+
+    async def _run(self) -> None:
+        """Background write-behind: wait for work, let a batch build up unless one is full, write it"""
+        while True:
+            await self.wakeup.wait()
+            self.wakeup.clear()
+            if len(self.pending) < self.batch_size:
+                await sleep(self.flush_delay)
+            await self.flush()
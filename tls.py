@@ -0,0 +1,149 @@
+"""Upstream TLS: Shared Client Contexts with Session Resumption"""
+
+from collections import OrderedDict
+from typing import Dict, Optional, Tuple
+import ssl
+import time
+
+TrustKey = Tuple[Optional[str], Optional[str], bool]  # cafile, capath, verify
+
+
+class ResumingSSLObject(ssl.SSLObject):
+    """SSLObject that reports its handshake and hands its session back to the context
+
+    asyncio creates one through SSLContext.wrap_bio() for every TLS
+    connection, so these hooks see every upstream handshake without the
+    streams API having to expose sessions.
+    """
+
+    def do_handshake(self) -> None:
+        super().do_handshake()
+        # Only reached once the handshake completed (otherwise SSLWantReadError was raised)
+        self.context.handshake_done(self)
+
+    def read(self, len: int = 1024, buffer=None):
+        data = super().read(len, buffer)
+        if self.pending_session:
+            # TLS 1.3 tickets arrive after the handshake, ahead of the first response bytes
+            self.pending_session = False
+            self.context.remember(self)
+        return data
+
+
+class ClientContext(ssl.SSLContext):
+    """Verifying client context that resumes TLS sessions per server name
+
+    Building a context parses the whole CA bundle, so one is built per trust
+    configuration and shared by every connection. Sessions are kept for the
+    max_sessions most recently used server names and offered on the next
+    handshake with that name, which saves a round trip and the certificate
+    verification on TLS 1.2 and the certificate exchange on TLS 1.3.
+    """
+
+    sslobject_class = ResumingSSLObject
+
+    def __new__(cls, max_sessions: int = 1024):
+        return super().__new__(cls, ssl.PROTOCOL_TLS_CLIENT)
+
+    def __init__(self, max_sessions: int = 1024) -> None:
+        super().__init__()
+        self.max_sessions = max_sessions
+        self.sessions: "OrderedDict[str, ssl.SSLSession]" = OrderedDict()
+        self.counters = {"handshakes": 0, "resumed": 0, "handshake_seconds": 0.0, "sessions_stored": 0}
+
+    def wrap_bio(self, incoming: ssl.MemoryBIO, outgoing: ssl.MemoryBIO, server_side: bool = False,
+                 server_hostname: Optional[str] = None, session: Optional[ssl.SSLSession] = None) -> ssl.SSLObject:
+        if session is None and server_hostname is not None:
+            session = self.sessions.get(server_hostname)
+        sslobj = super().wrap_bio(incoming, outgoing, server_side, server_hostname, session)
+        sslobj.pending_session = False
+        sslobj.started = time.perf_counter()
+        return sslobj
+
+    def handshake_done(self, sslobj: ssl.SSLObject) -> None:
+        self.counters["handshakes"] += 1
+        self.counters["handshake_seconds"] += time.perf_counter() - sslobj.started
+        if sslobj.session_reused:
+            self.counters["resumed"] += 1
+        # A resumed session stays valid; a TLS 1.2 session is complete now, a TLS 1.3 one after its ticket
+        if not sslobj.session_reused:
+            if sslobj.version() == "TLSv1.3":
+                sslobj.pending_session = True
+            else:
+                self.remember(sslobj)
+
+    def remember(self, sslobj: ssl.SSLObject) -> None:
+        """Keep a connection's session for the next handshake with the same server name"""
+        session = sslobj.session
+        name = sslobj.server_hostname
+        if session is None or name is None:
+            return
+        if sslobj.version() == "TLSv1.3" and not session.has_ticket:
+            return
+        self.sessions[name] = session
+        self.sessions.move_to_end(name)
+        self.counters["sessions_stored"] += 1
+        while len(self.sessions) > self.max_sessions:
+            self.sessions.popitem(last=False)
+
+    def stats(self) -> Dict[str, float]:
+        return dict(self.counters, sessions=len(self.sessions))
+
+
+class TLSClient:
+    """Client contexts for upstream connections, one per trust configuration
+
+    context() builds a context the first time a (cafile, capath, verify)
+    combination is asked for and returns the same object afterwards, so the
+    CA bundle is parsed once per process instead of once per request, and
+    sessions are shared by every connection that trusts the same roots.
+    """
+
+    def __init__(self, max_sessions: int = 1024) -> None:
+        self.max_sessions = max_sessions
+        self.contexts: Dict[TrustKey, ClientContext] = {}
+
+    def context(self, cafile: Optional[str] = None, capath: Optional[str] = None,
+                verify: bool = True) -> ClientContext:
+        """Shared context trusting cafile/capath, or the system roots when neither is given"""
+        key = (cafile, capath, verify)
+        context = self.contexts.get(key)
+        if context is None:
+            context = ClientContext(self.max_sessions)
+            context.minimum_version = ssl.TLSVersion.TLSv1_2
+            # Upstream connections only speak HTTP/1.1
+            context.set_alpn_protocols(["http/1.1"])
+            if not verify:
+                context.check_hostname = False
+                context.verify_mode = ssl.CERT_NONE
+            elif cafile or capath:
+                context.load_verify_locations(cafile=cafile, capath=capath)
+            else:
+                context.load_default_certs(ssl.Purpose.SERVER_AUTH)
+            self.contexts[key] = context
+        return context
+
+    def stats(self) -> Dict[str, float]:
+        """Handshake counters over every context, with the resumption rate
+
+        handshake_seconds is a running total, so the mean handshake time over
+        any interval is its increase divided by that of handshakes.
+        """
+        stats: Dict[str, float] = {"contexts": len(self.contexts)}
+        for context in self.contexts.values():
+            for key, value in context.stats().items():
+                stats[key] = stats.get(key, 0) + value
+        handshakes = stats.get("handshakes", 0)
+        stats["resumption_ratio"] = stats.get("resumed", 0) / handshakes if handshakes else 0.0
+        return stats
+
+
+_default: Optional[TLSClient] = None
+
+
+def default_context() -> ClientContext:
+    """Process-wide context trusting the system roots, for callers that do not bring their own"""
+    global _default
+    if _default is None:
+        _default = TLSClient()
+    return _default.context()
@@ -0,0 +1,308 @@
+"""CONNECT Tunnel Relay Engines
+
+Once a tunnel is established, bytes only need to be copied between two
+sockets. Two engines do that without going through StreamReader/StreamWriter:
+
+* "buffered": both transports are switched to a BufferedProtocol that
+  receives into a reusable preallocated buffer and writes straight to the
+  peer transport, with read pausing driven by the peer's write watermarks.
+* "splice": on Linux with a selector event loop the sockets are driven
+  directly and data moves socket -> pipe -> socket with os.splice, so it is
+  never copied into Python.
+
+"auto" picks splice when it is available and falls back to buffered.
+"""
+
+from asyncio import (
+    AbstractEventLoop, BaseTransport, BufferedProtocol, Future, StreamReader, StreamWriter,
+    get_running_loop,
+)
+from asyncio.selector_events import BaseSelectorEventLoop
+from typing import List, Optional
+import logging
+import os
+import socket
+import sys
+
+try:
+    import fcntl
+except ImportError:  # Windows
+    fcntl = None
+
+MIN_BUFFER = 16 * 1024
+MAX_BUFFER = 1024 * 1024
+DEFAULT_BUFFER = 64 * 1024
+HIGH_WATER = 1024 * 1024
+LOW_WATER = 256 * 1024
+
+SPLICE_AVAILABLE = sys.platform.startswith("linux") and hasattr(os, "splice")
+
+
+class _TunnelSide(BufferedProtocol):
+    """Protocol for one end of a tunnel; what it receives is written to the peer"""
+
+    def __init__(self, tunnel: "_BufferedTunnel", buffer_size: int) -> None:
+        self.tunnel = tunnel
+        self.transport: Optional[BaseTransport] = None
+        self.peer: Optional["_TunnelSide"] = None
+        self.size = buffer_size
+        self.buffer = memoryview(bytearray(buffer_size))
+        self.small_reads = 0
+        self.eof = False
+
+    def get_buffer(self, sizehint: int) -> memoryview:
+        return self.buffer
+
+    def buffer_updated(self, nbytes: int) -> None:
+        peer = self.peer.transport
+        peer.write(self.buffer[:nbytes])
+        self.tunnel.bytes += nbytes
+        if peer.get_write_buffer_size():
+            # The transport may still hold a view of this buffer, so stop reusing it
+            self.buffer = memoryview(bytearray(self.size))
+        self._adapt(nbytes)
+
+    def _adapt(self, nbytes: int) -> None:
+        """Grow the buffer on full reads, shrink it after a run of small ones"""
+        if nbytes == self.size and self.size < MAX_BUFFER:
+            self.size *= 2
+            self.buffer = memoryview(bytearray(self.size))
+            self.small_reads = 0
+        elif nbytes < self.size // 4 and self.size > MIN_BUFFER:
+            self.small_reads += 1
+            if self.small_reads >= 16:
+                self.size //= 2
+                self.buffer = memoryview(bytearray(self.size))
+                self.small_reads = 0
+        else:
+            self.small_reads = 0
+
+    def eof_received(self) -> bool:
+        self.eof = True
+        peer = self.peer.transport
+        if self.peer.eof or not peer.can_write_eof():
+            self.tunnel.close()
+            return False
+        peer.write_eof()
+        return True
+
+    def pause_writing(self) -> None:
+        self.peer.transport.pause_reading()
+
+    def resume_writing(self) -> None:
+        self.peer.transport.resume_reading()
+
+    def connection_lost(self, exc: Optional[Exception]) -> None:
+        self.tunnel.close(exc)
+
+
+class _BufferedTunnel:
+    """Relay between two transports using BufferedProtocol"""
+
+    def __init__(self, loop: AbstractEventLoop, buffer_size: int) -> None:
+        self.done: Future = loop.create_future()
+        self.left = _TunnelSide(self, buffer_size)
+        self.right = _TunnelSide(self, buffer_size)
+        self.left.peer, self.right.peer = self.right, self.left
+        self.bytes = 0
+
+    def start(self, left: BaseTransport, right: BaseTransport, at_eof: List[bool]) -> None:
+        """Swap both transports over to the tunnel protocols"""
+        for side, transport in ((self.left, left), (self.right, right)):
+            side.transport = transport
+            transport.set_write_buffer_limits(HIGH_WATER, LOW_WATER)
+            transport.set_protocol(side)
+        for side, eof in zip((self.left, self.right), at_eof):
+            if eof and not self.done.done():
+                side.eof_received()
+        for side in (self.left, self.right):
+            if side.transport.is_closing():
+                self.close()
+            elif not side.eof:
+                side.transport.resume_reading()
+
+    def close(self, exc: Optional[Exception] = None) -> None:
+        """Close both ends"""
+        for side in (self.left, self.right):
+            if side.transport is not None and not side.transport.is_closing():
+                side.transport.close()
+        if not self.done.done():
+            self.done.set_result(self.bytes)
+
+
+class _SpliceDirection:
+    """Moves one direction of a tunnel with os.splice through a pipe"""
+
+    def __init__(self, tunnel: "_SpliceTunnel", src: socket.socket, dst: socket.socket, buffer_size: int) -> None:
+        self.tunnel = tunnel
+        self.loop = tunnel.loop
+        self.src = src
+        self.dst = dst
+        self.pipe_r, self.pipe_w = os.pipe()
+        os.set_blocking(self.pipe_r, False)
+        os.set_blocking(self.pipe_w, False)
+        if fcntl is not None and hasattr(fcntl, "F_SETPIPE_SZ"):
+            try:
+                buffer_size = fcntl.fcntl(self.pipe_w, fcntl.F_SETPIPE_SZ, buffer_size)
+            except OSError:
+                buffer_size = fcntl.fcntl(self.pipe_w, fcntl.F_GETPIPE_SZ)
+        self.chunk = buffer_size
+        self.pending = 0
+        self.writing = False
+        self.finished = False
+
+    def start(self) -> None:
+        self.loop.add_reader(self.src.fileno(), self._readable)
+
+    def _readable(self) -> None:
+        try:
+            n = os.splice(self.src.fileno(), self.pipe_w, self.chunk,
+                          flags=os.SPLICE_F_MOVE | os.SPLICE_F_NONBLOCK)
+        except (BlockingIOError, InterruptedError):
+            return
+        except OSError as e:
+            self.tunnel.close(e)
+            return
+        if n == 0:
+            self._finish()
+            return
+        self.pending += n
+        self.tunnel.bytes += n
+        self._flush()
+
+    def _flush(self) -> None:
+        while self.pending:
+            try:
+                n = os.splice(self.pipe_r, self.dst.fileno(), self.pending,
+                              flags=os.SPLICE_F_MOVE | os.SPLICE_F_NONBLOCK)
+            except (BlockingIOError, InterruptedError):
+                if not self.writing:
+                    # Peer is slow: stop reading until the pipe drains (backpressure)
+                    self.writing = True
+                    self.loop.remove_reader(self.src.fileno())
+                    self.loop.add_writer(self.dst.fileno(), self._flush)
+                return
+            except OSError as e:
+                self.tunnel.close(e)
+                return
+            self.pending -= n
+        if self.writing:
+            self.writing = False
+            self.loop.remove_writer(self.dst.fileno())
+            self.loop.add_reader(self.src.fileno(), self._readable)
+
+    def _finish(self) -> None:
+        self.finished = True
+        self.loop.remove_reader(self.src.fileno())
+        try:
+            self.dst.shutdown(socket.SHUT_WR)
+        except OSError:
+            pass
+        self.tunnel.direction_done()
+
+    def close(self) -> None:
+        if not self.finished:
+            self.loop.remove_reader(self.src.fileno())
+        if self.writing:
+            self.loop.remove_writer(self.dst.fileno())
+        os.close(self.pipe_r)
+        os.close(self.pipe_w)
+
+
+class _SpliceTunnel:
+    """Relay between two sockets using os.splice"""
+
+    def __init__(self, loop: AbstractEventLoop, left: socket.socket, right: socket.socket,
+                 transports: List[BaseTransport], buffer_size: int) -> None:
+        self.loop = loop
+        self.done: Future = loop.create_future()
+        self.sockets = (left, right)
+        self.transports = transports
+        self.bytes = 0
+        self.directions = (
+            _SpliceDirection(self, left, right, buffer_size),
+            _SpliceDirection(self, right, left, buffer_size),
+        )
+
+    def start(self) -> None:
+        for direction in self.directions:
+            direction.start()
+
+    def direction_done(self) -> None:
+        if all(direction.finished for direction in self.directions):
+            self.close()
+
+    def close(self, exc: Optional[Exception] = None) -> None:
+        if self.done.done():
+            return
+        if exc is not None:
+            logging.debug("Splice tunnel error: %s", exc)
+        for direction in self.directions:
+            direction.close()
+        for sock in self.sockets:
+            sock.close()
+        for transport in self.transports:
+            transport.close()
+        self.done.set_result(self.bytes)
+
+
+def _buffered_bytes(reader: StreamReader) -> bytes:
+    """Take whatever the StreamReader already pulled off the socket"""
+    buffer = getattr(reader, "_buffer", None)
+    if not buffer:
+        return b""
+    data = bytes(buffer)
+    buffer.clear()
+    return data
+
+
+def _raw_socket(writer: StreamWriter) -> Optional[socket.socket]:
+    """A duplicate of the writer's socket, or None if it cannot be driven directly"""
+    if writer.get_extra_info("sslcontext") is not None:
+        return None
+    sock = writer.get_extra_info("socket")
+    if sock is None or sock.type != socket.SOCK_STREAM:
+        return None
+    return socket.socket(fileno=os.dup(sock.fileno()))
+
+
+async def relay(client_reader: StreamReader, client_writer: StreamWriter,
+                target_reader: StreamReader, target_writer: StreamWriter,
+                engine: str = "auto", buffer_size: int = DEFAULT_BUFFER) -> int:
+    """Relay a tunnel in both directions until both sides are done, returning bytes moved"""
+    loop = get_running_loop()
+    left, right = client_writer.transport, target_writer.transport
+    for transport in (left, right):
+        transport.pause_reading()
+    # Anything the StreamReaders already pulled off the sockets goes out first
+    buffered = 0
+    for reader, writer in ((client_reader, target_writer), (target_reader, client_writer)):
+        data = _buffered_bytes(reader)
+        if data:
+            writer.write(data)
+            buffered += len(data)
+    await client_writer.drain()
+    await target_writer.drain()
+    at_eof = [client_reader.at_eof(), target_reader.at_eof()]
+
+    if engine in ("auto", "splice") and SPLICE_AVAILABLE and not any(at_eof) \
+            and isinstance(loop, BaseSelectorEventLoop) \
+            and not left.get_write_buffer_size() and not right.get_write_buffer_size():
+        left_sock, right_sock = _raw_socket(client_writer), _raw_socket(target_writer)
+        if left_sock is not None and right_sock is not None:
+            tunnel = _SpliceTunnel(loop, left_sock, right_sock, [left, right], buffer_size)
+            tunnel.start()
+            try:
+                return buffered + await tunnel.done
+            finally:
+                tunnel.close()
+        for sock in (left_sock, right_sock):
+            if sock is not None:
+                sock.close()
+
+    tunnel = _BufferedTunnel(loop, buffer_size)
+    tunnel.start(left, right, at_eof)
+    try:
+        return buffered + await tunnel.done
+    finally:
+        tunnel.close()
@@ -0,0 +1,265 @@
+"""Asyncio HTTP/1.1 Upstream Client"""
+
+from asyncio import IncompleteReadError, StreamReader, StreamWriter, wait_for
+from typing import AsyncIterator, Dict, List, Optional, Union
+import ssl
+import time
+
+from http1 import (
+    Headers, RequestBody, content_length, framed_headers, get_header, has_body, is_chunked,
+    read_chunk_size, read_headers, read_response_head, serialize_head, strip_hop_by_hop,
+)
+from accesslog import note
+from dialer import Dialer
+from metrics import Histogram
+from pool import ConnectionPool, PoolKey
+
+IDEMPOTENT = frozenset(("GET", "HEAD", "OPTIONS", "PUT", "DELETE", "TRACE"))
+CHUNK_SIZE = 65536
+
+
+class BodyTee:
+    """Collects a streamed body for the cache, giving up once it grows past max_size"""
+
+    def __init__(self, max_size: int) -> None:
+        self.max_size = max_size
+        self.chunks: List[bytes] = []
+        self.size = 0
+        self.overflow = False
+
+    def feed(self, data: bytes) -> None:
+        """Add a chunk of body"""
+        if self.overflow:
+            return
+        self.size += len(data)
+        if self.size > self.max_size:
+            self.overflow = True
+            self.chunks.clear()
+            return
+        self.chunks.append(data)
+
+    def getvalue(self) -> Optional[bytes]:
+        """The collected body, or None if it was too large to keep"""
+        if self.overflow:
+            return None
+        return b"".join(self.chunks)
+
+
+class UpstreamResponse:
+    """Response read from an origin server"""
+
+    def __init__(self, method: str, version: str, status: int, reason: str, headers: Headers,
+                 reader: StreamReader, writer: StreamWriter,
+                 pool: Optional[ConnectionPool] = None, key: Optional[PoolKey] = None) -> None:
+        self.method = method
+        self.version = version
+        self.status = status
+        self.reason = reason
+        self.headers = headers
+        self.reader = reader
+        self.writer = writer
+        self.pool = pool
+        self.key = key
+
+    def getheader(self, name: str, default: Optional[str] = None) -> Optional[str]:
+        """Get a response header"""
+        return get_header(self.headers, name, default)
+
+    def getheaders(self) -> Headers:
+        """Get all response headers"""
+        return list(self.headers)
+
+    @property
+    def will_close(self) -> bool:
+        """Whether the connection cannot be reused after this response"""
+        connection = (self.getheader("Connection") or "").lower()
+        if "close" in connection:
+            return True
+        if self.version == "HTTP/1.0" and "keep-alive" not in connection:
+            return True
+        if not has_body(self.method, self.status):
+            return False
+        return not is_chunked(self.headers) and content_length(self.headers) is None
+
+    async def iter_body(self, chunk_size: int = CHUNK_SIZE) -> AsyncIterator[bytes]:
+        """Yield the decoded body as it arrives, releasing the connection at the end"""
+        complete = False
+        try:
+            if not has_body(self.method, self.status):
+                pass
+            elif is_chunked(self.headers):
+                while True:
+                    size = await read_chunk_size(self.reader)
+                    if size == 0:
+                        await read_headers(self.reader)
+                        break
+                    while size:
+                        data = await self.reader.read(min(size, chunk_size))
+                        if not data:
+                            raise IncompleteReadError(b"", size)
+                        size -= len(data)
+                        yield data
+                    await self.reader.readexactly(2)
+            else:
+                remaining = content_length(self.headers)
+                while remaining is None or remaining > 0:
+                    data = await self.reader.read(chunk_size if remaining is None else min(remaining, chunk_size))
+                    if not data:
+                        if remaining is None:
+                            break
+                        raise IncompleteReadError(b"", remaining)
+                    if remaining is not None:
+                        remaining -= len(data)
+                    yield data
+            complete = True
+        finally:
+            self.release(complete)
+
+    async def read(self) -> bytes:
+        """Read the whole body according to the response framing"""
+        return b"".join([data async for data in self.iter_body()])
+
+    async def relay(self, writer: StreamWriter, version: str, persistent: bool,
+                    tee: Optional[BodyTee] = None) -> bool:
+        """Forward the response head at once, then stream the body to writer with backpressure
+
+        Bodies without a length go out chunked to HTTP/1.1 clients and close-delimited
+        otherwise. Returns whether the client connection can stay open.
+        """
+        headers = strip_hop_by_hop(self.headers)
+        chunked = False
+        if has_body(self.method, self.status) and content_length(self.headers) is None:
+            if version.upper() == "HTTP/1.1":
+                headers.append(("Transfer-Encoding", "chunked"))
+                chunked = True
+            else:
+                persistent = False
+        headers.append(("Connection", "keep-alive" if persistent else "close"))
+        writer.write(serialize_head(f"{version} {self.status} {self.reason}", headers))
+        note(status=self.status)
+
+        body = self.iter_body()
+        sent = 0
+        try:
+            async for data in body:
+                if tee is not None:
+                    tee.feed(data)
+                if chunked:
+                    writer.writelines((b"%x\r\n" % len(data), data, b"\r\n"))
+                else:
+                    writer.write(data)
+                sent += len(data)
+                await writer.drain()
+        finally:
+            note(sent=sent)
+            await body.aclose()
+        if chunked:
+            writer.write(b"0\r\n\r\n")
+        await writer.drain()
+        return persistent
+
+    def serialize(self, version: str, body: bytes) -> bytes:
+        """Serialize the response with a fixed-length body, as stored in the cache"""
+        if has_body(self.method, self.status):
+            headers = framed_headers(self.headers, len(body))
+        else:
+            headers = strip_hop_by_hop(self.headers)
+        return serialize_head(f"{version} {self.status} {self.reason}", headers) + body
+
+    def release(self, complete: bool = True) -> None:
+        """Hand the connection back to the pool, or close it if it cannot be reused"""
+        if complete and self.pool is not None and not self.will_close:
+            self.pool.release(self.key, self.reader, self.writer)
+        else:
+            self.close()
+        self.pool = None
+
+    def close(self) -> None:
+        """Close the upstream connection"""
+        if not self.writer.is_closing():
+            self.writer.close()
+
+
+class UpstreamClient:
+    """Non-blocking HTTP/1.1 client used to reach origin servers"""
+
+    def __init__(self, timeout: float = 30.0, pool: Optional[ConnectionPool] = None,
+                 dialer: Optional[Dialer] = None) -> None:
+        self.timeout = timeout
+        self.pool = pool if pool is not None else ConnectionPool(dialer=dialer)
+        self.acquire_seconds = Histogram()
+        self.ttfb_seconds = Histogram()
+
+    def histograms(self) -> Dict[str, Histogram]:
+        """Time to get a connection (pooled or new) and from sending a request to its response head"""
+        return {"acquire_seconds": self.acquire_seconds, "ttfb_seconds": self.ttfb_seconds}
+
+    async def request(self, scheme: str, host: str, port: int, method: str, path: str,
+                      headers: Headers, body: Union[bytes, RequestBody] = b"",
+                      ssl_context: Optional[ssl.SSLContext] = None) -> UpstreamResponse:
+        """Send a request to host:port and return once the response head arrives
+
+        A RequestBody is streamed to the origin as it arrives from the client,
+        chunked when the client did not declare a length.
+        """
+        key = (scheme, host, port)
+        send_headers = strip_hop_by_hop(headers)
+        if get_header(send_headers, "Host") is None:
+            default_port = 443 if scheme == "https" else 80
+            send_headers.insert(0, ("Host", host if port == default_port else f"{host}:{port}"))
+        # Expect: 100-continue is answered by RequestBody, not passed on
+        send_headers = [(k, v) for k, v in send_headers if k.lower() not in ("content-length", "expect")]
+        streaming = isinstance(body, RequestBody)
+        if streaming and body.length is None:
+            send_headers.append(("Transfer-Encoding", "chunked"))
+        elif streaming:
+            send_headers.append(("Content-Length", str(body.length)))
+        elif body or method.upper() in ("POST", "PUT", "PATCH"):
+            send_headers.append(("Content-Length", str(len(body))))
+        head = serialize_head(f"{method} {path} HTTP/1.1", send_headers)
+
+        while True:
+            start = time.perf_counter()
+            reader, writer, reused = await self.pool.acquire(key, ssl_context, self.timeout)
+            sent = time.perf_counter()
+            self.acquire_seconds.observe(sent - start)
+            try:
+                if streaming:
+                    writer.write(head)
+                    await self.__send_body(writer, body)
+                else:
+                    writer.write(head + body)
+                await writer.drain()
+                while True:
+                    version, status, reason, response_headers = await wait_for(
+                        read_response_head(reader), self.timeout)
+                    # Interim responses are consumed here; the caller only sees the final one
+                    if 100 <= status < 200 and status != 101:
+                        continue
+                    self.ttfb_seconds.observe(time.perf_counter() - sent)
+                    return UpstreamResponse(method, version, status, reason, response_headers,
+                                            reader, writer, self.pool, key)
+            except (ConnectionError, IncompleteReadError) as e:
+                writer.close()
+                # A pooled connection may have been closed by the origin while idle
+                stale = not isinstance(e, IncompleteReadError) or not e.partial
+                replayable = not streaming or not body.started
+                if reused and stale and replayable and method.upper() in IDEMPOTENT:
+                    continue
+                raise
+            except BaseException:
+                writer.close()
+                raise
+
+    @staticmethod
+    async def __send_body(writer: StreamWriter, body: RequestBody) -> None:
+        """Pipe a client request body to the origin"""
+        chunked = body.length is None
+        async for data in body:
+            if chunked:
+                writer.writelines((b"%x\r\n" % len(data), data, b"\r\n"))
+            else:
+                writer.write(data)
+            await writer.drain()
+        if chunked:
+            writer.write(b"0\r\n\r\n")